@@ -5,6 +5,9 @@ python3 setup.py install
 
 # Install executables
 install -m 755 zm_notifier /usr/bin
+install -m 755 zm_evaluate /usr/bin
+install -m 755 zm_inference_server /usr/bin
+install -m 755 zm_reanalyze /usr/bin
 
 # Install config file read-only root permissions
 install -m 600 zm_notifier.cfg /etc
@@ -4,6 +4,8 @@ from setuptools import setup
 
 setup(name = "ZoneMinder_notifier",
       version = "0.2",
-      py_modules = ["zm_api", "zm_monitor", "zm_notification", "zm_object_detection",
-                    "zm_settings", "zm_util"],
+      py_modules = ["zm_api", "zm_event_db", "zm_event_queue", "zm_inference", "zm_latency",
+                    "zm_monitor", "zm_network_manager", "zm_notification", "zm_object_detection",
+                    "zm_profile", "zm_scheduler", "zm_settings", "zm_stream", "zm_trace",
+                    "zm_util"],
       )
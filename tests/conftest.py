@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are installed with py_modules, so make them importable from a checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,69 @@
+import numpy as np
+from zm_object_detection import DetectorCascade, DetectorHOG
+
+
+class FakeStage:
+    '''Detector stage reporting the given confidences for the person class'''
+    def __init__(self, model_name, confidences, conf_threshold):
+        self.model_name = model_name
+        self.confidences = confidences
+        self.conf_threshold = conf_threshold
+        self.calls = 0
+
+    def detectInImage(self, image_file, annotate_name=True, show=True):
+        self.calls += 1
+        return np.zeros((8, 8, 3), np.uint8), ["person"]*len(self.confidences), \
+               list(self.confidences)
+
+    def detectInVideo(self, video_file, annotate_name=True, show=True, annotate_fps=True,
+                      return_first_detection=False):
+        return self.detectInImage(video_file)
+
+
+def cascade(first_confidences, second_confidences, threshold=0.5, first_stage=None):
+    if first_stage is None:
+        first_stage = FakeStage("MobileNetV3", first_confidences, 0.3)
+    second_stage = FakeStage("Darknet", second_confidences, threshold)
+    return DetectorCascade("test", first_stage, second_stage, uncertain_low=0.3,
+                           uncertain_high=0.7, escalate_score=50)
+
+
+def test_confident_first_stage_decides():
+    detector = cascade([0.9], [0.6])
+    _, classes, confidences = detector.detectInImage("image.jpg", show=False)
+    assert confidences == [0.9]
+    assert detector.decided_by == "MobileNetV3"
+    assert detector.second_stage.calls == 0
+
+
+def test_uncertain_first_stage_escalates():
+    detector = cascade([0.5], [0.6])
+    _, classes, confidences = detector.detectInImage("image.jpg", show=False)
+    assert confidences == [0.6]
+    assert detector.decided_by == "Darknet"
+
+
+def test_empty_first_stage_escalates_on_score():
+    detector = cascade([], [0.8])
+    assert detector.detectInImage("image.jpg", show=False, event_score=10)[2] == []
+    assert detector.detectInImage("image.jpg", show=False, event_score=60)[2] == [0.8]
+
+
+def test_threshold_applies_to_first_stage():
+    # The first stage decides on the 0.9 detection, but the one below the threshold is dropped
+    detector = cascade([0.9, 0.2], [0.6], threshold=0.95)
+    _, classes, confidences = detector.detectInImage("image.jpg", show=False)
+    assert confidences == []
+    _, classes, confidences = detector.detectInVideo("video.mp4", show=False)
+    assert confidences == []
+    detector = cascade([0.9, 0.2], [0.6])
+    assert detector.detectInVideo("video.mp4", show=False)[2] == [0.9]
+
+
+def test_hog_detections_escalate():
+    hog = DetectorHOG("test")
+    detector = cascade([], [], first_stage=hog)
+    # HOG reports a made-up confidence of 1 for every detection
+    assert detector.needSecondStage([1.0], 0)
+    assert not detector.needSecondStage([], 0)
+    assert detector.needSecondStage([], 60)
@@ -0,0 +1,179 @@
+import json
+import cv2
+import numpy as np
+import pytest
+import zm_trace
+from zm_notification import NotificationCoalescer
+from zm_trace import EventTrace, TraceLog
+
+
+class FakeNotifier:
+    '''Records notifications instead of sending them'''
+    def __init__(self, attachment):
+        self.attachment = attachment
+        self.sent = []
+
+    def sendNotifications(self, msg, email_addresses=[], pushover_data=None):
+        with open(self.attachment, "rb") as f:
+            self.sent.append((msg, f.read()))
+        zm_trace.mark("email_sent", address="a@localhost", ok=True)
+        return True
+
+
+@pytest.fixture
+def notifier(tmp_path):
+    return FakeNotifier(str(tmp_path / "attachment.jpg"))
+
+
+def frame(value):
+    return np.full((8, 8, 3), 60*value, np.uint8)
+
+
+def image_value(image):
+    return round(cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR).mean()/60)
+
+
+def messages(notifier):
+    return [msg for msg, _ in notifier.sent]
+
+
+def test_no_window(notifier):
+    coalescer = NotificationCoalescer(notifier, window=0.)
+    for i in range(3):
+        coalescer.add("Driveway", "Driveway", i, "Event {:d}".format(i), frame(i), 0.5, now=i*0.1)
+    assert messages(notifier) == ["Event 0", "Event 1", "Event 2"]
+    assert coalescer.nextDue() is None
+    assert coalescer.getStats() == {"events": 3, "sent": 3, "waiting": 0}
+
+
+def test_window(notifier):
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=0.)
+    # The first event of a burst is sent right away and the rest when the window ends
+    coalescer.add("Driveway", "Driveway", 1, "Event 1", frame(1), 0.6, now=0.)
+    assert messages(notifier) == ["Event 1"]
+    coalescer.add("Driveway", "Driveway", 2, "Event 2", frame(2), 0.9, now=5.)
+    coalescer.add("Driveway", "Driveway", 3, "Event 3", frame(3), 0.7, now=10.)
+    assert len(notifier.sent) == 1
+    assert coalescer.nextDue() == 30.
+    coalescer.flush(now=29.)
+    assert len(notifier.sent) == 1
+    coalescer.flush(now=30.)
+    assert len(notifier.sent) == 2
+
+    # Merged notifications have the message and image of the most confident detection
+    msg, image = notifier.sent[1]
+    assert msg.startswith("2 events on Driveway (events 2, 3). Most confident:\n")
+    assert msg.endswith("Event 2")
+    assert image_value(image) == 2
+    assert coalescer.nextDue() is None
+    assert coalescer.getStats() == {"events": 3, "sent": 2, "waiting": 0}
+
+    # A new burst starts after the window
+    coalescer.add("Driveway", "Driveway", 4, "Event 4", frame(4), 0.6, now=31.)
+    assert messages(notifier)[-1] == "Event 4"
+
+
+def test_max_delay(notifier):
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=3.)
+    coalescer.add("Driveway", "Driveway", 1, "Event 1", frame(1), 0.6, now=0.)
+    coalescer.add("Driveway", "Driveway", 2, "Event 2", frame(2), 0.9, now=1.)
+    assert notifier.sent == []
+    assert coalescer.nextDue() == 3.
+    coalescer.flush(now=3.)
+    assert messages(notifier) == ["2 events on Driveway (events 1, 2). Most confident:\n" \
+                                  "Event 2"]
+
+    # Later events of the burst wait for the end of the window
+    coalescer.add("Driveway", "Driveway", 3, "Event 3", frame(3), 0.5, now=10.)
+    assert len(notifier.sent) == 1
+    coalescer.flush(now=30.)
+    assert messages(notifier)[-1] == "Event 3"
+
+
+def test_max_delay_limited_to_window(notifier):
+    coalescer = NotificationCoalescer(notifier, window=5., max_delay=60.)
+    coalescer.add("Driveway", "Driveway", 1, "Event 1", frame(1), 0.6, now=0.)
+    assert coalescer.nextDue() == 5.
+
+
+def test_event_after_window_sends_waiting(notifier):
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=0.)
+    coalescer.add("Driveway", "Driveway", 1, "Event 1", frame(1), 0.6, now=0.)
+    coalescer.add("Driveway", "Driveway", 2, "Event 2", frame(2), 0.6, now=20.)
+    # No flush in between, e.g. because the main loop was busy
+    coalescer.add("Driveway", "Driveway", 3, "Event 3", frame(3), 0.6, now=40.)
+    assert messages(notifier) == ["Event 1", "Event 2", "Event 3"]
+
+
+def test_groups(notifier):
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=2.)
+    # Monitors in the same group are merged, and other groups are independent
+    coalescer.add("Front", "Driveway", 1, "Event 1", frame(1), 0.6, now=0.)
+    coalescer.add("Front", "Porch", 2, "Event 2", frame(2), 0.8, now=1.)
+    coalescer.add("Garden", "Garden", 3, "Event 3", frame(3), 0.9, now=1.5)
+    assert coalescer.nextDue() == 2.
+    coalescer.flush(now=2.)
+    assert messages(notifier) == ["2 events on Driveway, Porch (events 1, 2). Most confident:\n" \
+                                  "Event 2"]
+    assert coalescer.nextDue() == 3.5
+    coalescer.flush(now=3.5)
+    assert messages(notifier)[-1] == "Event 3"
+
+
+def test_flush_at_shutdown(notifier):
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=5.)
+    coalescer.add("Front", "Driveway", 1, "Event 1", frame(1), 0.6, now=0.)
+    coalescer.add("Front", "Driveway", 2, "Event 2", frame(2), 0.7, now=1.)
+    coalescer.add("Garden", "Garden", 3, "Event 3", frame(3), 0.9, now=2.)
+    assert notifier.sent == []
+    coalescer.flush(now=2., force=True)
+    assert sorted(messages(notifier)) == \
+           ["2 events on Driveway (events 1, 2). Most confident:\nEvent 2", "Event 3"]
+    assert coalescer.getStats()["waiting"] == 0
+    assert coalescer.nextDue() is None
+
+
+def read_traces(path):
+    with open(path) as f:
+        return {record["event"]: record for record in map(json.loads, f)}
+
+
+def test_traces_of_held_burst(notifier, tmp_path):
+    path = str(tmp_path / "trace.log")
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=3.,
+                                      trace_log=TraceLog(path))
+    traces = {ID: EventTrace("Driveway", ID) for ID in [1, 2]}
+    for ID, trace in traces.items():
+        with trace:
+            coalescer.add("Driveway", "Driveway", ID, "Event {:d}".format(ID), frame(ID), 0.5,
+                          trace, now=ID-1.)
+    with pytest.raises(FileNotFoundError):
+        read_traces(path)
+
+    # Sent from the notify task, outside any event's trace
+    coalescer.flush(now=3.)
+    records = read_traces(path)
+    assert sorted(records.keys()) == [1, 2]
+    for record in records.values():
+        assert {"notification_held", "image_encoded", "email_sent"} <= set(record["phases"])
+        assert "counts" not in record
+
+
+def test_traces_of_burst_sent_by_new_burst(notifier, tmp_path):
+    path = str(tmp_path / "trace.log")
+    coalescer = NotificationCoalescer(notifier, window=30., max_delay=0.,
+                                      trace_log=TraceLog(path))
+    traces = {ID: EventTrace("Driveway", ID) for ID in [1, 2, 3]}
+    for ID, now in [(1, 0.), (2, 5.), (3, 40.)]:
+        with traces[ID]:
+            coalescer.add("Driveway", "Driveway", ID, "Event {:d}".format(ID), frame(ID), 0.5,
+                          traces[ID], now=now)
+
+    # The held event 2 is sent when event 3 starts a new burst. Its sending is recorded on its
+    # own trace, and event 3 only records its own notification.
+    records = read_traces(path)
+    assert sorted(records.keys()) == [1, 2, 3]
+    assert "email_sent" in records[2]["phases"]
+    assert "notification_held" in records[2]["phases"]
+    assert "counts" not in records[3]
+    assert zm_trace.active is None
@@ -0,0 +1,228 @@
+import datetime
+import os
+import sqlite3
+import pytest
+from zm_api import ZMAPI
+from zm_event_db import EventDatabase
+
+# The tables and columns of the ZoneMinder 1.36 schema that matter here
+SCHEMA = """
+CREATE TABLE Storage (Id INTEGER PRIMARY KEY, Path VARCHAR(64) NOT NULL DEFAULT '',
+                      Name VARCHAR(64) NOT NULL DEFAULT '', Type VARCHAR(16) DEFAULT 'local',
+                      Scheme VARCHAR(16) NOT NULL DEFAULT 'Medium');
+CREATE TABLE Events (Id INTEGER PRIMARY KEY, MonitorId INTEGER NOT NULL DEFAULT 0,
+                     StorageId INTEGER NOT NULL DEFAULT 0, Name VARCHAR(64) NOT NULL DEFAULT '',
+                     Cause VARCHAR(32) NOT NULL DEFAULT '', StartDateTime DATETIME,
+                     EndDateTime DATETIME, Width INTEGER NOT NULL DEFAULT 0,
+                     Height INTEGER NOT NULL DEFAULT 0, Length DECIMAL(10,2) NOT NULL DEFAULT 0,
+                     Frames INTEGER, AlarmFrames INTEGER, DefaultVideo VARCHAR(64) NOT NULL
+                     DEFAULT '', TotScore INTEGER NOT NULL DEFAULT 0, AvgScore INTEGER DEFAULT 0,
+                     MaxScore INTEGER DEFAULT 0, MaxScoreFrameId INTEGER DEFAULT NULL,
+                     Archived TINYINT NOT NULL DEFAULT 0, Scheme VARCHAR(16) NOT NULL
+                     DEFAULT 'Medium');
+CREATE TABLE Frames (Id INTEGER PRIMARY KEY, EventId INTEGER NOT NULL DEFAULT 0,
+                     FrameId INTEGER NOT NULL DEFAULT 0, Type VARCHAR(16) NOT NULL
+                     DEFAULT 'Normal', TimeStamp DATETIME, Delta DECIMAL(8,2) NOT NULL
+                     DEFAULT 0, Score SMALLINT NOT NULL DEFAULT 0);
+CREATE INDEX Events_MonitorId_idx ON Events (MonitorId);
+CREATE INDEX Frames_EventId_idx ON Frames (EventId);
+"""
+
+START = datetime.datetime(2024, 5, 1, 12, 30, 15)
+
+
+class Fixture:
+    '''ZoneMinder database in a sqlite file, with helpers to add and finish events the way
+       ZoneMinder does: an event is inserted when it starts and updated with its end time, frame
+       counts, and max score when it ends.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        self.conn.execute("INSERT INTO Storage (Id, Path, Name) VALUES (1, '/data/zm', 'Disk')")
+        self.conn.commit()
+        self.next_id = 1
+
+    def start(self, monitor_id, scheme="Medium", storage_id=1, start=None):
+        ID = self.next_id
+        self.next_id += 1
+        if start is None:
+            start = START + datetime.timedelta(minutes=ID)
+        self.conn.execute("INSERT INTO Events (Id, MonitorId, StorageId, Name, Cause, "
+                          "StartDateTime, Scheme) VALUES (?, ?, ?, ?, 'Motion', ?, ?)",
+                          (ID, monitor_id, storage_id, "Event- {:d}".format(ID),
+                           start.strftime("%Y-%m-%d %H:%M:%S"), scheme))
+        self.conn.commit()
+        return ID
+
+    def finish(self, ID, scores=(0, 12, 40, 7)):
+        for idx, score in enumerate(scores):
+            self.conn.execute("INSERT INTO Frames (EventId, FrameId, Type, Delta, Score) "
+                              "VALUES (?, ?, ?, ?, ?)", (ID, idx+1,
+                              "Alarm" if score > 0 else "Normal", idx*0.2, score))
+        max_score = max(scores)
+        self.conn.execute("UPDATE Events SET EndDateTime = StartDateTime, Frames = ?, "
+                          "AlarmFrames = ?, TotScore = ?, MaxScore = ?, MaxScoreFrameId = ?, "
+                          "DefaultVideo = ? WHERE Id = ?",
+                          (len(scores), sum(1 for s in scores if s > 0), sum(scores), max_score,
+                           scores.index(max_score) + 1, "{:d}-video.mp4".format(ID), ID))
+        self.conn.commit()
+
+    def add(self, monitor_id, **kwargs):
+        ID = self.start(monitor_id, **kwargs)
+        self.finish(ID)
+        return ID
+
+    def fileSystemPath(self, row):
+        '''Event path as the API reports it in FileSystemPath'''
+        start = datetime.datetime.strptime(row["StartDateTime"], "%Y-%m-%d %H:%M:%S")
+        monitor_dir = os.path.join(row["StoragePath"], str(row["MonitorId"]))
+        if row["Scheme"] == "Deep":
+            return os.path.join(monitor_dir, start.strftime("%y/%m/%d/%H/%M/%S"))
+        if row["Scheme"] == "Shallow":
+            return os.path.join(monitor_dir, str(row["Id"]))
+        return os.path.join(monitor_dir, start.strftime("%Y-%m-%d"), str(row["Id"]))
+
+    def apiEvents(self, monitor_id):
+        '''Response of the API events index for a monitor, newest first'''
+        self.conn.row_factory = sqlite3.Row
+        rows = self.conn.execute("SELECT E.*, S.Path AS StoragePath FROM Events E JOIN Storage S "
+                                 "ON S.Id = E.StorageId WHERE MonitorId = ? ORDER BY "
+                                 "StartDateTime DESC", (monitor_id,)).fetchall()
+        self.conn.row_factory = None
+        events = []
+        for row in rows:
+            event = {key: row[key] for key in row.keys()}
+            for key in ["Id", "MonitorId", "MaxScoreFrameId", "MaxScore"]:
+                if event[key] is not None:
+                    event[key] = str(event[key])
+            event["FileSystemPath"] = self.fileSystemPath(row)
+            events.append({"Event": event})
+        return {"events": events}
+
+
+class FakeResponse:
+    ok = True
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+@pytest.fixture
+def zm(tmp_path):
+    fixture = Fixture(str(tmp_path / "zm.db"))
+    yield fixture
+    fixture.conn.close()
+
+
+@pytest.fixture
+def api(zm, monkeypatch):
+    '''ZMAPI answering events requests from the fixture'''
+    zmapi = ZMAPI("http://localhost", "user", "pass")
+    def request(url, params=[], **kwargs):
+        monitor_id = int(url.split("MonitorId:")[1].split(".json")[0])
+        return FakeResponse(zm.apiEvents(monitor_id))
+    monkeypatch.setattr(zmapi, "_makeRequest", request)
+    return zmapi
+
+
+def event_db(zm, history=10):
+    return EventDatabase("sqlite", path=zm.path, events_dir="/var/cache/zoneminder/events",
+                         refresh_interval=0, history=history)
+
+
+def test_same_as_api(zm, api):
+    zm.add(1)
+    zm.add(2)
+    zm.add(1, scheme="Deep")
+    zm.add(1, scheme="Shallow")
+    db = event_db(zm)
+    for monitor_id in [1, 2]:
+        event = db.getMonitorLatestEvent(monitor_id)
+        expected = api.getMonitorLatestEvent(monitor_id)
+        assert event == expected
+        assert [type(value) for value in event.values()] == \
+               [type(value) for value in expected.values()]
+    assert db.getMonitorLatestEvent(1)['path'] == "/data/zm/1/4"
+    assert db.getMonitorLatestEvent(1, 1) == api.getMonitorLatestEvent(1, 1)
+    assert db.getMonitorLatestEvent(1, 1)['path'] == "/data/zm/1/24/05/01/12/33/15"
+    assert db.getMonitorLatestEvent(1, 2)['path'] == "/data/zm/1/2024-05-01/1"
+    db.close()
+
+
+def test_no_events(zm, api):
+    zm.add(2)
+    db = event_db(zm)
+    assert db.getMonitorLatestEvent(1) == \
+           {'id':-1, 'maxscore_frameid':0, 'path':"", 'video_name':"", 'max_score':0}
+    db.close()
+
+
+def test_new_events(zm, api):
+    zm.add(1)
+    db = event_db(zm)
+    assert db.getMonitorLatestEvent(1)['id'] == 1
+    ID = zm.add(1)
+    assert db.getMonitorLatestEvent(1) == api.getMonitorLatestEvent(1)
+    assert db.getMonitorLatestEvent(1)['id'] == ID
+    db.close()
+
+
+def test_in_progress_events(zm, api):
+    zm.add(1)
+    # In progress before the database is first read, and after
+    earlier = zm.start(1)
+    db = event_db(zm)
+    assert db.getMonitorLatestEvent(1)['id'] == 1
+    later = zm.start(1)
+    assert db.getMonitorLatestEvent(1) == api.getMonitorLatestEvent(1)
+    assert db.getMonitorLatestEvent(1)['id'] == 1
+    assert db.getStats()["pending"] == 2
+
+    zm.finish(later, scores=(5, 80))
+    event = db.getMonitorLatestEvent(1)
+    assert event == api.getMonitorLatestEvent(1)
+    assert event['id'] == later
+    assert event['maxscore_frameid'] == 2 and event['max_score'] == 80
+
+    # Events are ordered by id, so one that finishes late still isn't the latest
+    zm.finish(earlier)
+    assert db.getMonitorLatestEvent(1)['id'] == later
+    assert db.getMonitorLatestEvent(1, 1)['id'] == earlier
+    assert db.getStats()["pending"] == 0
+    db.close()
+
+
+def test_history_cutoff(zm, api):
+    ids = [zm.add(1) for _ in range(5)]
+    db = event_db(zm, history=3)
+    assert [db.getMonitorLatestEvent(1, idx)['id'] for idx in range(4)] == \
+           [ids[4], ids[3], ids[2], -1]
+    # New events push the oldest ones out
+    ids.append(zm.add(1))
+    assert [db.getMonitorLatestEvent(1, idx)['id'] for idx in range(4)] == \
+           [ids[5], ids[4], ids[3], -1]
+    db.close()
+
+
+def test_start_time_column(tmp_path):
+    # ZoneMinder before 1.36 names the column StartTime
+    path = str(tmp_path / "zm.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA.replace("StartDateTime", "StartTime"))
+    conn.execute("INSERT INTO Events (Id, MonitorId, StorageId, StartTime, MaxScore, "
+                 "MaxScoreFrameId, Scheme) VALUES (1, 1, 0, '2024-05-01 12:00:00', 9, 3, "
+                 "'Medium')")
+    conn.commit()
+    conn.close()
+    db = EventDatabase("sqlite", path=path, events_dir="/var/cache/zoneminder/events",
+                       refresh_interval=0)
+    assert db.getMonitorLatestEvent(1) == {'id': 1, 'maxscore_frameid': 3,
+           'path': "/var/cache/zoneminder/events/1/2024-05-01/1", 'video_name': "",
+           'max_score': 9}
+    db.close()
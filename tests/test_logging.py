@@ -0,0 +1,36 @@
+import logging
+import logging.handlers
+import threading
+import zm_util
+
+
+def test_debug_after_stop_writes_directly(capsys):
+    zm_util.stop_logging()
+    try:
+        zm_util.debug("late message")
+        zm_util.debug("late warning", "stderr")
+        zm_util.debug("hidden", level=logging.DEBUG)
+        assert zm_util._listener is None
+        out, err = capsys.readouterr()
+        assert out == "late message\n"
+        assert err == "late warning\n"
+    finally:
+        zm_util.setup_logging()
+
+
+def test_lazy_setup_starts_one_listener(monkeypatch):
+    zm_util.stop_logging()
+    monkeypatch.setattr(zm_util, "_stopped", False)
+    started = []
+    start = logging.handlers.QueueListener.start
+    def counting_start(self):
+        started.append(self)
+        start(self)
+    monkeypatch.setattr(logging.handlers.QueueListener, "start", counting_start)
+    threads = [threading.Thread(target=zm_util.debug, args=("message",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(started) == 1
+    assert zm_util._listener is started[0]
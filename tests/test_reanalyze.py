@@ -0,0 +1,65 @@
+import csv
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+# zm_reanalyze is a script without a .py extension
+path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zm_reanalyze")
+loader = importlib.machinery.SourceFileLoader("zm_reanalyze", path)
+spec = importlib.util.spec_from_loader("zm_reanalyze", loader)
+zm_reanalyze = importlib.util.module_from_spec(spec)
+sys.modules["zm_reanalyze"] = zm_reanalyze
+loader.exec_module(zm_reanalyze)
+
+
+def write_results(path, rows, partial=""):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, zm_reanalyze.columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        f.write(partial)
+
+
+def row(event_id, monitor, status="ok"):
+    return {"event_id": event_id, "monitor": monitor, "start_time": "2024-05-01",
+            "max_score": 0, "model": "Darknet", "detect_in": "image", "objclass": "person",
+            "confidence": "0.900", "detections": "person:0.900", "ms": "120", "status": status}
+
+
+def test_checkpoint_complete(tmp_path):
+    output = str(tmp_path / "results.csv")
+    assert zm_reanalyze.read_checkpoint(output) == set()
+    write_results(output, [row(1, "Driveway"), row(2, "Garden")])
+    assert zm_reanalyze.read_checkpoint(output) == {1, 2}
+
+
+def test_checkpoint_retries_failed(tmp_path):
+    output = str(tmp_path / "results.csv")
+    write_results(output, [row(1, "Driveway"), row(2, "Garden", "no_detector"),
+                           row(3, "Garden", "error"), row(3, "Garden")])
+    assert zm_reanalyze.read_checkpoint(output) == {1, 3}
+
+
+def test_checkpoint_partial_row_non_ascii(tmp_path):
+    # Multi-byte characters make character and byte offsets differ
+    output = str(tmp_path / "results.csv")
+    write_results(output, [row(1, "Allée"), row(2, "Haustür vorne")],
+                  partial="3,Einfahrt süd,2024-05-01,0,Dar")
+    assert zm_reanalyze.read_checkpoint(output) == {1, 2}
+    with open(output, newline="", encoding="utf-8") as f:
+        data = f.read()
+    assert data.endswith("Haustür vorne,2024-05-01,0,Darknet,image,person,0.900," \
+                         "person:0.900,120,ok\r\n")
+
+
+def test_disk_events(tmp_path):
+    event_dir = tmp_path / "3" / "2024-05-01" / "12"
+    event_dir.mkdir(parents=True)
+    (event_dir / "12-video.mp4").write_bytes(b"")
+    (tmp_path / "3" / "2024-05-02" / "13").mkdir(parents=True)
+    events = zm_reanalyze.list_disk_events(str(tmp_path), 3, None,
+                                           zm_reanalyze.parse_time("2024-05-01"))
+    assert events == [{'id': 12, 'path': str(event_dir), 'video_name': "12-video.mp4",
+                       'max_score': 0, 'start_time': "2024-05-01"}]
@@ -0,0 +1,182 @@
+import email
+import email.policy
+import socket
+import socketserver
+import threading
+import pytest
+import zm_notification
+from zm_notification import Notification, SMTPTransport
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    '''Local SMTP server that keeps the messages it receives. drop() closes all open
+       connections, like a server dropping idle clients.'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.open = []
+        self.lock = threading.Lock()
+
+    def drop(self):
+        with self.lock:
+            for conn in self.open:
+                conn.shutdown(socket.SHUT_RDWR)
+            self.open = []
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.open.append(self.connection)
+        self.reply("220 localhost test sink")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ")[0].upper()
+            if verb in ["EHLO", "HELO"]:
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(" <>"), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip(" <>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b""
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b".\r\n":
+                        break
+                    data += line[1:] if line.startswith(b"..") else line
+                message = email.message_from_bytes(data, policy=email.policy.default)
+                with server.lock:
+                    server.messages.append((sender, recipients, message))
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+@pytest.fixture
+def sink():
+    server = SMTPSink()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def attachment(tmp_path):
+    path = tmp_path / "attachment.jpg"
+    path.write_bytes(b"\xff\xd8\xff\xe0 not really a jpeg")
+    return str(path)
+
+
+def transport(port):
+    return SMTPTransport("127.0.0.1", port, security="none", sender="zm@localhost",
+                         timeout=5)
+
+
+def test_connection_reused(sink):
+    smtp = transport(sink.server_address[1])
+    notifier = Notification("/nonexistent/message.txt", "/nonexistent/image.jpg", smtp)
+    for i in range(3):
+        message = notifier.buildMessage("Event {:d}".format(i), ["a@localhost"], False)
+        assert smtp.send(message, ["a@localhost"])
+    smtp.close()
+    assert smtp.sent == 3
+    assert smtp.connects == 1
+    assert sink.connections == 1
+    assert [m.get_content().strip() for _, _, m in sink.messages] == \
+           ["Event 0", "Event 1", "Event 2"]
+
+
+def test_reconnect_after_drop(sink):
+    smtp = transport(sink.server_address[1])
+    notifier = Notification("/nonexistent/message.txt", "/nonexistent/image.jpg", smtp)
+    assert smtp.send(notifier.buildMessage("first", ["a@localhost"], False), ["a@localhost"])
+    sink.drop()
+    # The dropped connection is only noticed when sending. The message is resent once over a
+    # new connection.
+    assert smtp.send(notifier.buildMessage("second", ["a@localhost"], False), ["a@localhost"])
+    smtp.close()
+    assert smtp.connects == 2
+    assert [m.get_content().strip() for _, _, m in sink.messages] == ["first", "second"]
+
+
+def test_reconnect_when_idle(sink):
+    smtp = transport(sink.server_address[1])
+    smtp.idle_timeout = 0
+    notifier = Notification("/nonexistent/message.txt", "/nonexistent/image.jpg", smtp)
+    for text in ["first", "second"]:
+        assert smtp.send(notifier.buildMessage(text, ["a@localhost"], False), ["a@localhost"])
+    smtp.close()
+    assert smtp.connects == 2
+
+
+def test_image_split(sink, attachment, monkeypatch):
+    mutt_calls = []
+    monkeypatch.setattr(zm_notification.subprocess, "run",
+                        lambda *args, **kwargs: mutt_calls.append(args))
+    smtp = transport(sink.server_address[1])
+    notifier = Notification("/nonexistent/message.txt", attachment, smtp)
+    addresses = [{"address": "a@localhost", "image": True},
+                 {"address": "b@localhost", "image": False},
+                 {"address": "c@localhost", "image": True}]
+    assert notifier.sendNotifications("Motion detected", addresses)
+    smtp.close()
+    assert mutt_calls == []
+    assert sink.connections == 1
+    assert len(sink.messages) == 2
+
+    # One message with the image to everyone who wants it, and one without to the rest
+    with_image, without_image = sink.messages
+    assert with_image[0] == "zm@localhost"
+    assert sorted(with_image[1]) == ["a@localhost", "c@localhost"]
+    attachments = list(with_image[2].iter_attachments())
+    assert len(attachments) == 1
+    assert attachments[0].get_content_type() == "image/jpeg"
+    assert attachments[0].get_content() == open(attachment, "rb").read()
+    assert without_image[1] == ["b@localhost"]
+    assert list(without_image[2].iter_attachments()) == []
+
+
+def test_mutt_fallback(tmp_path, attachment, monkeypatch):
+    # Find a port nothing listens on
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    class Result:
+        returncode = 0
+    mutt_calls = []
+    def run(args, stdin=None):
+        mutt_calls.append((args, stdin.read()))
+        return Result()
+    monkeypatch.setattr(zm_notification.subprocess, "run", run)
+
+    smtp = transport(port)
+    notifier = Notification(str(tmp_path / "message.txt"), attachment, smtp)
+    addresses = [{"address": "a@localhost", "image": True},
+                 {"address": "b@localhost", "image": False}]
+    assert notifier.sendNotifications("Motion detected", addresses)
+    assert smtp.sent == 0
+    assert [(args[-1], "-a" in args) for args, _ in mutt_calls] == \
+           [("a@localhost", True), ("b@localhost", False)]
@@ -0,0 +1,164 @@
+import time
+import cv2
+import numpy as np
+import pytest
+from zm_monitor import Monitor
+from zm_object_detection import DetectorCascade
+from zm_stream import StreamCapture
+
+NFRAMES = 10
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    '''Writes a short MJPEG video whose frame i has brightness 20*i'''
+    path = str(tmp_path / "stream.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for i in range(NFRAMES):
+        writer.write(np.full((48, 64, 3), 20*i, np.uint8))
+    writer.release()
+    return path
+
+
+def wait_for(condition, timeout=5.):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_latest_frame_only(video_file):
+    # The whole file is read long before the consumer asks, so only the last frame is left
+    stream = StreamCapture("test", video_file, reconnect_delay=10, max_frame_age=10)
+    stream.start()
+    try:
+        assert wait_for(lambda: stream.frames_read == NFRAMES)
+        frame = stream.getLatestFrame()
+        assert frame is not None
+        assert abs(float(frame.mean()) - 20*(NFRAMES-1)) < 5
+        # A frame is never returned twice
+        assert stream.getLatestFrame() is None
+    finally:
+        stream.stop()
+    assert stream.thread is None
+
+
+def test_stale_frame_dropped(video_file):
+    stream = StreamCapture("test", video_file, reconnect_delay=10, max_frame_age=0.2)
+    stream.start()
+    try:
+        assert wait_for(lambda: stream.frames_read == NFRAMES)
+        time.sleep(0.3)
+        assert stream.getLatestFrame() is None
+    finally:
+        stream.stop()
+
+
+def test_reconnect(video_file):
+    # The end of the file looks like a dropped stream. The url function is called on every
+    # connect.
+    urls = []
+    def url():
+        urls.append(video_file)
+        return video_file
+    stream = StreamCapture("test", url, reconnect_delay=0.05)
+    stream.start()
+    try:
+        assert wait_for(lambda: stream.reconnects >= 2)
+    finally:
+        stream.stop()
+    assert len(urls) >= 3
+    assert stream.frames_read >= 2*NFRAMES
+
+
+def test_unopenable_stream_retried(tmp_path):
+    stream = StreamCapture("test", str(tmp_path / "missing.avi"), reconnect_delay=0.05)
+    stream.start()
+    try:
+        time.sleep(0.2)
+        assert stream.frames_read == 0
+        assert stream.getLatestFrame() is None
+    finally:
+        stream.stop()
+
+
+class FakeStream:
+    '''Returns a new frame on every call'''
+    def getLatestFrame(self):
+        return np.zeros((48, 64, 3), np.uint8)
+
+
+class FakeDetector:
+    '''Frame detector that reports the given confidences for class 0'''
+    def __init__(self, confidences, conf_threshold=0.5, model_name="Fake"):
+        self.confidences = confidences
+        self.conf_threshold = conf_threshold
+        self.model_name = model_name
+        self.classes = ["person"]
+        self.frames = 0
+
+    def detectInFrame(self, frame, annotate_name=True):
+        self.frames += 1
+        if len(self.confidences) == 0:
+            return [], [], [], None
+        return [0]*len(self.confidences), list(self.confidences), [], frame
+
+
+def cascade(first_stage, second_stage):
+    return DetectorCascade("test", first_stage, second_stage, uncertain_low=0.3,
+                           uncertain_high=0.7, escalate_score=50)
+
+
+class FakeAPI:
+    def getMonitorLatestEvent(self, monitorID, idx=0):
+        return {'id':-1, 'maxscore_frameid':0, 'path':"", 'video_name':"", 'max_score':0}
+
+    def getCachedMonitorStatus(self, monitorID):
+        return True
+
+
+def stream_monitor(detector, cooldown):
+    monitor = Monitor("test", 1, FakeAPI(), detector, detect_source="stream",
+                      stream_url="unused", stream_cooldown=cooldown)
+    monitor.stream = FakeStream()
+    return monitor
+
+
+def test_stream_cooldown():
+    monitor = stream_monitor(FakeDetector([0.9]), cooldown=0.2)
+    frame, objclass, confidence = monitor.detectInStream()
+    assert frame is not None and objclass == "person" and confidence == 0.9
+    # An object that stays in view is only reported once, and keeps extending the cooldown
+    for _ in range(3):
+        time.sleep(0.1)
+        assert monitor.detectInStream()[0] is None
+    time.sleep(0.25)
+    assert monitor.detectInStream()[0] is not None
+
+
+def test_stream_below_threshold():
+    monitor = stream_monitor(FakeDetector([0.4]), cooldown=0)
+    assert monitor.detectInStream()[0] is None
+
+
+def test_stream_cascade_escalates_uncertain():
+    first_stage = FakeDetector([0.4], conf_threshold=0.3)
+    second_stage = FakeDetector([], conf_threshold=0.5)
+    monitor = stream_monitor(cascade(first_stage, second_stage), cooldown=0)
+    # The second stage finds nothing, so the uncertain first stage detection is not reported
+    assert monitor.detectInStream()[0] is None
+    assert second_stage.frames == 1
+
+    second_stage.confidences = [0.8]
+    frame, objclass, confidence = monitor.detectInStream()
+    assert frame is not None and confidence == 0.8
+
+
+def test_stream_cascade_confident_first_stage():
+    first_stage = FakeDetector([0.9], conf_threshold=0.3)
+    second_stage = FakeDetector([0.8], conf_threshold=0.5)
+    monitor = stream_monitor(cascade(first_stage, second_stage), cooldown=0)
+    assert monitor.detectInStream()[2] == 0.9
+    assert second_stage.frames == 0
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+import zm_object_detection
+from zm_object_detection import VideoDecoder
+
+NFRAMES = 5
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    path = str(tmp_path / "event.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for i in range(NFRAMES):
+        writer.write(np.full((48, 64, 3), 20*i, np.uint8))
+    writer.release()
+    return path
+
+
+def test_decode_all_frames(video_file):
+    decoder = VideoDecoder(video_file, prefetch=2, max_width=32)
+    assert decoder.open()
+    frames = []
+    success, frame = decoder.read()
+    while success:
+        frames.append(frame)
+        success, frame = decoder.read()
+    # The end marker stays for further reads
+    assert decoder.read() == (False, None)
+    decoder.release()
+    assert len(frames) == NFRAMES
+    assert frames[0].shape == (24, 32, 3)
+
+
+def test_decode_error_ends_video(video_file, monkeypatch):
+    def fail(*args, **kwargs):
+        raise cv2.error("resize failed")
+    monkeypatch.setattr(zm_object_detection.cv2, "resize", fail)
+    decoder = VideoDecoder(video_file, max_width=32)
+    assert decoder.open()
+    # read must not block forever when the decoder thread fails
+    decoder.thread.join(5)
+    assert not decoder.thread.is_alive()
+    assert decoder.read() == (False, None)
+    decoder.release()
@@ -1,6 +1,9 @@
 # Some portions of this class influenced by the pyzm project, so thanks for that.
 
+import logging
+import random
 import requests
+import threading
 import time
 import zm_util
 from json.decoder import JSONDecodeError
@@ -9,15 +12,21 @@ from json.decoder import JSONDecodeError
 #import urllib3
 #urllib3.disable_warnings()
 
+debug = zm_util.module_debug(__name__)
+
 class ZMAPI:
     def __init__(self, localserver, username, password, webserver=None, verify_ssl=True,
-                 debug_level=1):
+                 debug_level=1, cache_ttl=None):
+        '''cache_ttl is an optional dict of time-to-live in seconds for cached responses of read
+           endpoints, with keys 'daemonCheck', 'states', and 'monitors'. A TTL of 0 disables
+           caching for that endpoint.'''
         self.username = username
         self.password = password
         self.verify = verify_ssl
         self.debug_level = debug_level
 
         self.apipath = localserver + '/zm/api'
+        self.cgipath = localserver + '/zm/cgi-bin'
         if webserver is None:
             self.webpath = localserver + '/zm/index.php'
         else:
@@ -25,17 +34,56 @@ class ZMAPI:
 
         self.access_token = None
         self.access_timeout = 0
+        self.access_lifetime = 0
         self.refresh_token = None
         self.refresh_timeout = 0
-
-    def _needAccess(self, access_buffer=300):
+        self.refresh_lifetime = 0
+
+        # Background token refresher. Tokens are renewed ahead of expiry by up to refresh_jitter
+        # extra seconds so that requests never have to wait on a login.
+        self.token_lock = threading.RLock()
+        self.refresher = None
+        self.refresher_stop = threading.Event()
+        self.refresh_jitter = 60
+        self.refresh_retry = 30
+
+        # Response cache for read endpoints. Each entry is keyed by endpoint and url and stores
+        # the response along with its expiry time.
+        self.cache_ttl = {'daemonCheck': 10, 'states': 300, 'monitors': 10}
+        if cache_ttl is not None:
+            self.cache_ttl.update(cache_ttl)
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_revalidations = 0
+
+        # Snapshot of monitor capture statuses from the last monitors.json request
+        self.monitor_status = {}
+        self.monitor_status_time = 0
+
+    def _renewMargins(self):
+        '''Returns how many seconds before expiry the access and refresh tokens are renewed: 300
+           and 600 s, or a quarter of the token lifetime for tokens that live shorter than that'''
+        access_margin = 300
+        if self.access_lifetime > 0:
+            access_margin = min(access_margin, self.access_lifetime/4)
+        refresh_margin = 600
+        if self.refresh_lifetime > 0:
+            refresh_margin = min(refresh_margin, self.refresh_lifetime/4)
+        return access_margin, refresh_margin
+
+    def _needAccess(self, access_buffer=None):
         '''Checks if we need a new access token (soon or already)'''
-        if self.access_token is None or self._access_timeout <= time.time()+access_buffer:
+        if access_buffer is None:
+            access_buffer = self._renewMargins()[0]
+        if self.access_token is None or self.access_timeout <= time.time()+access_buffer:
             return True
         return False
 
-    def _needRefresh(self, refresh_buffer=600):
+    def _needRefresh(self, refresh_buffer=None):
         '''Checks if we need a new refresh token (soon or already)'''
+        if refresh_buffer is None:
+            refresh_buffer = self._renewMargins()[1]
 
         if self.refresh_token is None or self.refresh_timeout <= time.time()+refresh_buffer:
             return True
@@ -44,29 +92,82 @@ class ZMAPI:
     def _refreshTokens(self):
         '''Refreshes tokens if needed'''
 
-        if self._needRefresh():
-            # Get new tokens via username and password if the refresh token has expired
-            check = self.login(method='password')
-        else:
-            # Get a new access token if needed. Otherwise take no action.
-            if self._needAccess():
-                check = self.login(method='refresh_token')
+        check = True
+        with self.token_lock:
+            if self._needRefresh():
+                # Get new tokens via username and password if the refresh token has expired
+                check = self.login(method='password')
+            else:
+                # Get a new access token if needed. Otherwise take no action.
+                if self._needAccess():
+                    check = self.login(method='refresh_token')
         return check
 
-    def _makeRequest(self, url, params=[], method="get", post_data=None):
+    def _tokenRefreshLoop(self):
+        '''Background thread that renews tokens ahead of expiry'''
+        while True:
+            # Wake up when either token is about to need renewal, with some random jitter so that
+            # several instances don't all log in at once. Margins and jitter are scaled down for
+            # short-lived tokens, and the wait is never shorter than a quarter of the access token
+            # lifetime (at most refresh_retry), so the server is never hammered with logins.
+            access_margin, refresh_margin = self._renewMargins()
+            jitter = min(self.refresh_jitter, access_margin, refresh_margin)
+            renew_time = min(self.access_timeout - access_margin,
+                             self.refresh_timeout - refresh_margin)
+            min_wait = min(self.refresh_retry, self.access_lifetime/4)
+            wait = max(renew_time - time.time() - random.uniform(0, jitter), min_wait)
+            if self.refresher_stop.wait(wait):
+                break
+            with self.token_lock:
+                if self._needAccess(access_margin+jitter) or \
+                   self._needRefresh(refresh_margin+jitter):
+                    if self._needRefresh(refresh_margin+jitter):
+                        check = self.login(method='password')
+                    else:
+                        check = self.login(method='refresh_token')
+                    if not check:
+                        self.debug(1, "Background token refresh failed. Retrying in {:d} s."\
+                                   .format(self.refresh_retry), "stderr")
+                        if self.refresher_stop.wait(self.refresh_retry):
+                            break
+
+    def startTokenRefresher(self):
+        '''Starts renewing tokens in a background thread. Call after a successful login.'''
+        if self.refresher is not None and self.refresher.is_alive():
+            return
+        self.refresher_stop.clear()
+        self.refresher = threading.Thread(target=self._tokenRefreshLoop, name="zm_api_tokens",
+                                          daemon=True)
+        self.refresher.start()
+
+    def stopTokenRefresher(self):
+        '''Stops the background token refresher'''
+        if self.refresher is None:
+            return
+        self.refresher_stop.set()
+        self.refresher.join()
+        self.refresher = None
+
+    def _makeRequest(self, url, params=[], method="get", post_data=None, headers=None,
+                     retry_auth=True):
         '''Makes a request to the API, appending access token, and returns response.
            params is a list of options to be appended at the end of the url (other
-           than the access token). Automatically refreshes tokens if required.
+           than the access token). Refreshes tokens inline if required and the background
+           refresher is not running. A 401 response is retried once after logging in again.
            method: 'get' or 'post'
-           post_data: optional dict of data to go along with a post request'''
+           post_data: optional dict of data to go along with a post request
+           headers: optional dict of extra request headers
+           retry_auth: whether to retry once on a 401 response'''
 
         # Initialize r as bad request so calling method can catch it on error
         r = requests.Response()
         r.status_code = 400
 
-        # Refresh tokens if needed
-        if not self._refreshTokens():
-            return r
+        # Refresh tokens if needed. With the background refresher running, this only happens if
+        # the access token has actually expired.
+        if self.refresher is None or self._needAccess(access_buffer=0):
+            if not self._refreshTokens():
+                return r
 
         # Put together the url
         access_url = url + '?token={:s}'.format(self.access_token)
@@ -76,51 +177,113 @@ class ZMAPI:
         # Make the request and return the response
         if method == 'get':
             try:
-                r = requests.get(access_url, verify=self.verify)
+                r = requests.get(access_url, headers=headers, verify=self.verify)
             except requests.exceptions.ConnectionError:
                 self.debug(1, "Get request failed due to connection error.", "stderr")
         elif method == 'post':
             try:
-                r = requests.post(access_url, data=post_data, verify=self.verify)
+                r = requests.post(access_url, data=post_data, headers=headers, verify=self.verify)
             except requests.exceptions.ConnectionError:
                 self.debug(1, "Post request failed due to connection error.", "stderr")
+
+        # Token was rejected. Log in again and retry once.
+        if r.status_code == 401 and retry_auth:
+            self.debug(1, "Request unauthorized. Logging in again and retrying.", "stderr")
+            with self.token_lock:
+                check = self.login(method='password')
+            if check:
+                return self._makeRequest(url, params, method, post_data, headers, False)
+        return r
+
+    def _cachedRequest(self, endpoint, url, params=[]):
+        '''Makes a get request through the response cache. Returns the cached response if it has
+           not expired. Expired responses are revalidated with a conditional request if the server
+           provided an ETag or Last-Modified header.'''
+        ttl = self.cache_ttl.get(endpoint, 0)
+        if ttl <= 0:
+            return self._makeRequest(url, params)
+
+        key = (endpoint, url, tuple(params))
+        entry = self.cache.get(key)
+        now = time.time()
+        if entry is not None and entry['expires'] > now:
+            self.cache_hits += 1
+            return entry['response']
+
+        # Conditional request if the cached response can be revalidated
+        headers = {}
+        if entry is not None:
+            etag = entry['response'].headers.get('ETag')
+            last_modified = entry['response'].headers.get('Last-Modified')
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        r = self._makeRequest(url, params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            self.cache_revalidations += 1
+            entry['expires'] = now + ttl
+            return entry['response']
+
+        self.cache_misses += 1
+        if r.ok:
+            self.cache[key] = {'response': r, 'expires': now + ttl}
+        else:
+            self.cache.pop(key, None)
         return r
 
-    def debug(self, level, message, pipename='stdout'):
+    def invalidateCache(self, endpoint=None):
+        '''Removes cached responses for the given endpoint, or all cached responses'''
+        if endpoint is None:
+            self.cache = {}
+        else:
+            self.cache = {key: entry for key, entry in self.cache.items() if key[0] != endpoint}
+
+    def getCacheStats(self):
+        '''Returns a dict of response cache statistics'''
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'revalidations': self.cache_revalidations, 'entries': len(self.cache)}
+
+    def debug(self, level, message, pipename='stdout', log_level=None):
         if level >= self.debug_level:
-            zm_util.debug("zm_api: " + message, pipename)
+            debug("zm_api: " + message, pipename, log_level)
 
     def login(self, method='password'):
         '''Performs login and saves access and refresh tokens. Returns True if successful
            and False if not.'''
 
         login_url = self.apipath + '/host/login.json'
-        if method == 'password' or self._needRefresh():
-            login_data = {'user': self.username, 'pass': self.password}
-        else:
-            login_data = {'token': self.refresh_token}
-        try:
-            r = requests.post(url=login_url, data=login_data, verify=self.verify)
-            if r.ok:
-                try:
-                    rj = r.json()
-                except JSONDecodeError:
-                    self.debug(1, "Login failed due to error decoding response.", "stderr")
-                    return False
-                self.access_token = rj['access_token']
-                self.access_timeout = float(rj['access_token_expires']) + time.time()
-                self.refresh_token = rj['refresh_token']
-                self.refresh_token_timeout = float(rj['refresh_token_expires']) + time.time()
-                api_version = rj['apiversion']
-                if api_version != '2.0':
-                    self.debug(1, "API version 2.0 required.", "stderr")
-                    return False
+        with self.token_lock:
+            if method == 'password' or self._needRefresh():
+                login_data = {'user': self.username, 'pass': self.password}
             else:
-                self.debug(1, "Login failed with status {:d}.".format(r.status_code), "stderr")
+                login_data = {'token': self.refresh_token}
+            try:
+                r = requests.post(url=login_url, data=login_data, verify=self.verify)
+                if r.ok:
+                    try:
+                        rj = r.json()
+                    except JSONDecodeError:
+                        self.debug(1, "Login failed due to error decoding response.", "stderr")
+                        return False
+                    self.access_token = rj['access_token']
+                    self.access_lifetime = float(rj['access_token_expires'])
+                    self.access_timeout = self.access_lifetime + time.time()
+                    # Logging in with a refresh token only returns a new access token
+                    if 'refresh_token' in rj:
+                        self.refresh_token = rj['refresh_token']
+                        self.refresh_lifetime = float(rj['refresh_token_expires'])
+                        self.refresh_timeout = self.refresh_lifetime + time.time()
+                    api_version = rj.get('apiversion', '2.0')
+                    if api_version != '2.0':
+                        self.debug(1, "API version 2.0 required.", "stderr")
+                        return False
+                else:
+                    self.debug(1, "Login failed with status {:d}.".format(r.status_code), "stderr")
+                    return False
+            except requests.exceptions.ConnectionError:
+                self.debug(1, "Login failed due to connection error.", "stderr")
                 return False
-        except requests.exceptions.ConnectionError:
-            self.debug(1, "Login failed due to connection error.", "stderr")
-            return False
 
         return True
 
@@ -128,6 +291,7 @@ class ZMAPI:
         '''Logs out of the API and returns True if successful, False if not'''
 
         logout_url = self.apipath + '/host/logout.json'
+        self.stopTokenRefresher()
         r = self._makeRequest(logout_url)
         return r.ok
 
@@ -135,7 +299,7 @@ class ZMAPI:
         '''Returns True if ZoneMinder is running, False if not or on error'''
 
         daemon_url = self.apipath + '/host/daemonCheck.json'
-        r = self._makeRequest(daemon_url)
+        r = self._cachedRequest('daemonCheck', daemon_url)
         if r.ok:
             status = int(r.json()['result'])
             return status == 1
@@ -157,16 +321,62 @@ class ZMAPI:
             self.debug(1, "Connection error in getMonitorDaemonStatus", "stderr")
             return False
 
+    def _parseMonitorStatus(self, item):
+        '''Returns True/False capture status of a monitor from its monitors.json item, or None if
+           the Monitor_Status fields are not available (ZoneMinder older than 1.34)'''
+        try:
+            status = item['Monitor_Status']['Status']
+        except (KeyError, TypeError):
+            return None
+        if status is None:
+            return None
+        return status in ['Running', 'Connected']
+
+    def _requestMonitors(self):
+        '''Requests monitors.json and updates the monitor status snapshot. Returns the list of
+           monitor items, or None on error.'''
+        monitors_url = self.apipath + '/monitors.json'
+        r = self._cachedRequest('monitors', monitors_url)
+        if not r.ok:
+            return None
+        items = r.json()['monitors']
+        snapshot = {}
+        for item in items:
+            try:
+                monitorID = int(item['Monitor']['Id'])
+            except TypeError:
+                continue
+            status = self._parseMonitorStatus(item)
+            if status is not None:
+                snapshot[monitorID] = status
+        self.monitor_status = snapshot
+        self.monitor_status_time = time.time()
+        return items
+
+    def getMonitorsStatus(self):
+        '''Gets the capture status of all monitors in one request. Returns a dict of
+           {monitor id: True/False} and saves it as the current snapshot. Monitors without
+           Monitor_Status data are not included. Dict will be empty on error.'''
+        if self._requestMonitors() is None:
+            self.debug(1, "Connection error in getMonitorsStatus", "stderr")
+            self.monitor_status = {}
+        return self.monitor_status
+
+    def getCachedMonitorStatus(self, monitorID):
+        '''Returns True if a monitor is active according to the last status snapshot. Falls back
+           to getMonitorDaemonStatus if the monitor is not in the snapshot.'''
+        if monitorID in self.monitor_status:
+            return self.monitor_status[monitorID]
+        return self.getMonitorDaemonStatus(monitorID)
+
     def getMonitors(self, active_only=False):
         '''Returns a list of monitor ids and names, optionally only the monitors
            that are active. List will be emtpy if a connection error occurs.'''
 
-        monitors_url = self.apipath + '/monitors.json'
-        r = self._makeRequest(monitors_url)
         monitors = []
-        if r.ok:
-            rj = r.json()
-            for item in rj['monitors']:
+        items = self._requestMonitors()
+        if items is not None:
+            for item in items:
                 monitor = {}
                 try:
                     monitor['id'] = int(item['Monitor']['Id'])
@@ -175,14 +385,15 @@ class ZMAPI:
                     self.debug(1, "No data available for monitor. Skipping.")
                     continue
                 if active_only:
-                    if self.getMonitorDaemonStatus(monitor['id']):
+                    if self.getCachedMonitorStatus(monitor['id']):
                         monitors.append(monitor)
                         self.debug(1, "Appended monitor {:d}: {:s}"\
-                                   .format(monitor['id'], monitor['name']))
+                                   .format(monitor['id'], monitor['name']),
+                                   log_level=logging.DEBUG)
                 else:
                     monitors.append(monitor)
                     self.debug(1, "Appended monitor {:d}: {:s}"\
-                               .format(monitor['id'], monitor['name']))
+                               .format(monitor['id'], monitor['name']), log_level=logging.DEBUG)
         else:
             self.debug(1, "Connection error in getMonitors", "stderr")
 
@@ -194,6 +405,7 @@ class ZMAPI:
            res['maxscore_frameid']: frameid of maxscore (0 by default)
            res['path']: filesystem path of the event on the server ("" by default)
            res['video_name']: file name of the video ("" by default)
+           res['max_score']: max alarm score of the event (0 by default)
            The input idx is optional and defaults to 0, which means it returns the latest event
            available. Increase the index to return an earlier event.
 
@@ -209,7 +421,7 @@ class ZMAPI:
            documentation. However, due to the way the API sorts events, the first result on the
            first page will be the latest event for the monitor.'''
 
-        res = {'id':-1, 'maxscore_frameid':0, 'path':"", 'video_name':""}
+        res = {'id':-1, 'maxscore_frameid':0, 'path':"", 'video_name':"", 'max_score':0}
 
         # Get the list of events for this monitor in descending order based on StartTime
         monitor_url = self.apipath + '/events/index/MonitorId:{:d}.json'.format(monitorID)
@@ -231,12 +443,61 @@ class ZMAPI:
                 res['maxscore_frameid'] = int(maxscoreid)
                 res['path'] = event['Event']['FileSystemPath']
                 res['video_name'] = event['Event']['DefaultVideo']
+                if event['Event']['MaxScore'] is not None:
+                    res['max_score'] = int(event['Event']['MaxScore'])
             else:
                 # Return the next event instead
                 return self.getMonitorLatestEvent(monitorID, idx+1)
 
         return res
 
+    def getMonitorEvents(self, monitorID, start=None, end=None):
+        '''Returns a list of the finished events of a monitor, oldest first, optionally only
+           those that started between the datetimes start and end. Each item has the same keys
+           as the result of getMonitorLatestEvent, plus item['start_time']: the start time string
+           from the API. List will be incomplete if a connection error occurs.'''
+
+        events = []
+        monitor_url = self.apipath + '/events/index/MonitorId:{:d}'.format(monitorID)
+        if start is not None:
+            monitor_url += '/StartTime >=:' + start.strftime("%Y-%m-%d %H:%M:%S")
+        if end is not None:
+            monitor_url += '/StartTime <=:' + end.strftime("%Y-%m-%d %H:%M:%S")
+        monitor_url += '.json'
+
+        # Loop over all pages of results
+        page = 1
+        npages = 1
+        while page <= npages:
+            r = self._makeRequest(monitor_url, params=['page={:d}'.format(page), 'sort=StartTime',
+                                                       'direction=asc'])
+            if not r.ok:
+                self.debug(1, "Error getting events in getMonitorEvents", "stderr")
+                break
+            rj = r.json()
+            npages = rj['pagination']['pageCount']
+            for event in rj['events']:
+                # Events without a max score frame are still in progress, or ZoneMinder stopped
+                # while they were
+                if event['Event']['MaxScoreFrameId'] is None:
+                    continue
+                max_score = event['Event']['MaxScore']
+                events.append({'id': int(event['Event']['Id']),
+                               'maxscore_frameid': int(event['Event']['MaxScoreFrameId']),
+                               'path': event['Event']['FileSystemPath'],
+                               'video_name': event['Event']['DefaultVideo'],
+                               'max_score': int(max_score) if max_score is not None else 0,
+                               'start_time': event['Event']['StartTime']})
+            page += 1
+
+        return events
+
+    def getStreamURL(self, monitorID, maxfps=5):
+        '''Returns url for the MJPEG live stream of a monitor from the local server, including the
+           current access token'''
+        return self.cgipath + "/nph-zms?mode=jpeg&monitor={:d}&scale=100&maxfps={:d}&token={:s}"\
+                              .format(monitorID, maxfps, self.access_token)
+
     def getEventURL(self, eventid):
         '''Returns url for the event specified by the given eventid'''
         return self.webpath + "?view=event&eid={:d}".format(eventid)
@@ -253,7 +514,7 @@ class ZMAPI:
 
         runstates = []
         stateurl = self.apipath + "/states.json"
-        r = self._makeRequest(stateurl)
+        r = self._cachedRequest('states', stateurl)
         if not r.ok:
             self.debug(1, "Error getting run states", "stderr")
             return runstates
@@ -266,9 +527,18 @@ class ZMAPI:
                               'active': statedict['IsActive']==1})
         return runstates
 
+    def getActiveRunState(self):
+        '''Returns the name of the active run state, or None if there is none or on error'''
+        for runstate in self.getRunStates():
+            if runstate['active']:
+                return runstate['name']
+        return None
+
     def changeRunState(self, runstate_name):
-        '''Changes run state. Returns True on success or False on error.'''
+        '''Changes run state. Returns True on success or False on error. Cached responses are
+           invalidated since the run state, daemon status, and monitors may all change.'''
 
         stateurl = self.apipath + "/states/change/{:s}.json".format(runstate_name)
         r = self._makeRequest(stateurl, method="post")
+        self.invalidateCache()
         return r.ok
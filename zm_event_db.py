@@ -0,0 +1,235 @@
+import datetime
+import os
+import queue
+import sqlite3
+import time
+import zm_util
+
+debug = zm_util.module_debug(__name__)
+
+class ConnectionPool:
+    '''Keeps up to size open database connections for reuse. Connections are created on demand
+       by connect(), and connections that had an error are discarded instead of returned.'''
+
+    def __init__(self, connect, size=2):
+        self.connect = connect
+        self.idle = queue.LifoQueue(maxsize=max(size, 1))
+
+    def get(self):
+        '''Returns an idle connection, or a new one if there is none'''
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def put(self, conn):
+        '''Returns a connection to the pool, closing it if the pool is full'''
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def closeAll(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class EventDatabase:
+    '''Finds events by reading the ZoneMinder database directly instead of through the API, which
+       is much cheaper for both sides. Requires ZoneMinder 1.32 or later. All monitors share one
+       query for new events (Id greater than the last one seen, an index range scan on the
+       primary key), run at most every refresh_interval seconds. The latest history finished
+       events of each monitor are kept in memory, and getMonitorLatestEvent returns them in the
+       same form as ZMAPI.getMonitorLatestEvent, so it can be used as a Monitor's event source.
+       driver is "mysql" (requires the pymysql module) or "sqlite" (a database file with the
+       same schema, opened read-only from path). Not thread safe.'''
+
+    def __init__(self, driver="mysql", host="localhost", port=3306, user="zmuser",
+                 password="zmpass", database="zm", path="",
+                 events_dir="/var/cache/zoneminder/events", pool_size=2, refresh_interval=0.5,
+                 history=10):
+        self.driver = driver
+        self.events_dir = events_dir
+        self.refresh_interval = refresh_interval
+        self.history = history
+        if driver == "sqlite":
+            self.placeholder = "?"
+            self.driver_errors = (sqlite3.Error,)
+            connect = lambda: sqlite3.connect("file:{:s}?mode=ro".format(path), uri=True)
+        else:
+            import pymysql
+            self.placeholder = "%s"
+            self.driver_errors = (pymysql.Error,)
+            # Autocommit so that every query sees events committed since the last one
+            connect = lambda: pymysql.connect(host=host, port=port, user=user,
+                                              password=password, database=database,
+                                              autocommit=True,
+                                              init_command="SET SESSION TRANSACTION READ ONLY")
+        self.pool = ConnectionPool(connect, pool_size)
+
+        # Column names of the last query, and the name of the start time column, which differs
+        # between ZoneMinder versions
+        self.last_columns = []
+        self.start_column = None
+
+        # Id of the newest event seen, ids of events seen in progress -> time first seen,
+        # monitor id -> finished events, newest first, and monitors whose earlier events were read
+        self.last_seen = None
+        self.pending = {}
+        self.pending_timeout = 3600
+        self.recent = {}
+        self.loaded = set()
+        self.last_refresh = 0.
+
+        # Counters
+        self.queries = 0
+        self.errors = 0
+
+    def _query(self, sql, params=()):
+        '''Runs a query and returns the rows as dicts, or None on error. A query that fails is
+           retried once with a new connection, in case the server closed the old one.'''
+        sql = sql.replace("?", self.placeholder)
+        for attempt in range(2):
+            conn = None
+            try:
+                conn = self.pool.get()
+                cursor = conn.cursor()
+                cursor.execute(sql, params)
+                self.last_columns = [column[0] for column in cursor.description]
+                rows = [dict(zip(self.last_columns, row)) for row in cursor.fetchall()]
+                cursor.close()
+                self.pool.put(conn)
+                self.queries += 1
+                return rows
+            except self.driver_errors as err:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except self.driver_errors:
+                        pass
+                if attempt == 1:
+                    debug("Database query failed: {:s}".format(str(err)), "stderr")
+        self.errors += 1
+        return None
+
+    def _eventQuery(self, where):
+        '''Returns the query for events matching a where clause'''
+        if self.start_column is None:
+            # StartTime was renamed StartDateTime in ZoneMinder 1.36
+            if self._query("SELECT * FROM Events WHERE 1 = 0") is None:
+                return None
+            self.start_column = "StartTime"
+            if "StartDateTime" in self.last_columns:
+                self.start_column = "StartDateTime"
+        return ("SELECT E.Id, E.MonitorId, E.MaxScoreFrameId, E.MaxScore, E.DefaultVideo, "
+                "E.Scheme, E.{:s} AS StartTime, S.Path AS StoragePath FROM Events E "
+                "LEFT JOIN Storage S ON S.Id = E.StorageId WHERE {:s} ORDER BY E.Id") \
+               .format(self.start_column, where)
+
+    def eventPath(self, row):
+        '''Returns the directory of an event for ZoneMinder's Deep, Medium, and Shallow storage
+           schemes'''
+        storage = row["StoragePath"] or self.events_dir
+        monitor_dir = os.path.join(storage, str(row["MonitorId"]))
+        start = row["StartTime"]
+        if isinstance(start, str):
+            start = datetime.datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
+        if row["Scheme"] == "Deep":
+            return os.path.join(monitor_dir, start.strftime("%y/%m/%d/%H/%M/%S"))
+        if row["Scheme"] == "Shallow":
+            return os.path.join(monitor_dir, str(row["Id"]))
+        return os.path.join(monitor_dir, start.strftime("%Y-%m-%d"), str(row["Id"]))
+
+    def _addEvent(self, row):
+        '''Adds a finished event to the recent events of its monitor'''
+        event = {'id': int(row["Id"]), 'maxscore_frameid': int(row["MaxScoreFrameId"]),
+                 'path': self.eventPath(row), 'video_name': row["DefaultVideo"] or "",
+                 'max_score': int(row["MaxScore"] or 0)}
+        events = self.recent.setdefault(int(row["MonitorId"]), [])
+        if any(e['id'] == event['id'] for e in events):
+            return
+        events.append(event)
+        events.sort(key=lambda e: -e['id'])
+        del events[self.history:]
+
+    def refresh(self, force=False):
+        '''Reads events added or finished since the last refresh. Returns False on error.'''
+        now = time.time()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return True
+
+        if self.last_seen is None:
+            # Start from the newest event. Events in progress among the last 100 are watched for
+            # when they finish.
+            rows = self._query("SELECT MAX(Id) AS Id FROM Events")
+            if rows is None:
+                return False
+            self.last_seen = int(rows[0]["Id"] or 0)
+            rows = self._query("SELECT Id FROM Events WHERE Id > ? AND MaxScoreFrameId IS NULL",
+                               (self.last_seen - 100,))
+            if rows is None:
+                self.last_seen = None
+                return False
+            self.pending = {int(row["Id"]): now for row in rows}
+
+        # New events, and events that were in progress at the last refresh
+        self.pending = {ID: seen for ID, seen in self.pending.items()
+                        if now - seen < self.pending_timeout}
+        where = "E.Id > ?"
+        params = [self.last_seen]
+        if len(self.pending) > 0:
+            where += " OR E.Id IN ({:s})".format(", ".join("?"*len(self.pending)))
+            params += sorted(self.pending.keys())
+        sql = self._eventQuery(where)
+        rows = self._query(sql, tuple(params)) if sql is not None else None
+        if rows is None:
+            return False
+        self.last_refresh = now
+        for row in rows:
+            ID = int(row["Id"])
+            self.last_seen = max(self.last_seen, ID)
+            if row["MaxScoreFrameId"] is None:
+                self.pending.setdefault(ID, now)
+            else:
+                self.pending.pop(ID, None)
+                self._addEvent(row)
+        return True
+
+    def _loadMonitor(self, monitorID):
+        '''Reads the latest finished events of a monitor the first time it is used'''
+        sql = self._eventQuery("E.MonitorId = ? AND E.MaxScoreFrameId IS NOT NULL AND E.Id <= ?")
+        if sql is None:
+            return False
+        rows = self._query(sql.replace("ORDER BY E.Id", "ORDER BY E.Id DESC LIMIT ?"),
+                           (monitorID, self.last_seen, self.history))
+        if rows is None:
+            return False
+        self.loaded.add(monitorID)
+        self.recent.setdefault(monitorID, [])
+        for row in rows:
+            self._addEvent(row)
+        return True
+
+    def getMonitorLatestEvent(self, monitorID, idx=0):
+        '''Returns the same event information as ZMAPI.getMonitorLatestEvent: the latest finished
+           event of a monitor, or with idx > 0 an earlier one. The id is -1 on error or if there
+           is no such event among the ones kept.'''
+        res = {'id':-1, 'maxscore_frameid':0, 'path':"", 'video_name':"", 'max_score':0}
+        if not self.refresh():
+            return res
+        if monitorID not in self.loaded and not self._loadMonitor(monitorID):
+            return res
+        events = self.recent[monitorID]
+        if idx < len(events):
+            res = dict(events[idx])
+        return res
+
+    def getStats(self):
+        '''Returns a dict of query and error counts'''
+        return {"queries": self.queries, "errors": self.errors, "pending": len(self.pending)}
+
+    def close(self):
+        self.pool.closeAll()
@@ -0,0 +1,90 @@
+import heapq
+import time
+
+class EventQueue:
+    '''Queue of discovered events waiting for detection. Events are ordered by monitor priority
+       (higher first), then ZoneMinder max score (higher first), then discovery time (older
+       first). When the queue is full, the lowest-priority event is dropped.'''
+
+    def __init__(self, max_depth=100):
+        self.max_depth = max_depth
+        self.queue = []
+        self.counter = 0
+
+        # Metrics
+        self.max_seen_depth = 0
+        self.queued = 0
+        self.dequeued = 0
+        self.processed = 0
+        self.degraded = 0
+        self.dropped = 0
+        self.total_wait = 0.
+
+    def depth(self):
+        '''Returns the number of events waiting in the queue'''
+        return len(self.queue)
+
+    def put(self, monitor, event):
+        '''Adds an event from a monitor to the queue'''
+        item = (-monitor.priority, -event['max_score'], self.counter, time.time(), monitor, event)
+        heapq.heappush(self.queue, item)
+        self.counter += 1
+        self.queued += 1
+
+        # Shed the lowest-priority event if over the limit. Among events of equal priority and
+        # score, the oldest is dropped, since users most need to hear about the newest one.
+        if len(self.queue) > self.max_depth:
+            idx = self.queue.index(max(self.queue, key=lambda x: (x[0], x[1], -x[2])))
+            _, _, _, _, dropped_monitor, dropped_event = self.queue.pop(idx)
+            heapq.heapify(self.queue)
+            self.dropped += 1
+            dropped_monitor.debug("Event queue full. Dropping event {:d}." \
+                                  .format(dropped_event['id']), "stderr")
+        self.max_seen_depth = max(self.max_seen_depth, len(self.queue))
+
+    def get(self):
+        '''Removes and returns the next event as monitor, event, discovered_time. Returns
+           None, None, None if the queue is empty.'''
+        if len(self.queue) == 0:
+            return None, None, None
+        _, _, _, discovered_time, monitor, event = heapq.heappop(self.queue)
+        self.dequeued += 1
+        self.total_wait += time.time() - discovered_time
+        return monitor, event, discovered_time
+
+    def replaceMonitor(self, old, new):
+        '''Reassigns the queued events of a monitor to a new Monitor object for the same monitor
+           (e.g. after a configuration reload), or drops them if new is None'''
+        items = []
+        for item in self.queue:
+            if item[4] is not old:
+                items.append(item)
+            elif new is not None:
+                items.append((-new.priority,) + item[1:4] + (new, item[5]))
+        self.queue = items
+        heapq.heapify(self.queue)
+
+    def snapshot(self):
+        '''Returns the queued events in the order they will be processed, as dicts of monitor
+           name, event id, max score, and seconds waited'''
+        now = time.time()
+        return [{'monitor': item[4].name, 'event': item[5]['id'], 'max_score': item[5]['max_score'],
+                 'waited': round(now - item[3], 1)} for item in sorted(self.queue)]
+
+    def recordResult(self, result):
+        '''Records what happened to a dequeued event: processed, degraded, or dropped'''
+        if result == 'processed':
+            self.processed += 1
+        elif result == 'degraded':
+            self.degraded += 1
+        else:
+            self.dropped += 1
+
+    def getMetrics(self):
+        '''Returns a dict of queue metrics'''
+        avg_wait = 0.
+        if self.dequeued > 0:
+            avg_wait = self.total_wait / self.dequeued
+        return {'depth': len(self.queue), 'max_depth': self.max_seen_depth,
+                'queued': self.queued, 'processed': self.processed, 'degraded': self.degraded,
+                'dropped': self.dropped, 'avg_wait': avg_wait}
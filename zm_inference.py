@@ -0,0 +1,186 @@
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+import zm_util
+
+debug = zm_util.module_debug(__name__)
+
+class InferenceBatcher:
+    '''Collects detection requests for one detector from any number of threads into dynamic
+       batches. A batch is run as soon as it has max_batch_size frames, or max_wait seconds after
+       its first frame arrived, whichever comes first. The detector is only ever used from the
+       batcher's own thread.'''
+
+    def __init__(self, detector, max_batch_size=8, max_wait=0.02):
+        self.detector = detector
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        # Metrics
+        self.batches = 0
+        self.frames = 0
+        self.errors = 0
+
+    def start(self):
+        '''Starts the batching thread'''
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._batchLoop,
+                                       name="batcher_{:s}".format(self.detector.model_name),
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the batching thread'''
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, frame, timeout=30.):
+        '''Queues a frame for detection and waits for the result. Returns classes, confidences,
+           boxes like DetectorBase.detectObjects, or None if detection failed or timed out.'''
+        request = {"frame": frame, "done": threading.Event(), "result": None}
+        self.requests.put(request)
+        if not request["done"].wait(timeout):
+            return None
+        return request["result"]
+
+    def _nextBatch(self):
+        '''Waits for the first request, then collects more until the batch is full or max_wait
+           has passed. Returns an empty list if stopped.'''
+        batch = []
+        while not self.stop_event.is_set() and len(batch) == 0:
+            try:
+                batch.append(self.requests.get(timeout=0.5))
+            except queue.Empty:
+                continue
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.requests.get(timeout=remaining))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _batchLoop(self):
+        while not self.stop_event.is_set():
+            batch = self._nextBatch()
+            if len(batch) == 0:
+                continue
+            try:
+                results = self.detector.detectObjectsBatch([item["frame"] for item in batch])
+            except Exception as err:
+                debug("Detection failed for a batch of {:d}: {:s}".format(len(batch), str(err)),
+                      "stderr")
+                results = [None]*len(batch)
+                self.errors += 1
+            self.batches += 1
+            self.frames += len(batch)
+            for item, result in zip(batch, results):
+                item["result"] = result
+                item["done"].set()
+
+    def getMetrics(self):
+        '''Returns a dict of batching metrics'''
+        avg_batch = 0.
+        if self.batches > 0:
+            avg_batch = self.frames / self.batches
+        return {"batches": self.batches, "frames": self.frames, "errors": self.errors,
+                "avg_batch": avg_batch, "waiting": self.requests.qsize()}
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    '''HTTP API of the inference server:
+       GET /info: JSON with the class list of each model served and the batching metrics
+       POST /detect?model=<model>: body is an encoded image (e.g. JPEG). Returns JSON with lists
+           of classes (class IDs), confidences, and boxes (left, top, width, height) of all
+           detections above the server's confidence threshold, before non-maximum suppression.'''
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Requests are not logged individually
+        pass
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/info":
+            self._reply(404, {"error": "Not found"})
+            return
+        models = {}
+        for model, batcher in self.server.batchers.items():
+            models[model] = {"classes": batcher.detector.classes, "metrics": batcher.getMetrics()}
+        self._reply(200, {"models": models})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/detect":
+            self._reply(404, {"error": "Not found"})
+            return
+        model = parse_qs(url.query).get("model", [""])[0]
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length)
+        batcher = self.server.batchers.get(model)
+        if batcher is None:
+            self._reply(400, {"error": "Unknown model {:s}".format(model)})
+            return
+
+        # Images are decoded in the request threads so that the batcher only runs inference
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            self._reply(400, {"error": "Unable to decode image"})
+            return
+        result = batcher.submit(frame, self.server.request_timeout)
+        if result is None:
+            self._reply(503, {"error": "Detection failed"})
+            return
+        classes, confidences, boxes = result
+        self._reply(200, {"classes": [int(c) for c in classes],
+                          "confidences": [float(c) for c in confidences],
+                          "boxes": [[int(v) for v in box] for box in boxes]})
+
+
+class InferenceServer(ThreadingHTTPServer):
+    '''HTTP server that runs detection for remote clients (DetectorRemote) with one
+       InferenceBatcher per model, so that requests from all monitors and all clients are
+       batched together.'''
+
+    daemon_threads = True
+
+    def __init__(self, address, detectors, max_batch_size=8, max_wait=0.02,
+                 request_timeout=30.):
+        '''address: (host, port) to listen on
+           detectors: dict of model name -> initialized detector
+           max_batch_size, max_wait: batching limits (see InferenceBatcher)
+           request_timeout: seconds a request may wait for its result'''
+        ThreadingHTTPServer.__init__(self, address, InferenceRequestHandler)
+        self.request_timeout = request_timeout
+        self.batchers = {}
+        for model, detector in detectors.items():
+            self.batchers[model] = InferenceBatcher(detector, max_batch_size, max_wait)
+            self.batchers[model].start()
+
+    def server_close(self):
+        for batcher in self.batchers.values():
+            batcher.stop()
+        ThreadingHTTPServer.server_close(self)
@@ -0,0 +1,81 @@
+import time
+
+def _area(size):
+    return size[0]*size[1]
+
+
+class AnalysisSizeTuner:
+    '''Keeps a detector's time per analyzed frame within a latency budget by changing its analysis
+       size. The configured analysis size is the largest used, and smaller ones come from the
+       detector's analysis_sizes. The time per frame is smoothed over updates. When it exceeds
+       the budget, the next smaller size is used right away. When the time expected at the next
+       larger size (scaled by its number of pixels) is within headroom times the budget, and the
+       size hasn't changed for cooldown seconds, the larger size is used again.'''
+
+    def __init__(self, detector, budget, headroom=0.8, cooldown=60., smoothing=0.3):
+        '''detector: detector to tune (see tunable)
+           budget: seconds per analyzed frame
+           headroom: fraction of the budget the expected time must be within to step up
+           cooldown: minimum seconds between a change and stepping up
+           smoothing: weight of the newest measurement in the smoothed time per frame'''
+        self.detector = detector
+        self.budget = budget
+        self.headroom = headroom
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.sizes = [detector.analysis_size] + [size for size in detector.analysis_sizes
+                      if _area(size) < _area(detector.analysis_size)]
+        self.frame_time = None
+        self.measured = 0.
+        self.last_time = detector.detect_time
+        self.last_count = detector.detect_count
+        self.last_change = 0.
+        self.changes = 0
+
+    @staticmethod
+    def tunable(detector):
+        '''Returns True if the detector has smaller analysis sizes to switch to'''
+        return any(_area(size) < _area(detector.analysis_size)
+                   for size in getattr(detector, "analysis_sizes", []))
+
+    def update(self, now=None):
+        '''Updates the time per frame with the frames analyzed since the last update and changes
+           the analysis size if needed. Returns the previous size if it was changed, or None.'''
+        if now is None:
+            now = time.time()
+        detector = self.detector
+        count = detector.detect_count - self.last_count
+        if count == 0:
+            return None
+        frame_time = (detector.detect_time - self.last_time)/count
+        self.last_time = detector.detect_time
+        self.last_count = detector.detect_count
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time = self.smoothing*frame_time + (1 - self.smoothing)*self.frame_time
+        self.measured = self.frame_time
+
+        idx = self.sizes.index(detector.analysis_size)
+        if self.frame_time > self.budget and idx < len(self.sizes) - 1:
+            new_idx = idx + 1
+        elif idx > 0 and now - self.last_change >= self.cooldown and \
+             self.frame_time*_area(self.sizes[idx-1])/_area(self.sizes[idx]) <= \
+             self.headroom*self.budget:
+            new_idx = idx - 1
+        else:
+            return None
+
+        # Start from the expected time at the new size until it has been measured
+        previous = detector.analysis_size
+        self.frame_time *= _area(self.sizes[new_idx])/_area(previous)
+        detector.setAnalysisSize(self.sizes[new_idx])
+        self.last_change = now
+        self.changes += 1
+        return previous
+
+    def getStats(self):
+        '''Returns a dict of the current analysis size, last smoothed seconds per frame measured,
+           budget, and number of changes'''
+        return {"size": self.detector.analysis_size, "frame_time": self.measured,
+                "budget": self.budget, "changes": self.changes}
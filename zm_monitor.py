@@ -1,41 +1,116 @@
+import logging
 import sys
 import os
-from cv2 import imread
-from zm_util import debug
+import time
+from glob import glob
+from cv2 import imread, resize, cvtColor, COLOR_BGR2GRAY, INTER_AREA
+import zm_util
+from zm_stream import StreamCapture
+from zm_latency import AnalysisSizeTuner
+import zm_trace
+
+debug = zm_util.module_debug(__name__)
 
 class Monitor:
     def __init__(self, monitor_name, monitor_id, zmapi, detector=None, detect_objects=True,
-                 detect_in="image"):
+                 detect_in="image", priority=0, event_deadline=0, stale_detector=None,
+                 frame_idle_timeout=5, frame_step=1, detect_source="events", stream_url="",
+                 stream_sample_rate=1.0, stream_cooldown=60, duplicate_gate="off",
+                 duplicate_distance=5, duplicate_max_age=300, event_source=None,
+                 latency_budget=0):
         '''Initialize monitor with name, id, pointers to ZMAPI and detector instances, and detection
-           settings'''
+           settings. Events are queued for detection with the given priority (higher first). Events
+           that have waited longer than event_deadline seconds (0 means never) are stale and are
+           analyzed with stale_detector instead, or skipped if it is None. With detect_in "frames",
+           every frame_step-th frame JPEG is analyzed while the event is in progress, and the
+           event is considered finished when no new frames appear for frame_idle_timeout seconds.
+           With detect_source "stream", detection is done on frames sampled from the live stream
+           (stream_url, or ZoneMinder's MJPEG stream if blank) stream_sample_rate times per
+           second instead of on events, and a detection is only reported if there were none in
+           the previous stream_cooldown seconds. With duplicate_gate "reuse" or "skip", events whose
+           image differs from that of the last analyzed event in at most duplicate_distance bits of
+           its perceptual hash, within duplicate_max_age seconds, are not analyzed again. Their
+           result is the previous one with "reuse", or no image with "skip". Events are looked up
+           with event_source (e.g. an EventDatabase) if given, or else through the API. With a
+           latency_budget (seconds per analyzed frame, 0 means none), the analysis size of the
+           detector (the second stage of cascades) is lowered when detection takes longer and
+           raised again when there is room, if the detector supports it.'''
         self.name = monitor_name
         self.id = monitor_id
         self.api = zmapi
+        self.events = event_source if event_source is not None else zmapi
         self.detector = detector
         self.detect_objects = detect_objects
         self.detect_in = detect_in
+        self.priority = priority
+        self.event_deadline = event_deadline
+        self.stale_detector = stale_detector
+        self.frame_idle_timeout = frame_idle_timeout
+        self.frame_step = max(frame_step, 1)
+
+        self.detect_source = detect_source
+        self.stream_interval = 1./stream_sample_rate
+        self.stream_cooldown = stream_cooldown
+
+        # Near-duplicate gate state: hash, time, event ID, and result of the last analyzed event
+        self.duplicate_gate = duplicate_gate
+        self.duplicate_distance = duplicate_distance
+        self.duplicate_max_age = duplicate_max_age
+        self.last_analyzed = None
+        self.duplicate_of = None
+        self.duplicate_stats = {'checked': 0, 'reused': 0, 'skipped': 0}
+
+        # Analysis size tuning
+        self.tuner = None
+        if latency_budget > 0 and detector is not None:
+            tuned = detector
+            if getattr(detector, "model_name", "") == "Cascade":
+                tuned = detector.second_stage
+            if AnalysisSizeTuner.tunable(tuned):
+                self.tuner = AnalysisSizeTuner(tuned, latency_budget)
+            else:
+                self.debug("The analysis size of {:s} can't be lowered. Ignoring latency_budget." \
+                           .format(tuned.model_name), "stderr")
+
+        # State of the in-progress event being analyzed frame by frame
+        self.progress = None
+
+        # Live stream capture for detect_source "stream"
+        self.stream = None
+        self.last_stream_detection = 0
+        if detect_source == "stream":
+            if stream_url == "":
+                stream_url = lambda: self.api.getStreamURL(self.id)
+            self.stream = StreamCapture(self.name, stream_url)
 
         # Sanity checks
         if self.detect_objects:
             if detector is None:
                 self.debug("Must pass a detector to detect objects.", "stderr")
                 sys.exit(1)
-            if not detect_in in ["image", "video"]:
-                self.debug("detect_in must be 'image' or 'video'.", "stderr")
+            if not detect_in in ["image", "video", "frames"]:
+                self.debug("detect_in must be 'image', 'video', or 'frames'.", "stderr")
                 sys.exit(1)
+        if not detect_source in ["events", "stream"]:
+            self.debug("detect_source must be 'events' or 'stream'.", "stderr")
+            sys.exit(1)
+        if detect_source == "stream" and not self.detect_objects:
+            self.debug("detect_objects must be enabled with detect_source 'stream'.", "stderr")
+            sys.exit(1)
 
         # Get latest event
-        self.latest_event = self.api.getMonitorLatestEvent(self.id)
+        self.latest_event = self.events.getMonitorLatestEvent(self.id)
 
         # Save active state
         self.checkActive()
 
-    def debug(self, message, pipename='stdout'):
-        debug("{:s}: {:s}".format(self.name, message), pipename)
+    def debug(self, message, pipename='stdout', level=None):
+        debug("{:s}: {:s}".format(self.name, message), pipename, level)
 
     def checkActive(self):
-        '''Checks if monitor is active'''
-        self.active = self.api.getMonitorDaemonStatus(self.id)
+        '''Checks if monitor is active, using the API's current monitor status snapshot. Call
+           ZMAPI.getMonitorsStatus first to refresh the snapshot.'''
+        self.active = self.api.getCachedMonitorStatus(self.id)
         return self.active
 
     def eventImage(self, event, imgfile="snapshot.jpg"):
@@ -51,8 +126,8 @@ class Monitor:
         return os.path.join(event['path'], event['video_name'])
 
     def getNewEvent(self):
-        '''Gets a new event from the API. Returns True if there is a new event to process, False
-           if not. An event is considered ready to be processed if:
+        '''Gets a new event from the event source. Returns True if there is a new event to
+           process, False if not. An event is considered ready to be processed if:
            1. It is different from the one already in memory.
            2. The max score frame or alarm frame is available.'''
 
@@ -61,7 +136,7 @@ class Monitor:
         # Look through monitor events list, starting with the latest
         idx = 0
         while not ret:
-            event = self.api.getMonitorLatestEvent(self.id, idx)
+            event = self.events.getMonitorLatestEvent(self.id, idx)
             # There was an error getting the event
             if event['id'] == -1:
                 break
@@ -80,20 +155,95 @@ class Monitor:
 
         return ret
 
-    def detectObjects(self):
-        '''Detects objects in latest event. Returns: 
+    def getState(self):
+        '''Returns a dict describing the monitor's current state, for diagnostics'''
+        state = {'name': self.name, 'id': self.id, 'active': self.active,
+                 'latest_event': self.latest_event['id'], 'source': self.detect_source,
+                 'detect_in': self.detect_in, 'model': "", 'in_progress': ""}
+        if self.detector is not None:
+            state['model'] = self.detector.model_name
+        if self.progress is not None:
+            state['in_progress'] = "{:d} (frame {:d})".format(self.progress['event']['id'],
+                                                              self.progress['next_frame'])
+        if self.duplicate_gate != "off":
+            state.update(self.duplicate_stats)
+        if self.tuner is not None:
+            stats = self.tuner.getStats()
+            state['analysis_size'] = "{:d}x{:d}".format(*stats['size'])
+            state['frame_time'] = round(stats['frame_time'], 3)
+        return state
+
+    def tuneAnalysisSize(self):
+        '''Adapts the analysis size to the latency budget with the frames analyzed since the last
+           call, if there is a budget'''
+        if self.tuner is None:
+            return
+        previous = self.tuner.update()
+        if previous is not None:
+            stats = self.tuner.getStats()
+            self.debug(("Analysis size {:d}x{:d} -> {:d}x{:d} ({:.2f} s per frame, budget "
+                        "{:.2f} s).").format(*previous, *stats['size'], stats['frame_time'],
+                                             stats['budget']))
+
+    def prewarm(self):
+        '''Loads the network of the monitor's detector (the first stage for cascades) if it was
+           unloaded to save memory, so that it is ready by the time an event is processed'''
+        detector = self.detector
+        if detector is None:
+            return
+        if not hasattr(detector, "acquireNetwork"):
+            detector = detector.first_stage
+        detector.acquireNetwork()
+
+    @staticmethod
+    def imageHash(frame):
+        '''Returns a 64-bit difference hash of a frame: whether each pixel of a 9x8 grayscale
+           thumbnail is brighter than its right neighbor. Small changes in lighting, noise, or
+           compression barely change it.'''
+        thumb = resize(cvtColor(frame, COLOR_BGR2GRAY), (9, 8), interpolation=INTER_AREA)
+        bits = (thumb[:,1:] > thumb[:,:-1]).flatten()
+        return int("".join("1" if bit else "0" for bit in bits), 2)
+
+    def checkDuplicate(self, event, frame):
+        '''Returns the hash of the event frame and the last analyzed event info if the frame is a
+           near-duplicate of it, or None otherwise'''
+        signature = self.imageHash(frame)
+        self.duplicate_stats['checked'] += 1
+        last = self.last_analyzed
+        if last is None or time.time() - last['time'] > self.duplicate_max_age:
+            return signature, None
+        if bin(signature ^ last['hash']).count("1") > self.duplicate_distance:
+            return signature, None
+        return signature, last
+
+    def isStale(self, discovered_time, now):
+        '''Returns True if an event discovered at discovered_time has missed its deadline'''
+        return self.event_deadline > 0 and now - discovered_time > self.event_deadline
+
+    def detectObjects(self, event=None, detector=None):
+        '''Detects objects in an event, by default the latest event, with the given detector, by
+           default the monitor's detector. Returns:
            frame: the OpenCV frame object
            objclass: the class name of the object detected with highest confidence in the frame
            maxconfidence: the confidence of the object detected (0-1)'''
         frame = None
         objclass = ""
         maxconfidence = 0.0
+        self.duplicate_of = None
+        if event is None:
+            event = self.latest_event
+        if detector is None:
+            detector = self.detector
+
+        # Cascaded detectors also need the ZoneMinder event score to decide whether to run the
+        # second stage
+        cascade = getattr(detector, "model_name", "") == "Cascade"
 
         # Get the event image file. First try the maxscore frame (snapshot.jpg), but if that's
         # not available, try the alarm frame (alarm.jpg).
         has_img = True
-        maxscore_img = self.eventImage(self.latest_event)
-        alarm_img = self.eventImage(self.latest_event, "alarm.jpg")
+        maxscore_img = self.eventImage(event)
+        alarm_img = self.eventImage(event, "alarm.jpg")
         event_img = None
         if maxscore_img is not None and os.path.isfile(maxscore_img):
             event_img = maxscore_img
@@ -104,36 +254,71 @@ class Monitor:
         if not has_img:
             self.debug("Event image not present on disk.")
             return frame, objclass, maxconfidence
+        zm_trace.mark("image_available", file=os.path.basename(event_img))
 
         # Open the max score frame. Since we've already checked that the file exists on disk,
         # this should return a valid frame object, but it will be None if there is a problem
         # reading it.
         frame = imread(event_img)
+        zm_trace.mark("image_decoded")
 
         # Return the max score frame if we're not doing object detection
         if not self.detect_objects:
             return frame, objclass, maxconfidence
 
+        # Don't analyze near-duplicates of the last analyzed event image again
+        if self.duplicate_gate != "off" and frame is not None:
+            signature, last = self.checkDuplicate(event, frame)
+            if last is not None:
+                self.duplicate_of = last['event_id']
+                zm_trace.mark("duplicate", of=last['event_id'], gate=self.duplicate_gate)
+                if self.duplicate_gate == "skip":
+                    self.duplicate_stats['skipped'] += 1
+                    return None, objclass, maxconfidence
+                self.duplicate_stats['reused'] += 1
+                self.debug("Event {:d} is a near-duplicate of event {:d}. Reusing its result." \
+                           .format(event['id'], last['event_id']))
+                return frame, last['objclass'], last['confidence']
+            self.last_analyzed = {'hash': signature, 'time': time.time(),
+                                  'event_id': event['id'], 'objclass': objclass,
+                                  'confidence': maxconfidence}
+
+        # Extra arguments for cascaded detection
+        detect_kwargs = {}
+        if cascade:
+            detect_kwargs['event_score'] = event['max_score']
+
         # Detect objects in video. We'll default to the max score image if there is a problem
         # reading the video.
         if self.detect_in == "video":
-            video_file = self.eventVideo(self.latest_event)
+            video_file = self.eventVideo(event)
             if not os.path.isfile(video_file):
                 self.debug("Event video not present on disk. Detecting in max score frame instead.")
             else:
-                bestframe, classes, confidences = self.detector.detectInVideo(video_file,
+                zm_trace.mark("video_available")
+                bestframe, classes, confidences = detector.detectInVideo(video_file,
                                                   annotate_name=False, show=False,
-                                                  annotate_fps=False, return_first_detection=True)
+                                                  annotate_fps=False, return_first_detection=True,
+                                                  **detect_kwargs)
+                if cascade:
+                    self.debug("Detection decided by {:s} stage.".format(detector.decided_by),
+                               level=logging.DEBUG)
+                    zm_trace.mark("cascade_decided", stage=detector.decided_by)
                 if bestframe is None:
                     self.debug("No objects found. Trying max score image instead.")
                 else:
                     maxconfidence = max(confidences)
                     objclass = classes[confidences.index(maxconfidence)]
+                    self.rememberResult(event, objclass, maxconfidence)
                     return bestframe, objclass, maxconfidence
 
         # Detect objects in max score image
-        bestframe, classes, confidences = self.detector.detectInImage(event_img,
-                                          annotate_name=False, show=False)
+        bestframe, classes, confidences = detector.detectInImage(event_img,
+                                          annotate_name=False, show=False, **detect_kwargs)
+        if cascade:
+            self.debug("Detection decided by {:s} stage.".format(detector.decided_by),
+                       level=logging.DEBUG)
+            zm_trace.mark("cascade_decided", stage=detector.decided_by)
         if bestframe is None:
             self.debug("Error opening max score image. No detection done.", "stderr")
         else:
@@ -141,5 +326,132 @@ class Monitor:
             if len(confidences) > 0:
                 maxconfidence = max(confidences)
                 objclass = classes[confidences.index(maxconfidence)]
+        self.rememberResult(event, objclass, maxconfidence)
 
         return frame, objclass, maxconfidence
+
+    def rememberResult(self, event, objclass, maxconfidence):
+        '''Saves the detection result of an event for reuse by its near-duplicates'''
+        if self.last_analyzed is not None and self.last_analyzed['event_id'] == event['id']:
+            self.last_analyzed['objclass'] = objclass
+            self.last_analyzed['confidence'] = maxconfidence
+
+    def startInProgress(self, event, detector=None, trace=None):
+        '''Starts frame-by-frame analysis of an event that may still be in progress. Call
+           detectInProgress repeatedly afterwards until it reports that it is done. The timing
+           trace for the event, if any, is kept in progress['trace']. Only one event is analyzed
+           at a time, so call finishInProgress first if another one is still in progress.'''
+        if detector is None:
+            detector = self.detector
+        self.progress = {'event': event, 'detector': detector, 'next_frame': 0, 'nframes': 0,
+                         'last_new': time.time(), 'trace': trace}
+
+    def finishInProgress(self):
+        '''Stops frame-by-frame analysis of the event in progress and detects objects in its event
+           image instead, like detectInProgress does once the event has ended. Returns frame,
+           objclass, maxconfidence like detectObjects.'''
+        event = self.progress['event']
+        detector = self.progress['detector']
+        self.progress = None
+        self.debug("Finishing detection for event {:d} with its event image.".format(event['id']))
+        return self.detectObjects(event, detector)
+
+    def detectInProgress(self):
+        '''Analyzes frame JPEGs written by ZoneMinder since the last call for the in-progress event.
+           Returns done, frame, objclass, maxconfidence. done is True as soon as an object is
+           detected in any frame, or once the event has ended. If no object was found in the frames
+           by then, detection falls back to the event image.'''
+        frame = None
+        objclass = ""
+        maxconfidence = 0.0
+        event = self.progress['event']
+        detector = self.progress['detector']
+
+        # Cascaded detectors need the whole event, so they can't be used frame by frame
+        if not hasattr(detector, "detectInFrame"):
+            self.progress = None
+            frame, objclass, maxconfidence = self.detectObjects(event, detector)
+            return True, frame, objclass, maxconfidence
+
+        # Frames are named like 00001-capture.jpg. The newest one may still be being written, so
+        # leave it for the next call unless the event looks finished.
+        frame_files = sorted(glob(os.path.join(event['path'], "*-capture.jpg")))
+        now = time.time()
+        nframes = len(frame_files)
+        if nframes > self.progress['nframes']:
+            self.progress['nframes'] = nframes
+            self.progress['last_new'] = now
+        idle = now - self.progress['last_new'] > self.frame_idle_timeout
+        last = nframes if idle else nframes-1
+
+        for idx in range(self.progress['next_frame'], last, self.frame_step):
+            img = imread(frame_files[idx])
+            if img is None:
+                continue
+            zm_trace.mark("image_decoded", frame=idx+1)
+            classes, confidences, _, annotated = detector.detectInFrame(img, annotate_name=False)
+            if annotated is not None and len(confidences) > 0:
+                self.progress = None
+                maxconfidence = max(confidences)
+                objclass = detector.classes[classes[confidences.index(maxconfidence)]]
+                self.debug("Detected {:s} in frame {:d} of event {:d} in progress." \
+                           .format(objclass, idx+1, event['id']), level=logging.DEBUG)
+                return True, annotated, objclass, maxconfidence
+        next_frame = self.progress['next_frame']
+        while next_frame < last:
+            next_frame += self.frame_step
+        self.progress['next_frame'] = next_frame
+
+        if not idle:
+            return False, frame, objclass, maxconfidence
+
+        # The event has ended without any detections in frames. Fall back to the event image,
+        # which will have the final max score frame by now.
+        if nframes == 0:
+            self.debug("No frame JPEGs found for event {:d}. Is JPEG saving enabled?" \
+                       .format(event['id']), "stderr")
+        self.progress = None
+        frame, objclass, maxconfidence = self.detectObjects(event, detector)
+        return True, frame, objclass, maxconfidence
+
+    def detectInStream(self):
+        '''Detects objects in the latest frame from the live stream. Returns frame, objclass,
+           maxconfidence like detectObjects. frame is None if there is no fresh frame, if nothing
+           was detected, or if there was another detection less than stream_cooldown seconds
+           ago (so an object that stays in view is only reported once).'''
+        objclass = ""
+        maxconfidence = 0.0
+
+        frame = self.stream.getLatestFrame()
+        if frame is None:
+            return None, objclass, maxconfidence
+
+        # For cascades, frames where the first stage is uncertain go to the second stage like
+        # events do. The first stage reports detections down to uncertain_low, so the result is
+        # also checked against the monitor's confidence threshold.
+        detector = self.detector
+        if not hasattr(detector, "detectInFrame"):
+            detector = self.detector.first_stage
+            classes, confidences, _, annotated = detector.detectInFrame(frame,
+                                                                        annotate_name=False)
+            if annotated is not None and self.detector.needSecondStage(confidences, 0):
+                detector = self.detector.second_stage
+                classes, confidences, _, annotated = detector.detectInFrame(frame,
+                                                                            annotate_name=False)
+            elif annotated is not None:
+                classes, confidences = self.detector.applyThreshold(classes, confidences)
+        else:
+            classes, confidences, _, annotated = detector.detectInFrame(frame, annotate_name=False)
+        if annotated is None or len(confidences) == 0 or \
+           max(confidences) < self.detector.conf_threshold:
+            return None, objclass, maxconfidence
+
+        now = time.time()
+        if now - self.last_stream_detection < self.stream_cooldown:
+            self.last_stream_detection = now
+            return None, objclass, maxconfidence
+        self.last_stream_detection = now
+
+        maxconfidence = max(confidences)
+        objclass = detector.classes[classes[confidences.index(maxconfidence)]]
+        return annotated, objclass, maxconfidence
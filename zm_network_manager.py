@@ -0,0 +1,139 @@
+import os
+import time
+import weakref
+from collections import OrderedDict
+import zm_util
+
+debug = zm_util.module_debug(__name__)
+
+def current_rss():
+    '''Returns the resident set size of this process in bytes, or 0 if unknown'''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+class NetworkManager:
+    '''Keeps track of loaded detector networks by networkKey. Detectors with the same key share
+       one network. If a memory budget is set, the least recently used networks are evicted to
+       stay within it, and evicted networks are reloaded when a detector using them is next used
+       (detectors call acquire before detecting). Networks that haven't been used for idle_timeout
+       seconds can also be evicted with evictIdle. Not thread safe: use it from one thread.'''
+
+    def __init__(self, budget_mb=0, idle_timeout=0):
+        '''budget_mb: approximate memory budget for all networks in MB (0 means unlimited)
+           idle_timeout: seconds after which evictIdle evicts unused networks (0 means never)'''
+        self.budget = budget_mb*1024*1024
+        self.idle_timeout = idle_timeout
+
+        # networkKey -> {"network", "size", "last_used", "loads", "detectors"}, least recently
+        # used first. "network" is None once evicted.
+        self.entries = OrderedDict()
+
+        # Counters
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def register(self, detector):
+        '''Registers a new detector and makes sure its network is loaded, sharing it if it is
+           already. Returns False if the network couldn't be loaded.'''
+        key = detector.networkKey()
+        detector.network_key = key
+        detector.network_manager = self
+        if key not in self.entries:
+            self.entries[key] = {"network": None, "size": 0, "last_used": 0., "loads": 0,
+                                 "detectors": weakref.WeakSet()}
+        self.entries[key]["detectors"].add(detector)
+        if not self.acquire(detector):
+            self.entries[key]["detectors"].discard(detector)
+            if len(self.entries[key]["detectors"]) == 0:
+                del self.entries[key]
+            return False
+        return True
+
+    def acquire(self, detector):
+        '''Makes sure a registered detector's network is loaded and marks it as recently used.
+           Returns False if the network couldn't be loaded.'''
+        entry = self.entries.get(detector.network_key)
+        if entry is None:
+            return True
+        entry["last_used"] = time.time()
+        self.entries.move_to_end(detector.network_key)
+        if entry["network"] is not None:
+            detector.setNetwork(entry["network"])
+            return True
+
+        # Load the network and estimate its footprint from the growth of the process and the
+        # size of the model files
+        rss = current_rss()
+        if not detector.initializeNetwork():
+            return False
+        files = sum(os.path.getsize(path) for path in [detector.config_path,
+                    detector.model_path] if path != "" and os.path.isfile(path))
+        entry["size"] = max(current_rss() - rss, files)
+        entry["network"] = detector.getNetwork()
+        self.loads += 1
+        entry["loads"] += 1
+        if entry["loads"] > 1:
+            debug("Reloaded {:s} network ({:.0f} MB).".format(detector.model_name,
+                  entry["size"]/1024/1024))
+        self.enforceBudget(detector.network_key)
+        return True
+
+    def evict(self, key):
+        '''Unloads a network. Detectors using it reload it on their next use.'''
+        entry = self.entries[key]
+        if entry["network"] is None:
+            return
+        entry["network"] = None
+        for detector in entry["detectors"]:
+            detector.setNetwork(None)
+        self.evictions += 1
+
+    def loadedSize(self):
+        '''Returns the approximate memory used by loaded networks in bytes'''
+        return sum(entry["size"] for entry in self.entries.values()
+                   if entry["network"] is not None)
+
+    def enforceBudget(self, keep=None):
+        '''Evicts least recently used networks, except keep, until within the budget'''
+        if self.budget <= 0:
+            return
+        for key in list(self.entries.keys()):
+            if self.loadedSize() <= self.budget:
+                break
+            if key != keep and self.entries[key]["network"] is not None:
+                debug("Memory budget exceeded. Unloading least recently used network.")
+                self.evict(key)
+
+    def evictIdle(self, now=None):
+        '''Evicts networks that haven't been used for idle_timeout seconds'''
+        if self.idle_timeout <= 0:
+            return
+        if now is None:
+            now = time.time()
+        for key, entry in self.entries.items():
+            if entry["network"] is not None and now - entry["last_used"] > self.idle_timeout:
+                self.evict(key)
+
+    def retain(self, keys):
+        '''Forgets all networks except those with the given keys'''
+        for key in list(self.entries.keys()):
+            if key not in keys:
+                del self.entries[key]
+
+    def getStats(self):
+        '''Returns a dict of process RSS, loaded network count and size in MB, and load and
+           eviction counters'''
+        loaded = sum(1 for entry in self.entries.values() if entry["network"] is not None)
+        return {"rss_mb": current_rss()/1024/1024, "networks": len(self.entries),
+                "loaded": loaded, "loaded_mb": self.loadedSize()/1024/1024,
+                "loads": self.loads, "evictions": self.evictions}
@@ -1,13 +1,97 @@
+import os
+import smtplib
+import ssl
 import subprocess
+import cv2
 import requests
 import time
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
 import zm_util
+import zm_trace
+
+debug = zm_util.module_debug(__name__)
+
+class SMTPTransport:
+    '''Sends email over a persistent, authenticated SMTP connection, which is reused between
+       events and reopened when it has been idle longer than idle_timeout seconds (most servers
+       drop idle connections) or when the server has closed it.'''
+
+    def __init__(self, host, port=587, security="starttls", username="", password="", sender="",
+                 timeout=10, idle_timeout=60):
+        '''security: starttls, ssl, or none
+           sender: From address (defaults to username)'''
+        self.host = host
+        self.port = port
+        self.security = security
+        self.username = username
+        self.password = password
+        self.sender = sender if sender != "" else username
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.smtp = None
+        self.last_used = 0.
+
+        # Counters
+        self.connects = 0
+        self.sent = 0
+
+    def connect(self):
+        '''Opens and authenticates a new connection'''
+        self.close()
+        if self.security == "ssl":
+            self.smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout,
+                                         context=ssl.create_default_context())
+        else:
+            self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                self.smtp.starttls(context=ssl.create_default_context())
+        if self.username != "":
+            self.smtp.login(self.username, self.password)
+        self.connects += 1
+
+    def close(self):
+        '''Closes the connection, if open'''
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+    def send(self, message, recipients):
+        '''Sends an EmailMessage to a list of recipients. The connection is reopened and the
+           message resent once if the server has closed it. Returns True if successful.'''
+        if self.smtp is not None and time.time() - self.last_used > self.idle_timeout:
+            self.close()
+        for attempt in range(2):
+            try:
+                if self.smtp is None:
+                    self.connect()
+                self.smtp.send_message(message, self.sender, recipients)
+                self.last_used = time.time()
+                self.sent += 1
+                return True
+            except smtplib.SMTPServerDisconnected:
+                # Stale connection. Try once more with a new one.
+                self.smtp = None
+            except (smtplib.SMTPException, OSError) as err:
+                debug("SMTP error sending to {:s}: {:s}".format(", ".join(recipients),
+                      str(err)), "stderr")
+                self.close()
+                return False
+        debug("SMTP server {:s} disconnected.".format(self.host), "stderr")
+        return False
 
 class Notification:
-    def __init__(self, tmp_message_file, tmp_attachment):
+    def __init__(self, tmp_message_file, tmp_attachment, smtp_transport=None):
+        '''smtp_transport: an SMTPTransport to send email with instead of mutt. mutt is still used
+           if sending over SMTP fails.'''
         self.message_file = tmp_message_file
         self.attachment = tmp_attachment
         self.subject = "ZoneMinder event alert"
+        self.smtp = smtp_transport
 
         # Keep track of the last time we received a 500 response from the API server.
         # Their documentation says to wait at least 5 seconds in that case.
@@ -23,15 +107,22 @@ class Notification:
             "user_key": pushover_user_key,
             "attach_image": True/False}'''
 
-        # Email notifications
+        # Email notifications over SMTP. Falls back to mutt for failed messages.
+        if len(email_addresses) > 0 and self.smtp is not None:
+            email_addresses = self.sendSMTPEmails(msg, email_addresses)
+
+        # Email notifications with mutt
         if len(email_addresses) > 0:
             # Write the message
             if not self.writeMessage(msg):
                 return False
+            zm_trace.mark("message_written")
 
             # Send emails
             for addr in email_addresses:
-                if not self.sendEmail(addr["address"], addr["image"]):
+                ok = self.sendEmail(addr["address"], addr["image"])
+                zm_trace.mark("email_sent", address=addr["address"], ok=ok)
+                if not ok:
                     return False
 
         # Pushover API notifications
@@ -39,16 +130,54 @@ class Notification:
             api_token = pushover_data["api_token"]
             user_key = pushover_data["user_key"]
             attach_image = pushover_data["attach_image"]
-            return self.sendPushoverNotification(api_token, user_key, msg, attach_image)
+            ok = self.sendPushoverNotification(api_token, user_key, msg, attach_image)
+            zm_trace.mark("pushover_sent", ok=ok)
+            return ok
 
         return True
 
+    def buildMessage(self, msg, recipients, attach_image):
+        '''Builds an EmailMessage for a list of recipients, optionally with the image attached'''
+        message = EmailMessage()
+        message["Subject"] = self.subject
+        message["From"] = self.smtp.sender
+        message["To"] = ", ".join(recipients)
+        message["Date"] = formatdate(localtime=True)
+        message["Message-ID"] = make_msgid()
+        message.set_content(msg)
+        if attach_image:
+            try:
+                with open(self.attachment, "rb") as f:
+                    message.add_attachment(f.read(), maintype="image", subtype="jpeg",
+                                           filename=os.path.basename(self.attachment))
+            except IOError:
+                debug("Unable to open {:s} for email attachment.".format(self.attachment),
+                      "stderr")
+        return message
+
+    def sendSMTPEmails(self, msg, email_addresses):
+        '''Sends one message to all addresses that get the image attached and one to all others.
+           Returns the list of email_addresses for which sending failed.'''
+        failed = []
+        for attach_image in [True, False]:
+            group = [addr for addr in email_addresses if addr["image"] == attach_image]
+            if len(group) == 0:
+                continue
+            recipients = [addr["address"] for addr in group]
+            ok = self.smtp.send(self.buildMessage(msg, recipients, attach_image), recipients)
+            zm_trace.mark("email_sent", address=", ".join(recipients), ok=ok, transport="smtp")
+            if not ok:
+                failed += group
+        if len(failed) > 0:
+            debug("Sending email over SMTP failed. Trying mutt instead.", "stderr")
+        return failed
+
     def writeMessage(self, msg):
         '''Writes message to tmp file'''
         try:
             f = open(self.message_file, 'w')
         except IOError:
-            zm_util.debug("Cannot write to {:s}.".format(self.message_file), "stderr")
+            debug("Cannot write to {:s}.".format(self.message_file), "stderr")
             return False
         f.write(msg)
 
@@ -59,7 +188,7 @@ class Notification:
         try:
             f = open(self.message_file)
         except IOError:
-            zm_util.debug("Cannot open {:s}.".format(self.message_file), "stderr")
+            debug("Cannot open {:s}.".format(self.message_file), "stderr")
             return False
         if attach_image:
             check = subprocess.run(['mutt', '-s', self.subject, '-a', self.attachment, '--',
@@ -79,8 +208,8 @@ class Notification:
         # See "Being Friendly to our API" section in Pushover API documentation
         now = time.time()
         if now - self.pushover_last_error < self.pushover_error_timeout:
-            zm_util.debug("Skipping Pushover notification due to recent API request error.",
-                          "stderr")
+            debug("Skipping Pushover notification due to recent API request error.",
+                  "stderr")
             return False
 
         # Send the request
@@ -91,14 +220,109 @@ class Notification:
                 r = requests.post(url, data=data, files=attachment_data)
                 f.close()
             except IOError:
-                zm_util.debug("Unable to open {:s} for Pushover notification.", "stderr")
+                debug("Unable to open {:s} for Pushover notification.", "stderr")
                 r = requests.post(url, data=data)
         else:
             r = requests.post(url, data=data)
 
         # Check the response and return
         if not r.ok:
-            zm_util.debug("Pushover request returned {:d}.".format(r.status_code), "stderr")
+            debug("Pushover request returned {:d}.".format(r.status_code), "stderr")
             self.pushover_last_error = time.time()
             return False
         return True
+
+
+class NotificationCoalescer:
+    '''Merges the notifications of bursts of events from the same monitor or group of monitors.
+       The first event of a burst is notified at most max_delay seconds after it arrives, together
+       with any others from the same group that arrived by then. Events that arrive later within
+       window seconds of the first are notified together once the window ends. A merged
+       notification has the image and message of the event detected with the highest confidence
+       and the number of events. With a window of 0, every event is notified right away.'''
+
+    def __init__(self, notifier, email_addresses=[], pushover_data=None, window=0.,
+                 max_delay=0., trace_log=None):
+        '''notifier: Notification to send with
+           email_addresses, pushover_data: recipients, as for Notification.sendNotifications
+           trace_log: TraceLog the traces of events are written to once they are notified'''
+        self.notifier = notifier
+        self.email_addresses = email_addresses
+        self.pushover_data = pushover_data
+        self.window = window
+        self.max_delay = min(max_delay, window)
+        self.trace_log = trace_log
+
+        # group -> {"start", "due", "events"}. events are waiting to be notified as dicts of
+        # monitor, event_id, msg, frame, confidence, trace.
+        self.bursts = {}
+
+        # Counters
+        self.events = 0
+        self.sent = 0
+
+    def add(self, group, monitor_name, event_id, msg, frame, confidence, trace=None, now=None):
+        '''Adds the notification of an event with its message, resized image, and detection
+           confidence, and sends whatever is due. The event's EventTrace, if given, records the
+           phases of sending its notification, whenever that happens, and is then written to
+           the trace log.'''
+        if now is None:
+            now = time.time()
+        self.events += 1
+        burst = self.bursts.get(group)
+        if burst is None or now - burst["start"] >= self.window:
+            if burst is not None:
+                self._send(burst)
+            burst = {"start": now, "due": now + self.max_delay, "events": []}
+            self.bursts[group] = burst
+        burst["events"].append({"monitor": monitor_name, "event_id": event_id, "msg": msg,
+                                "frame": frame, "confidence": confidence, "trace": trace})
+        if burst["due"] > now and trace is not None:
+            trace.mark("notification_held", events=len(burst["events"]))
+        self.flush(now)
+
+    def nextDue(self):
+        '''Returns the time the next waiting notification is due, or None if there is none'''
+        due = [burst["due"] for burst in self.bursts.values() if len(burst["events"]) > 0]
+        return min(due) if len(due) > 0 else None
+
+    def flush(self, now=None, force=False):
+        '''Sends the notifications that are due, or all waiting ones if force'''
+        if now is None:
+            now = time.time()
+        for group in list(self.bursts.keys()):
+            burst = self.bursts[group]
+            if len(burst["events"]) > 0 and (force or now >= burst["due"]):
+                self._send(burst)
+                burst["due"] = burst["start"] + self.window
+            if len(burst["events"]) == 0 and now - burst["start"] >= self.window:
+                del self.bursts[group]
+
+    def _send(self, burst):
+        '''Sends one notification for the events waiting in a burst and writes their traces'''
+        events = burst["events"]
+        if len(events) == 0:
+            return
+        best = max(events, key=lambda event: event["confidence"])
+        msg = best["msg"]
+        if len(events) > 1:
+            monitors = sorted(set(event["monitor"] for event in events))
+            msg = "{:d} events on {:s} (events {:s}). Most confident:\n".format(len(events),
+                  ", ".join(monitors), ", ".join(str(event["event_id"]) for event in events)) + msg
+            debug("Sending one notification for {:d} events.".format(len(events)))
+        burst["events"] = []
+        traces = [event["trace"] for event in events if event["trace"] is not None]
+        with zm_trace.TraceGroup(traces):
+            if best["frame"] is not None:
+                cv2.imwrite(self.notifier.attachment, best["frame"])
+                zm_trace.mark("image_encoded")
+            self.notifier.sendNotifications(msg, self.email_addresses, self.pushover_data)
+        self.sent += 1
+        if self.trace_log is not None:
+            for trace in traces:
+                self.trace_log.write(trace)
+
+    def getStats(self):
+        '''Returns a dict of events added, notifications sent, and events waiting'''
+        return {"events": self.events, "sent": self.sent,
+                "waiting": sum(len(burst["events"]) for burst in self.bursts.values())}
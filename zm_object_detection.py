@@ -1,16 +1,246 @@
 import os
-import sys
+import queue
+import threading
 import cv2
 import numpy as np
+import requests
 import time
 from matplotlib import cm
 from copy import copy
+import zm_trace
+import zm_util
+
+debug = zm_util.module_debug(__name__)
 
 cmap = cm.get_cmap('RdYlGn')
 
+class InputBuffer:
+    '''Preprocessing stage that owns preallocated network input buffers. Frames are resized
+       into a reusable canvas, either stretched to the analysis size or letterboxed to keep their
+       aspect ratio, and then written into a reusable NCHW float blob with channel swap, mean
+       subtraction, and scaling done in place. Buffers are only reallocated when the frame size or
+       batch size changes, which is counted in allocations.'''
+
+    def __init__(self, size, scale=1.0, mean=(0.,0.,0.), swapRB=False, letterbox=False,
+                 pad_value=114):
+        '''size: (width, height) of the network input
+           scale: multiplier applied after mean subtraction
+           mean: values subtracted from each channel (after swapping channels if swapRB)
+           swapRB: whether to swap the first and last channels
+           letterbox: preserve aspect ratio and pad instead of stretching
+           pad_value: pixel value of the letterbox padding'''
+        self.size = size
+        self.scale = scale
+        self.mean = mean
+        self.swapRB = swapRB
+        self.letterbox = letterbox
+        self.pad_value = pad_value
+        self.allocations = 0
+
+        # Buffers, allocated on first use
+        self.blob = None
+        self.canvases = []
+        self.resized = []
+        self.frame_shapes = []
+        self.transforms = []
+
+    def resize(self, size):
+        '''Changes the network input size. Buffers are reallocated on the next use.'''
+        self.size = size
+        self.blob = None
+        self.canvases = []
+        self.resized = []
+        self.frame_shapes = []
+        self.transforms = []
+
+    def _allocate(self, idx, frame_shape):
+        '''(Re)allocates the canvas for batch index idx for frames of the given shape'''
+        aw, ah = self.size
+        height, width = frame_shape[:2]
+        if self.letterbox:
+            scale = min(aw/width, ah/height)
+            nw = int(round(width*scale))
+            nh = int(round(height*scale))
+            left = (aw - nw)//2
+            top = (ah - nh)//2
+            transform = (scale, scale, left, top)
+            # The padding never changes, so it only needs to be filled once
+            canvas = np.full((ah, aw, 3), self.pad_value, dtype=np.uint8)
+            resized = np.empty((nh, nw, 3), dtype=np.uint8)
+        else:
+            transform = (aw/width, ah/height, 0, 0)
+            canvas = np.empty((ah, aw, 3), dtype=np.uint8)
+            resized = canvas
+        if idx < len(self.canvases):
+            self.canvases[idx] = canvas
+            self.resized[idx] = resized
+            self.frame_shapes[idx] = frame_shape
+            self.transforms[idx] = transform
+        else:
+            self.canvases.append(canvas)
+            self.resized.append(resized)
+            self.frame_shapes.append(frame_shape)
+            self.transforms.append(transform)
+        self.allocations += 1
+
+    def prepare(self, frames):
+        '''Converts a list of frames to a network input blob. Returns the blob and a list of
+           (scale_x, scale_y, left, top) transforms for each frame, such that a point x in the
+           network input corresponds to (x - left)/scale_x in the frame.'''
+        aw, ah = self.size
+        nframes = len(frames)
+        if self.blob is None or self.blob.shape[0] < nframes:
+            self.blob = np.empty((nframes, 3, ah, aw), dtype=np.float32)
+            self.allocations += 1
+
+        for idx, frame in enumerate(frames):
+            if idx >= len(self.canvases) or self.frame_shapes[idx] != frame.shape:
+                self._allocate(idx, frame.shape)
+            canvas = self.canvases[idx]
+            resized = self.resized[idx]
+            cv2.resize(frame, (resized.shape[1], resized.shape[0]), dst=resized)
+            if resized is not canvas:
+                left = self.transforms[idx][2]
+                top = self.transforms[idx][3]
+                canvas[top:top+resized.shape[0], left:left+resized.shape[1]] = resized
+
+            # HWC uint8 -> CHW float32 with channel swap, mean, and scale, without temporaries
+            for c in range(3):
+                src = 2-c if self.swapRB else c
+                np.copyto(self.blob[idx,c], canvas[:,:,src], casting='unsafe')
+                if self.mean[c] != 0:
+                    self.blob[idx,c] -= self.mean[c]
+                if self.scale != 1:
+                    self.blob[idx,c] *= self.scale
+
+        return self.blob[:nframes], self.transforms[:nframes]
+
+
+class VideoDecoder:
+    '''Decodes a video file in a background thread into a bounded queue of frames, so that
+       decoding overlaps with inference. Has the same read/release interface as cv2.VideoCapture.'''
+
+    backends = {"any": cv2.CAP_ANY, "ffmpeg": cv2.CAP_FFMPEG, "gstreamer": cv2.CAP_GSTREAMER}
+
+    def __init__(self, video_file, prefetch=8, backend="any", threads=0, hw_accel=False,
+                 max_width=0):
+        '''video_file: path of the video
+           prefetch: maximum number of decoded frames waiting to be analyzed
+           backend: capture backend (any, ffmpeg, or gstreamer)
+           threads: number of decoder threads (0 lets the backend decide)
+           hw_accel: try hardware-accelerated decoding (e.g. VA-API), falling back to the CPU
+           max_width: downscale frames wider than this in the decoder thread (0 means never)'''
+        self.video_file = video_file
+        self.prefetch = max(prefetch, 1)
+        self.backend = self.backends.get(backend, cv2.CAP_ANY)
+        self.threads = threads
+        self.hw_accel = hw_accel
+        self.max_width = max_width
+
+        self.cap = None
+        self.frames = queue.Queue(maxsize=self.prefetch)
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.width = 0
+        self.height = 0
+
+    def _capture(self, hw_accel):
+        params = []
+        if hw_accel:
+            params += [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+        if self.threads > 0:
+            params += [cv2.CAP_PROP_N_THREADS, self.threads]
+        return cv2.VideoCapture(self.video_file, self.backend, params)
+
+    def open(self):
+        '''Opens the video and starts decoding. Returns True if successful.'''
+        self.cap = self._capture(self.hw_accel)
+        if not self.cap.isOpened() and self.hw_accel:
+            debug("Hardware-accelerated decoding unavailable. Using CPU.", "stderr")
+            self.cap.release()
+            self.cap = self._capture(False)
+        if not self.cap.isOpened():
+            return False
+
+        self.width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.scaled_size = None
+        if self.max_width > 0 and self.width > self.max_width:
+            self.scaled_size = (int(self.max_width), int(round(self.height*self.max_width/
+                                                                self.width)))
+            self.width, self.height = self.scaled_size
+
+        self.thread = threading.Thread(target=self._decodeLoop, name="video_decoder",
+                                       daemon=True)
+        self.thread.start()
+        return True
+
+    def isOpened(self):
+        return self.thread is not None
+
+    def _decodeLoop(self):
+        '''Background thread that decodes frames into the queue. None marks the end, and is
+           also put if decoding fails so that read never blocks forever.'''
+        try:
+            while not self.stop_event.is_set():
+                success, frame = self.cap.read()
+                if not success:
+                    break
+                if self.scaled_size is not None:
+                    frame = cv2.resize(frame, self.scaled_size, interpolation=cv2.INTER_AREA)
+                while not self.stop_event.is_set():
+                    try:
+                        self.frames.put(frame, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as err:
+            debug("Decoding {:s} failed: {:s}".format(self.video_file, str(err)), "stderr")
+        finally:
+            self.frames.put(None)
+
+    def read(self):
+        '''Returns the next success, frame like cv2.VideoCapture.read'''
+        frame = self.frames.get()
+        if frame is None:
+            # Leave the end marker for any further reads
+            self.frames.put(None)
+            return False, None
+        return True, frame
+
+    def release(self):
+        '''Stops decoding and releases the video'''
+        if self.thread is not None:
+            self.stop_event.set()
+            # Unblock the decoder thread if it is waiting on a full queue
+            while self.thread.is_alive():
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    pass
+                self.thread.join(0.01)
+            self.thread = None
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+
 class DetectorBase:
     '''Base class for object detection with OpenCV'''
 
+    # Attributes holding the loaded network, which detectors with the same networkKey can share
+    network_attributes = ("net", "ln")
+
+    # NetworkManager this detector is registered with, if any
+    network_manager = None
+
+    # Analysis sizes that setAnalysisSize can switch between, largest first. Empty if the
+    # analysis size can't be changed after the network is loaded.
+    analysis_sizes = []
+
+    # Whether detection confidences are meaningful scores rather than a fixed value
+    reports_confidence = True
+
     def __init__(self, name, config_path, model_path, identify_classes=[],
                  confidence_threshold=0.4, nms_threshold=0.4):
         '''Constructor for DetectorBase class
@@ -30,6 +260,15 @@ class DetectorBase:
         self.nms_threshold = nms_threshold
         self.model_name = "Base"
         self.swapRB = False
+        self.precision = "fp32"
+        self.input_buffer = None
+
+        # Total seconds spent detecting objects in frames, and the number of frames
+        self.detect_time = 0.
+        self.detect_count = 0
+
+        # VideoDecoder options for detectInVideo
+        self.decode_options = {}
 
         # Annotation settings
         self.name_fc = (255,255,255)
@@ -45,12 +284,17 @@ class DetectorBase:
     def readClasses(self, classes_path):
         '''Reads class list and assigns colors'''
         if not os.path.isfile(classes_path):
-            sys.stderr.write("Unable to open {:s}.\n".format(classes_path))
+            debug("Unable to open {:s}.".format(classes_path), "stderr")
             return False
 
         with open(classes_path, 'r') as f:
-            self.classes = f.read().splitlines()
+            self.setClasses(f.read().splitlines())
+        return True
 
+    def setClasses(self, classes):
+        '''Sets the class list, finds the IDs of the classes to identify, and assigns colors'''
+        self.classes = classes
+        self.identifyClassIDs = []
         if len(self.identifyClasses) == 0:
             self.identifyClasses = self.classes
 
@@ -59,7 +303,7 @@ class DetectorBase:
             try:
                 classID = self.classes.index(class_name)
             except ValueError:
-                sys.stderr.write("{:s} is not an available class. Skipping.\n".format(class_name))
+                debug("{:s} is not an available class. Skipping.".format(class_name), "stderr")
                 continue
             self.identifyClassIDs.append(classID)
 
@@ -72,11 +316,58 @@ class DetectorBase:
             for j in range(3):
                 self.classesColor[i,j] = rgba[j]*255
 
-        return True
-
     def initializeNetwork(self):
         raise NotImplementedError
 
+    def networkKey(self):
+        '''Returns a key identifying the network this detector loads. It changes if the model files
+           are changed on disk.'''
+        mtimes = tuple(os.path.getmtime(path) if os.path.isfile(path) else 0
+                       for path in [self.config_path, self.model_path])
+        return (type(self).__name__, self.config_path, self.model_path, mtimes, self.precision)
+
+    def getNetwork(self):
+        '''Returns the loaded network as a dict of attributes'''
+        return {attr: getattr(self, attr) for attr in self.network_attributes
+                if hasattr(self, attr)}
+
+    def setNetwork(self, network):
+        '''Uses a network from getNetwork of a detector with the same networkKey instead of
+           calling initializeNetwork. None unloads the network.'''
+        for attr in self.network_attributes:
+            if network is None:
+                if hasattr(self, attr):
+                    setattr(self, attr, None)
+            elif attr in network:
+                setattr(self, attr, network[attr])
+
+    def acquireNetwork(self):
+        '''Makes sure the network is loaded if it is managed by a NetworkManager, which may have
+           unloaded it. Returns False if it couldn't be loaded.'''
+        if self.network_manager is None:
+            return True
+        return self.network_manager.acquire(self)
+
+    def allocationCount(self):
+        '''Returns the number of input buffer allocations made so far. This should stop increasing
+           once frames of a steady size are being analyzed.'''
+        if self.input_buffer is None:
+            return 0
+        return self.input_buffer.allocations
+
+    def setAnalysisSize(self, size):
+        '''Changes the analysis size, e.g. to one of analysis_sizes. Detectors sharing the network
+           keep their own analysis size.'''
+        self.analysis_size = size
+        if self.input_buffer is not None:
+            self.input_buffer.resize(size)
+
+    def applyPrecision(self, net):
+        '''Runs fp16 variants with reduced-precision inference on the CPU if this version of
+           OpenCV supports it. Otherwise OpenCV converts the weights to fp32 as usual.'''
+        if self.precision == "fp16" and hasattr(cv2.dnn, "DNN_TARGET_CPU_FP16"):
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU_FP16)
+
     def detectObjects(self, frame):
         '''Derived classes must detect objects in a frame and return the following:
            classes:     detected class IDs from classes list
@@ -85,6 +376,14 @@ class DetectorBase:
            These must be filtered by confidence threshold and requested classes to identify.'''
         raise NotImplementedError
 
+    def detectObjectsBatch(self, frames):
+        '''Detects objects in a list of frames and returns a list of classes, confidences, boxes
+           for each frame. Derived classes whose networks accept batches can override this to
+           analyze all frames in one forward pass.'''
+        if not self.acquireNetwork():
+            return [([], [], []) for frame in frames]
+        return [self.detectObjects(frame) for frame in frames]
+
     def removeOverlapping(self, classes, confidences, boxes):
         '''Removes overlapping boxes with lower confidence using nms threshold. Returns
            new lists of classes, confidences, and boxes.'''
@@ -104,21 +403,30 @@ class DetectorBase:
             idx += 1
         return newclasses, newconfidences, newboxes
 
-    def detectInFrame(self, frame, annotate_name=True):
+    def detectInFrame(self, frame, annotate_name=True, copy_frame=True):
         '''Performs object detection on a frame and returns detection data along with
-           an annotated frame'''
+           an annotated frame. If not copy_frame, annotations are drawn on the frame itself.'''
 
         # We need to have at least one class to detect
         if len(self.identifyClassIDs) == 0:
-            sys.stderr.write("No classes to identify. Call readClasses first.\n")
+            debug("No classes to identify. Call readClasses first.", "stderr")
+            return [], [], [], None
+        if not self.acquireNetwork():
             return [], [], [], None
 
         # Do object detection and remove overlapping boxes
+        start = time.perf_counter()
         classes, confidences, boxes = self.detectObjects(frame)
         classes, confidences, boxes = self.removeOverlapping(classes, confidences, boxes)
+        self.detect_time += time.perf_counter() - start
+        self.detect_count += 1
+        zm_trace.mark("postprocessed", model=self.model_name, detections=len(classes))
 
         # Draw boxes with class label and confidence
-        annotated_frame = copy(frame)
+        if copy_frame:
+            annotated_frame = copy(frame)
+        else:
+            annotated_frame = frame
         for classID, confidence, box in zip(classes, confidences, boxes):
             left = box[0]
             top = box[1]
@@ -147,14 +455,15 @@ class DetectorBase:
         classes = []
         confidences = []
         frame = None
-        file_err_msg = "Error opening image file {:s}.\n".format(image_file)
+        file_err_msg = "Error opening image file {:s}.".format(image_file)
         if os.path.isfile(image_file):
             frame = cv2.imread(image_file)
+            zm_trace.mark("image_decoded", model=self.model_name)
         else:
-            sys.stderr.write(file_err_msg)
+            debug(file_err_msg, "stderr")
             return frame, classes, confidences
         if frame is None:
-            sys.stderr.write(file_err_msg)
+            debug(file_err_msg, "stderr")
             return frame, classes, confidences
 
         # Detect objects in the frame and annotate
@@ -162,7 +471,7 @@ class DetectorBase:
 
         # Return now if there was an issue
         if frame is None:
-            sys.stderr.write("There was a problem detecting objects.\n")
+            debug("There was a problem detecting objects.", "stderr")
             return frame, classes, confidences
 
         if show:
@@ -187,15 +496,16 @@ class DetectorBase:
         bestclasses = []
         bestconfidences = []
 
-        # Open video file
-        cap = cv2.VideoCapture(video_file)
-        if not cap.isOpened():
-            sys.stderr.write("Error opening video file {:s}.\n".format(video_file))
+        # Open video file. Frames are decoded in a separate thread while we analyze them.
+        cap = VideoDecoder(video_file, **self.decode_options)
+        if not cap.open():
+            debug("Error opening video file {:s}.".format(video_file), "stderr")
             return bestframe, bestclasses, bestconfidences
 
         success, frame = cap.read()
-        width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        zm_trace.mark("video_opened", model=self.model_name)
+        width = cap.width
+        height = cap.height
 
         bestframe = None
         bestscore = 0.
@@ -208,8 +518,10 @@ class DetectorBase:
             fps_label = "FPS: {:.1f}".format(fps)
             lastTime = currentTime
 
-            # Detect objects in the frame and annotate
-            classes, confidences, _, frame = self.detectInFrame(frame, annotate_name)
+            # Detect objects in the frame and annotate. Each frame read from the video is new, so
+            # there's no need to copy it first.
+            classes, confidences, _, frame = self.detectInFrame(frame, annotate_name,
+                                                                copy_frame=False)
 
             # Skip this frame if there was an issue
             if frame is None:
@@ -260,8 +572,18 @@ class DetectorDarknet(DetectorBase):
     '''OpenCV detection using Darknet models, e.g. Yolo.
        https://opencv-tutorial.readthedocs.io/en/latest/yolo/yolo.html'''
 
+    analysis_sizes = [(608,608), (416,416), (320,320)]
+
     def __init__(self, name, config_path, model_path, identify_classes=[],
-                 confidence_threshold=0.4, nms_threshold=0.4, analysis_size=(416,416)):
+                 confidence_threshold=0.4, nms_threshold=0.4, analysis_size=(416,416),
+                 tile_grid=(1,1), tile_overlap=0.2, letterbox=False):
+        '''tile_grid: (columns, rows) of overlapping tiles to split frames into. Each tile is
+                      analyzed at analysis_size in one batched forward pass, which keeps small
+                      objects detectable and avoids distorting the aspect ratio of wide frames.
+                      (1,1) analyzes the whole frame at once.
+           tile_overlap: fraction of the tile size by which neighboring tiles overlap
+           letterbox: preserve the aspect ratio of frames (or tiles) by padding instead of
+                      stretching them to the analysis size'''
         # Initialize parent class
         DetectorBase.__init__(self, name, config_path, model_path, identify_classes,
                               confidence_threshold, nms_threshold)
@@ -269,53 +591,120 @@ class DetectorDarknet(DetectorBase):
         self.swapRB = True
 
         # Options for analysis_size are: (320,320), (416,416), (608,608)
-        if analysis_size not in [(320,320), (416,416), (608,608)]:
-            sys.stderr.write("Unsupported analysis size. Using (416,416).\n")
+        if analysis_size not in self.analysis_sizes:
+            debug("Unsupported analysis size. Using (416,416).", "stderr")
             analysis_size = (416,416)
         self.analysis_size = analysis_size
 
+        # Tiling options
+        if tile_grid[0] < 1 or tile_grid[1] < 1:
+            debug("Tile grid must be at least (1,1). Using (1,1).", "stderr")
+            tile_grid = (1,1)
+        if tile_overlap < 0 or tile_overlap >= 1:
+            debug("Tile overlap must be at least 0 and less than 1. Using 0.2.", "stderr")
+            tile_overlap = 0.2
+        self.tile_grid = tile_grid
+        self.tile_overlap = tile_overlap
+
+        # Preallocated network input
+        self.input_buffer = InputBuffer(analysis_size, scale=1/255., swapRB=self.swapRB,
+                                        letterbox=letterbox)
+
     def initializeNetwork(self):
         # Check that the paths exist
         if not os.path.isfile(self.config_path):
-            sys.stderr.write("Error opening file: {:s} does not exist.\n".format(self.config_path))
+            debug("Error opening file: {:s} does not exist.".format(self.config_path), "stderr")
             return False
         if not os.path.isfile(self.model_path):
-            sys.stderr.write("Error opening file: {:s} does not exist.\n".format(self.model_path))
+            debug("Error opening file: {:s} does not exist.".format(self.model_path), "stderr")
             return False
         self.net = cv2.dnn.readNetFromDarknet(self.config_path, self.model_path)
+        self.applyPrecision(self.net)
         ln = self.net.getLayerNames()
         self.ln = [ln[i-1] for i in self.net.getUnconnectedOutLayers()]
 
         return True
 
-    def detectObjects(self, frame):
-        blob = cv2.dnn.blobFromImage(frame, 1/255., size=self.analysis_size, swapRB=self.swapRB,
-                                     crop=False)
-        self.net.setInput(blob)
-        cvOut = self.net.forward(self.ln)
-        # Combine the 3 output groups into 1 (10647, 85)
-        # large objects (507,85)
-        # medium objects (2028, 85)
-        # small objects (8112, 85)
-        cvOut = np.vstack(cvOut)
-
-        # Rearrange outputs into lists and filter
-        height, width = frame.shape[:2]
-        classes = []
-        confidences = []
-        boxes = []
+    def getTiles(self, width, height):
+        '''Returns a list of (left, top, width, height) tiles covering a frame of the given size'''
+        cols, rows = self.tile_grid
+        tw = int(round(width/(cols - (cols-1)*self.tile_overlap)))
+        th = int(round(height/(rows - (rows-1)*self.tile_overlap)))
+        tiles = []
+        for j in range(rows):
+            top = 0 if rows == 1 else int(round(j*(height-th)/(rows-1)))
+            for i in range(cols):
+                left = 0 if cols == 1 else int(round(i*(width-tw)/(cols-1)))
+                tiles.append((left, top, tw, th))
+        return tiles
+
+    def filterOutputs(self, cvOut, transform, offset, classes, confidences, boxes):
+        '''Filters network outputs for one frame or tile and appends detections to the lists.
+           transform is the input buffer transform for the frame or tile, and offset is the
+           (left, top) position of the tile in the frame.'''
+        sx, sy, left, top = transform
+        aw, ah = self.analysis_size
         for output in cvOut:
             scores = output[5:]
             classID = np.argmax(scores)
             confidence = scores[classID]
             if confidence >= self.conf_threshold and classID in self.identifyClassIDs:
-                x, y, w, h = output[:4]*np.array([width, height, width, height])
-                p0 = int(x - w//2), int(y - h//2)
-                p1 = int(x + w//2), int(y + h//2)
+                x = (output[0]*aw - left)/sx
+                y = (output[1]*ah - top)/sy
+                w = output[2]*aw/sx
+                h = output[3]*ah/sy
+                p0 = int(offset[0] + x - w//2), int(offset[1] + y - h//2)
                 boxes.append([*p0, int(w), int(h)])
                 confidences.append(float(confidence))
                 classes.append(classID)
-        return classes, confidences, boxes
+
+    def detectObjects(self, frame):
+        return self.detectObjectsBatch([frame])[0]
+
+    def detectObjectsBatch(self, frames):
+        if not self.acquireNetwork():
+            return [([], [], []) for frame in frames]
+
+        # Whole frames or tiles of each frame, all analyzed in one batched forward pass.
+        # Overlapping boxes from neighboring tiles are merged by the non-maximum suppression in
+        # detectInFrame, since all boxes are in frame coordinates.
+        images = []
+        owners = []
+        offsets = []
+        for idx, frame in enumerate(frames):
+            if self.tile_grid == (1,1):
+                images.append(frame)
+                owners.append(idx)
+                offsets.append((0, 0))
+                continue
+            height, width = frame.shape[:2]
+            for left, top, tw, th in self.getTiles(width, height):
+                images.append(frame[top:top+th, left:left+tw])
+                owners.append(idx)
+                offsets.append((left, top))
+        blob, transforms = self.input_buffer.prepare(images)
+        zm_trace.mark("preprocessed", images=len(images))
+        self.net.setInput(blob)
+        cvOut = self.net.forward(self.ln)
+        zm_trace.mark("inferred")
+
+        results = [([], [], []) for _ in frames]
+        nimages = len(images)
+        for idx in range(nimages):
+            # Outputs are (batch, boxes, 85) for batches, but some OpenCV versions stack the batch
+            # along the first axis instead. Stacking the 3 output groups gives all boxes for the
+            # image: large objects, medium objects, and small objects.
+            imageOut = []
+            for out in cvOut:
+                if out.ndim == 3:
+                    imageOut.append(out[idx])
+                else:
+                    n = out.shape[0]//nimages
+                    imageOut.append(out[idx*n:(idx+1)*n])
+            classes, confidences, boxes = results[owners[idx]]
+            self.filterOutputs(np.vstack(imageOut), transforms[idx], offsets[idx], classes,
+                               confidences, boxes)
+        return results
 
 
 class DetectorSSDMobileNetV3(DetectorBase):
@@ -330,22 +719,24 @@ class DetectorSSDMobileNetV3(DetectorBase):
     def initializeNetwork(self):
         # Check that the paths exist
         if not os.path.isfile(self.config_path):
-            sys.stderr.write("Error opening file: {:s} does not exist.\n".format(self.config_path))
+            debug("Error opening file: {:s} does not exist.".format(self.config_path), "stderr")
             return False
         if not os.path.isfile(self.model_path):
-            sys.stderr.write("Error opening file: {:s} does not exist.\n".format(self.model_path))
+            debug("Error opening file: {:s} does not exist.".format(self.model_path), "stderr")
             return False
         self.net = cv2.dnn_DetectionModel(self.model_path, self.config_path)
         self.net.setInputSize(320,320)
         self.net.setInputScale(1./127.5)
         self.net.setInputMean((127.5, 127.5, 127.5))
         self.net.setInputSwapRB(self.swapRB)
+        self.applyPrecision(self.net)
 
         return True
 
     def detectObjects(self, frame):
         # Detect objects
         allclasses, allconfidences, allboxes = self.net.detect(frame, self.conf_threshold)
+        zm_trace.mark("inferred")
 
         # Filter by confidence and classID
         classes = []
@@ -364,6 +755,8 @@ class DetectorTensorFlow(DetectorBase):
     '''OpenCV detection using various TensorFlow models.
     https://github.com/opencv/opencv/wiki/TensorFlow-Object-Detection-API'''
 
+    analysis_sizes = [(400,400), (300,300), (240,240)]
+
     def __init__(self, name, config_path, model_path, identify_classes=[],
                  confidence_threshold=0.4, nms_threshold=0.4, analysis_size=(300,300)):
         # Initialize parent class
@@ -375,23 +768,29 @@ class DetectorTensorFlow(DetectorBase):
         # Set analysis size
         self.analysis_size = analysis_size
 
+        # Preallocated network input
+        self.input_buffer = InputBuffer(analysis_size, swapRB=self.swapRB)
+
     def initializeNetwork(self):
         # Check that the paths exist
         if not os.path.isfile(self.config_path):
-            sys.stderr.write("Error opening file: {:s} does not exist.\n".format(self.config_path))
+            debug("Error opening file: {:s} does not exist.".format(self.config_path), "stderr")
             return False
         if not os.path.isfile(self.model_path):
-            sys.stderr.write("Error opening file: {:s} does not exist.\n".format(self.model_path))
+            debug("Error opening file: {:s} does not exist.".format(self.model_path), "stderr")
             return False
         self.net = cv2.dnn.readNetFromTensorflow(self.model_path, self.config_path)
+        self.applyPrecision(self.net)
 
         return True
 
     def detectObjects(self, frame):
         # Detect objects
-        blob = cv2.dnn.blobFromImage(frame, size=self.analysis_size, swapRB=self.swapRB, crop=False)
+        blob, _ = self.input_buffer.prepare([frame])
+        zm_trace.mark("preprocessed")
         self.net.setInput(blob)
         cvOut = self.net.forward()
+        zm_trace.mark("inferred")
 
         # Rearrange outputs into lists and filter
         height, width = frame.shape[:2]
@@ -416,6 +815,12 @@ class DetectorHOG(DetectorBase):
        neural-network based and is only configured to detect people.
        https://thedatafrog.com/en/articles/human-detection-video/'''
 
+    network_attributes = ("hog",)
+
+    analysis_sizes = [(800,600), (640,480), (480,360), (320,240)]
+
+    reports_confidence = False
+
     def __init__(self, name, analysis_size=(640,480), win_stride=(8,8), scale=1.05):
         # Initialize parent class
         DetectorBase.__init__(self, name, "", "", ["person"], 0.0, 0.0)
@@ -427,6 +832,20 @@ class DetectorHOG(DetectorBase):
         self.win_stride = win_stride
         self.scale = scale
 
+        # Preallocated resized and grayscale frames
+        self.resized = np.empty((analysis_size[1], analysis_size[0], 3), dtype=np.uint8)
+        self.gray = np.empty((analysis_size[1], analysis_size[0]), dtype=np.uint8)
+        self.allocations = 2
+
+    def allocationCount(self):
+        return self.allocations
+
+    def setAnalysisSize(self, size):
+        self.analysis_size = size
+        self.resized = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self.gray = np.empty((size[1], size[0]), dtype=np.uint8)
+        self.allocations += 2
+
     def readClasses(self, classes_path):
         '''HOG only identifies person class'''
         self.classes = ['person']
@@ -443,13 +862,16 @@ class DetectorHOG(DetectorBase):
         return True
 
     def detectObjects(self, frame):
-        # Resize and convert to grayscale
-        analysis_frame = cv2.resize(frame, self.analysis_size)
-        analysis_frame = cv2.cvtColor(analysis_frame, cv2.COLOR_RGB2GRAY)
+        # Resize and convert to grayscale in the preallocated buffers
+        cv2.resize(frame, self.analysis_size, dst=self.resized)
+        cv2.cvtColor(self.resized, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        analysis_frame = self.gray
+        zm_trace.mark("preprocessed")
 
         # Detect people and return bounding boxes
         boxes, weights = self.hog.detectMultiScale(analysis_frame, winStride=self.win_stride,
                                                    scale=self.scale)
+        zm_trace.mark("inferred")
 
         # Scale boxes back to full image size
         h, w = frame.shape[:2]
@@ -466,3 +888,375 @@ class DetectorHOG(DetectorBase):
         confidences = [1.0]*ndetections
 
         return classes, confidences, boxes
+
+
+class DetectorONNX(DetectorBase):
+    '''OpenCV detection using YOLO models exported to ONNX, e.g. YOLOv5, YOLOv8, or YOLO-NAS.
+       Frames are letterboxed to the analysis size to preserve aspect ratio. If use_onnxruntime
+       and the onnxruntime module is installed, it is used for inference instead of OpenCV.
+       Supported output formats:
+       yolov5:  (1, N, 5+nclasses) rows of cx, cy, w, h, objectness, class scores
+       yolov8:  (1, 4+nclasses, N) columns of cx, cy, w, h, class scores
+       yolonas: two outputs, (1, N, 4) boxes as x1, y1, x2, y2 and (1, N, nclasses) scores'''
+
+    network_attributes = ("net", "ln", "session", "input_name")
+
+    def __init__(self, name, model_path, identify_classes=[], confidence_threshold=0.4,
+                 nms_threshold=0.4, analysis_size=(640,640), output_format="yolov8",
+                 use_onnxruntime=False):
+        # Initialize parent class
+        DetectorBase.__init__(self, name, "", model_path, identify_classes,
+                              confidence_threshold, nms_threshold)
+        self.model_name = "ONNX"
+        self.swapRB = True
+
+        if output_format not in ["yolov5", "yolov8", "yolonas"]:
+            debug("Unsupported ONNX output format. Using yolov8.", "stderr")
+            output_format = "yolov8"
+        self.output_format = output_format
+        self.analysis_size = analysis_size
+        self.use_onnxruntime = use_onnxruntime
+        self.session = None
+
+        # Preallocated, letterboxed network input
+        self.input_buffer = InputBuffer(analysis_size, scale=1/255., swapRB=self.swapRB,
+                                        letterbox=True)
+
+    def initializeNetwork(self):
+        # Check that the path exists
+        if not os.path.isfile(self.model_path):
+            debug("Error opening file: {:s} does not exist.".format(self.model_path), "stderr")
+            return False
+        if self.use_onnxruntime:
+            try:
+                import onnxruntime
+                self.session = onnxruntime.InferenceSession(self.model_path,
+                                                            providers=["CPUExecutionProvider"])
+                self.input_name = self.session.get_inputs()[0].name
+                return True
+            except ImportError:
+                debug("onnxruntime is not installed. Using OpenCV instead.", "stderr")
+        self.net = cv2.dnn.readNetFromONNX(self.model_path)
+        self.applyPrecision(self.net)
+        self.ln = self.net.getUnconnectedOutLayersNames()
+
+        return True
+
+    def networkKey(self):
+        return DetectorBase.networkKey(self) + (self.use_onnxruntime,)
+
+    def forward(self, blob):
+        '''Runs the network and returns the list of outputs'''
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: blob})
+        self.net.setInput(blob)
+        return self.net.forward(self.ln)
+
+    def parseOutputs(self, outputs):
+        '''Returns boxes as (cx, cy, w, h) and class scores in analysis image coordinates'''
+        if self.output_format == "yolonas":
+            # Identify the box output by its last dimension
+            if outputs[0].shape[-1] == 4:
+                xyxy, scores = outputs[0][0], outputs[1][0]
+            else:
+                xyxy, scores = outputs[1][0], outputs[0][0]
+            cxcywh = np.empty_like(xyxy)
+            cxcywh[:,0:2] = (xyxy[:,0:2] + xyxy[:,2:4])/2
+            cxcywh[:,2:4] = xyxy[:,2:4] - xyxy[:,0:2]
+            return cxcywh, scores
+        out = outputs[0][0]
+        if self.output_format == "yolov8":
+            out = out.T
+            return out[:,:4], out[:,4:]
+        return out[:,:4], out[:,5:]*out[:,4:5]
+
+    def detectObjects(self, frame):
+        blob, transforms = self.input_buffer.prepare([frame])
+        scale, _, left, top = transforms[0]
+        zm_trace.mark("preprocessed")
+        outputs = self.forward(blob)
+        zm_trace.mark("inferred")
+        boxes_out, scores = self.parseOutputs(outputs)
+
+        # Filter by confidence and classID
+        classIDs = np.argmax(scores, axis=1)
+        confs = scores[np.arange(len(classIDs)), classIDs]
+        keep = (confs >= self.conf_threshold) & np.isin(classIDs, self.identifyClassIDs)
+
+        # Convert boxes back to frame coordinates
+        classes = []
+        confidences = []
+        boxes = []
+        for box, classID, confidence in zip(boxes_out[keep], classIDs[keep], confs[keep]):
+            cx, cy, w, h = box
+            x0 = (cx - w/2 - left)/scale
+            y0 = (cy - h/2 - top)/scale
+            boxes.append([int(x0), int(y0), int(w/scale), int(h/scale)])
+            confidences.append(float(confidence))
+            classes.append(int(classID))
+        return classes, confidences, boxes
+
+
+class DetectorRemote(DetectorBase):
+    '''Detection on a zm_inference_server, which may be shared by many monitors and hosts.
+       Frames are sent JPEG-encoded, and the server runs them with its own detector for the given
+       model, batched with requests from other clients. The server returns all detections above
+       its own confidence threshold, so class filtering, this detector's confidence threshold,
+       and non-maximum suppression are applied locally.'''
+
+    network_attributes = ("server_classes",)
+
+    def __init__(self, name, server_url, model, identify_classes=[], confidence_threshold=0.4,
+                 nms_threshold=0.4, timeout=30., jpeg_quality=90):
+        # Initialize parent class
+        DetectorBase.__init__(self, name, "", "", identify_classes, confidence_threshold,
+                              nms_threshold)
+        self.model_name = "Remote {:s}".format(model)
+        self.server_url = server_url.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.jpeg_quality = jpeg_quality
+        self.session = requests.Session()
+        self.server_classes = []
+
+    def initializeNetwork(self):
+        '''Checks that the server is up and serves the model, and gets its class list'''
+        try:
+            r = self.session.get(self.server_url + "/info", timeout=self.timeout)
+            models = r.json()["models"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+            debug("Unable to get info from inference server {:s}: {:s}" \
+                  .format(self.server_url, str(err)), "stderr")
+            return False
+        if self.model not in models:
+            debug("Inference server {:s} does not serve {:s}.".format(self.server_url,
+                  self.model), "stderr")
+            return False
+        self.server_classes = models[self.model]["classes"]
+        return True
+
+    def networkKey(self):
+        return (type(self).__name__, self.server_url, self.model)
+
+    def readClasses(self, classes_path):
+        '''Classes come from the server'''
+        self.setClasses(self.server_classes)
+        return True
+
+    def detectObjects(self, frame):
+        classes = []
+        confidences = []
+        boxes = []
+        success, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY,
+                                                         self.jpeg_quality])
+        if not success:
+            debug("Unable to encode frame for inference server.", "stderr")
+            return classes, confidences, boxes
+        zm_trace.mark("preprocessed", bytes=len(encoded))
+        try:
+            r = self.session.post(self.server_url + "/detect", params={"model": self.model},
+                                  data=encoded.tobytes(), headers={"Content-Type": "image/jpeg"},
+                                  timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            debug("Inference server request failed: {:s}".format(str(err)), "stderr")
+            return classes, confidences, boxes
+        zm_trace.mark("inferred")
+        if not r.ok:
+            debug("Inference server returned {:d}.".format(r.status_code), "stderr")
+            return classes, confidences, boxes
+
+        # Filter by confidence and classID
+        data = r.json()
+        for classID, confidence, box in zip(data["classes"], data["confidences"], data["boxes"]):
+            if confidence >= self.conf_threshold and classID in self.identifyClassIDs:
+                classes.append(classID)
+                confidences.append(confidence)
+                boxes.append(box)
+        return classes, confidences, boxes
+
+
+class DetectorCascade:
+    '''Two-stage detection. A cheap first stage (e.g. HOG or MobileNetV3) always runs, and the
+       expensive second stage (e.g. Darknet) runs only when the first stage result is ambiguous:
+       1. The best first stage confidence falls in the uncertain band [uncertain_low,
+          uncertain_high).
+       2. The first stage finds nothing in an event that ZoneMinder scored at least
+          escalate_score.
+       A first stage without real confidences (HOG) has all of its detections checked by the
+       second stage. Detections the first stage decides on alone are also held to the second
+       stage's confidence threshold, which should be within the uncertain band.
+       Both stages must be fully set up (initializeNetwork and readClasses) before use. The
+       first stage should be constructed with confidence_threshold = uncertain_low so that it
+       reports detections in the uncertain band. The model name of the stage that made the final
+       decision is saved in decided_by after each detection.'''
+
+    def __init__(self, name, first_stage, second_stage, uncertain_low=0.3, uncertain_high=0.7,
+                 escalate_score=50):
+        self.name = name
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+        self.uncertain_low = uncertain_low
+        self.uncertain_high = uncertain_high
+        self.escalate_score = escalate_score
+        self.model_name = "Cascade"
+        self.conf_threshold = second_stage.conf_threshold
+        self.decided_by = ""
+
+    def needSecondStage(self, confidences, event_score):
+        '''Returns True if the first stage result is ambiguous enough to run the second stage'''
+        if confidences is None or len(confidences) == 0:
+            return event_score >= self.escalate_score
+        if not getattr(self.first_stage, "reports_confidence", True):
+            return True
+        maxconfidence = max(confidences)
+        return maxconfidence >= self.uncertain_low and maxconfidence < self.uncertain_high
+
+    def applyThreshold(self, classes, confidences):
+        '''Drops first stage detections below the confidence threshold. Returns classes,
+           confidences.'''
+        keep = [idx for idx, confidence in enumerate(confidences)
+                if confidence >= self.conf_threshold]
+        return [classes[idx] for idx in keep], [confidences[idx] for idx in keep]
+
+    def detectInImage(self, image_file, annotate_name=True, show=True, event_score=0):
+        '''Performs cascaded object detection on an image file. Returns the same data as
+           DetectorBase.detectInImage.'''
+        self.decided_by = self.first_stage.model_name
+        frame, classes, confidences = self.first_stage.detectInImage(image_file, annotate_name,
+                                                                     show=False)
+        if frame is not None and self.needSecondStage(confidences, event_score):
+            self.decided_by = self.second_stage.model_name
+            frame, classes, confidences = self.second_stage.detectInImage(image_file,
+                                                                          annotate_name, show)
+            return frame, classes, confidences
+        if frame is not None:
+            classes, confidences = self.applyThreshold(classes, confidences)
+        if show and frame is not None:
+            cv2.imshow("Result", frame)
+            cv2.waitKey(0)
+            cv2.destroyAllWindows()
+        return frame, classes, confidences
+
+    def detectInVideo(self, video_file, annotate_name=True, show=True, annotate_fps=True,
+                      return_first_detection=False, event_score=0):
+        '''Performs cascaded object detection on a video. Returns the same data as
+           DetectorBase.detectInVideo.'''
+        self.decided_by = self.first_stage.model_name
+        bestframe, classes, confidences = self.first_stage.detectInVideo(video_file,
+                                          annotate_name, show, annotate_fps, return_first_detection)
+        if self.needSecondStage(confidences, event_score):
+            self.decided_by = self.second_stage.model_name
+            bestframe, classes, confidences = self.second_stage.detectInVideo(video_file,
+                                              annotate_name, show, annotate_fps,
+                                              return_first_detection)
+        elif confidences is not None:
+            classes, confidences = self.applyThreshold(classes, confidences)
+        return bestframe, classes, confidences
+
+
+# Registry of detector backends by detection_model name. Each factory is called as
+# factory(name, st, detect_classes, confidence_threshold, options), where st is the Settings
+# object and options is a dict of optional per-monitor settings, and returns the detector (not yet
+# initialized) and the path of its classes file. Plugin modules can add their own backends by
+# calling registerDetectorBackend when they are imported.
+detector_backends = {}
+
+def registerDetectorBackend(model_name, factory):
+    '''Registers a factory function for a detection_model name'''
+    detector_backends[model_name] = factory
+
+def availableDetectorBackends():
+    '''Returns the list of registered detection_model names'''
+    return sorted(detector_backends.keys())
+
+def createDetector(model_name, name, st, detect_classes, confidence_threshold, options={},
+                   networks=None):
+    '''Creates, initializes, and reads classes for a detector of the given detection_model.
+       networks is an optional NetworkManager. The detector is registered with it, so an already
+       loaded network with the same key is shared instead of loaded again, and the network can
+       be unloaded and reloaded to stay within the manager's memory budget. Returns None on
+       error.'''
+    if model_name not in detector_backends:
+        debug("{:s} is not a valid detection model. Choices are: {:s}." \
+              .format(model_name, ", ".join(availableDetectorBackends())), "stderr")
+        return None
+    detector, classes_path = detector_backends[model_name](name, st, detect_classes,
+                                                           confidence_threshold, options)
+    if detector is None:
+        return None
+    if networks is not None:
+        if not networks.register(detector):
+            return None
+    elif not detector.initializeNetwork():
+        return None
+    if not detector.readClasses(classes_path):
+        return None
+    if hasattr(st, "video_decode_options"):
+        detector.decode_options = st.video_decode_options
+    return detector
+
+def _variantModelPath(st, section, options):
+    '''Returns the model path for the model_variant in options, or None if not configured'''
+    variant = options.get("model_variant", "fp32")
+    path = st.model_variants[section].get(variant)
+    if path is None:
+        debug("No {:s} variant configured for {:s}.".format(variant, section), "stderr")
+    return path
+
+def _setPrecision(detector, options):
+    detector.precision = options.get("model_variant", "fp32")
+    return detector
+
+def _createDarknet(name, st, detect_classes, confidence_threshold, options):
+    model_path = _variantModelPath(st, "Darknet", options)
+    if model_path is None:
+        return None, ""
+    detector = DetectorDarknet(name, st.darknet_config, model_path, detect_classes,
+                               confidence_threshold, analysis_size=st.darknet_analysis_size,
+                               tile_grid=options.get("tile_grid", (1,1)),
+                               tile_overlap=options.get("tile_overlap", 0.2),
+                               letterbox=st.darknet_letterbox)
+    return _setPrecision(detector, options), st.darknet_classes
+
+def _createMobileNetV3(name, st, detect_classes, confidence_threshold, options):
+    model_path = _variantModelPath(st, "MobileNetV3", options)
+    if model_path is None:
+        return None, ""
+    detector = DetectorSSDMobileNetV3(name, st.mobilenet_config, model_path, detect_classes,
+                                      confidence_threshold)
+    return _setPrecision(detector, options), st.mobilenet_classes
+
+def _createInceptionV2(name, st, detect_classes, confidence_threshold, options):
+    model_path = _variantModelPath(st, "InceptionV2", options)
+    if model_path is None:
+        return None, ""
+    detector = DetectorTensorFlow(name, st.inception_config, model_path, detect_classes,
+                                  confidence_threshold, analysis_size=st.inception_analysis_size)
+    return _setPrecision(detector, options), st.inception_classes
+
+def _createHOG(name, st, detect_classes, confidence_threshold, options):
+    detector = DetectorHOG(name, st.hog_analysis_size, st.hog_winstride, st.hog_scale)
+    return detector, ""
+
+def _createONNX(name, st, detect_classes, confidence_threshold, options):
+    model_path = _variantModelPath(st, "ONNX", options)
+    if model_path is None:
+        return None, ""
+    detector = DetectorONNX(name, model_path, detect_classes, confidence_threshold,
+                            analysis_size=st.onnx_analysis_size,
+                            output_format=st.onnx_output_format,
+                            use_onnxruntime=st.onnx_use_onnxruntime)
+    return _setPrecision(detector, options), st.onnx_classes
+
+def _createRemote(name, st, detect_classes, confidence_threshold, options):
+    detector = DetectorRemote(name, st.inference_server_url, st.inference_server_model,
+                              detect_classes, confidence_threshold,
+                              timeout=st.inference_server_timeout)
+    return detector, ""
+
+registerDetectorBackend("Darknet", _createDarknet)
+registerDetectorBackend("MobileNetV3", _createMobileNetV3)
+registerDetectorBackend("InceptionV2", _createInceptionV2)
+registerDetectorBackend("HOG", _createHOG)
+registerDetectorBackend("ONNX", _createONNX)
+registerDetectorBackend("Remote", _createRemote)
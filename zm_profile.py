@@ -0,0 +1,96 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import zm_util
+
+debug = zm_util.module_debug(__name__)
+
+class Profiler:
+    '''cProfile session that can be started and stopped at any time, e.g. from a signal handler
+       flag. It profiles the thread that starts it. Nothing is profiled in between sessions, so
+       it costs nothing while off.'''
+
+    def __init__(self, directory="/tmp", name="zm_notifier"):
+        '''directory: where stats are written when a session stops
+           name: prefix of the file names'''
+        self.directory = directory
+        self.name = name
+        self.profile = None
+        self.start = 0.
+
+    def active(self):
+        return self.profile is not None
+
+    def toggle(self):
+        '''Starts a session, or stops the running one and writes its stats. Returns the path of
+           the stats file written, or None when starting.'''
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.start = time.time()
+            self.profile.enable()
+            debug("Profiling started.")
+            return None
+        self.profile.disable()
+        profile = self.profile
+        self.profile = None
+        return self.write(profile, time.time() - self.start)
+
+    def write(self, profile, duration):
+        '''Writes binary stats (for pstats, snakeviz, etc.) and a text summary of the functions
+           with the highest cumulative and own time. Returns the path of the binary stats.'''
+        path = os.path.join(self.directory, "{:s}-{:s}.prof".format(self.name,
+                            time.strftime("%Y%m%d-%H%M%S")))
+        try:
+            profile.dump_stats(path)
+            summary = io.StringIO()
+            summary.write("Profiled for {:.1f} s.\n\n".format(duration))
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats("cumulative").print_stats(40)
+            stats.sort_stats("tottime").print_stats(40)
+            with open(os.path.splitext(path)[0] + ".txt", "w") as f:
+                f.write(summary.getvalue())
+        except IOError as err:
+            debug("Unable to write profile to {:s}: {:s}".format(path, str(err)), "stderr")
+            return None
+        debug("Profiled for {:.1f} s. Stats written to {:s}.".format(duration, path))
+        return path
+
+
+def thread_stacks():
+    '''Returns the current stack of every thread as text'''
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append("Thread {:s} ({:d}):\n".format(names.get(ident, "unknown"), ident))
+        lines += traceback.format_stack(frame)
+        lines.append("\n")
+    return "".join(lines)
+
+
+def write_state(directory, name, sections):
+    '''Writes the stacks of all threads followed by sections of state to a file. sections is a
+       list of (title, list of lines), where a line can also be a dict of names and values.
+       Returns the path of the file, or None on error.'''
+    path = os.path.join(directory, "{:s}-state-{:s}.txt".format(name,
+                        time.strftime("%Y%m%d-%H%M%S")))
+    try:
+        with open(path, "w") as f:
+            f.write(thread_stacks())
+            for title, lines in sections:
+                f.write("{:s}:\n".format(title))
+                for line in lines:
+                    if isinstance(line, dict):
+                        line = ", ".join("{:s}={}".format(key, value)
+                                         for key, value in line.items())
+                    f.write("  {:s}\n".format(line))
+                f.write("\n")
+    except IOError as err:
+        debug("Unable to write state to {:s}: {:s}".format(path, str(err)), "stderr")
+        return None
+    debug("State written to {:s}.".format(path))
+    return path
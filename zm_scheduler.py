@@ -0,0 +1,93 @@
+import heapq
+import time
+
+class PollScheduler:
+    '''Priority queue of tasks ordered by the time they are next due. Tasks are identified by a
+       name and an optional monitor. Event polls for each monitor use an adaptive interval:
+       polling is fast after activity and backs off exponentially while the monitor is quiet.'''
+
+    def __init__(self, min_interval=5, max_interval=60, backoff=2.0):
+        '''min_interval: poll interval in seconds right after activity
+           max_interval: ceiling for the poll interval of quiet monitors
+           backoff: factor by which the poll interval grows after each quiet poll'''
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = max(backoff, 1.0)
+        self.queue = []
+        self.counter = 0
+        self.poll_intervals = {}
+
+    def schedule(self, task, monitor=None, delay=0.):
+        '''Schedules a task to run after delay seconds'''
+        heapq.heappush(self.queue, [time.time()+delay, self.counter, task, monitor])
+        self.counter += 1
+
+    def scheduleOnce(self, task, monitor=None, delay=0.):
+        '''Schedules a task to run after delay seconds unless it is already scheduled to run by
+           then'''
+        due = time.time() + delay
+        for item in self.queue:
+            if item[2] == task and item[3] is monitor and item[0] <= due:
+                return
+        self.schedule(task, monitor, delay)
+
+    def isScheduled(self, task, monitor=None):
+        '''Returns True if a task is scheduled for a monitor'''
+        return any(item[2] == task and item[3] is monitor for item in self.queue)
+
+    def next(self):
+        '''Waits until the next task is due, removes it from the queue, and returns its name and
+           monitor. Returns None, None if the queue is empty.'''
+        if len(self.queue) == 0:
+            return None, None
+        due, _, task, monitor = heapq.heappop(self.queue)
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        return task, monitor
+
+    def isDue(self):
+        '''Returns True if a task is due now'''
+        return len(self.queue) > 0 and self.queue[0][0] <= time.time()
+
+    def pollInterval(self, monitor):
+        '''Returns the current poll interval for a monitor'''
+        return self.poll_intervals.get(monitor.id, self.min_interval)
+
+    def schedulePoll(self, monitor, activity):
+        '''Schedules the next event poll for a monitor. If there was activity, the poll interval is
+           reset to the minimum. Otherwise it is increased by the backoff factor.'''
+        if activity:
+            interval = self.min_interval
+        else:
+            interval = min(self.pollInterval(monitor)*self.backoff, self.max_interval)
+        self.poll_intervals[monitor.id] = interval
+        self.schedule("poll", monitor, interval)
+
+    def resetPolls(self, monitor=None):
+        '''Resets poll intervals to the minimum and makes polls due now, either for the given
+           monitor or for all monitors'''
+        now = time.time()
+        for item in self.queue:
+            if item[2] == "poll" and (monitor is None or item[3] is monitor):
+                self.poll_intervals.pop(item[3].id, None)
+                item[0] = now
+        heapq.heapify(self.queue)
+
+    def removeMonitor(self, monitor):
+        '''Removes all tasks for a monitor'''
+        self.queue = [item for item in self.queue if item[3] is not monitor]
+        heapq.heapify(self.queue)
+
+    def snapshot(self):
+        '''Returns the scheduled tasks in the order they are due, as dicts of task name, monitor
+           name, seconds until due (negative if overdue), and poll interval for polls'''
+        now = time.time()
+        tasks = []
+        for due, _, task, monitor in sorted(self.queue, key=lambda item: item[:2]):
+            item = {'task': task, 'monitor': monitor.name if monitor is not None else "",
+                    'due_in': round(due - now, 1)}
+            if task == "poll":
+                item['interval'] = self.pollInterval(monitor)
+            tasks.append(item)
+        return tasks
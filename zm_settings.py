@@ -5,6 +5,8 @@ import os
 import sys
 import zm_util
 
+debug = zm_util.module_debug(__name__)
+
 class Settings:
     def __init__(self, config_file="/etc/zm_notifier.cfg"):
         '''Read and store static sections (all sections except monitors) from config file. Monitors
@@ -14,18 +16,21 @@ class Settings:
         try:
             f = open(self.config_file)
         except IOError:
-            zm_util.debug("Error opening {:s}".format(self.config_file), "stderr")
+            debug("Error opening {:s}".format(self.config_file), "stderr")
             sys.exit(1)
         f.close()
         if len(config.read(self.config_file)) == 0:
-            zm_util.debug("Error parsing {:s}".format(self.config_file), "stderr")
+            debug("Error parsing {:s}".format(self.config_file), "stderr")
             sys.exit(1)
 
+        # Raw contents of all sections, used to find what changed when the config is reloaded
+        self.sections = {section: dict(config.items(section)) for section in config.sections()}
+
         # Check for required sections in config file
         for section in ["ZoneMinderAPI", "Notification", "Daemon"]:
             if not config.has_section(section):
-                zm_util.debug("No section {:s} found in {:s}".format(section, self.config_file),
-                              "stderr")
+                debug("No section {:s} found in {:s}".format(section, self.config_file),
+                      "stderr")
                 sys.exit(1)
 
         # ZoneMinderAPI settings
@@ -36,6 +41,14 @@ class Settings:
         self.password = zm_util.get_from_config(config, section, "password")
         self.verify_ssl = zm_util.get_bool_from_config(config, section, "verify_ssl",
                                                        required=False, default=True)
+        daemon_status_ttl = zm_util.get_int_from_config(config, section, "daemon_status_ttl",
+                                                        required=False, default=10)
+        run_states_ttl = zm_util.get_int_from_config(config, section, "run_states_ttl",
+                                                     required=False, default=300)
+        monitors_ttl = zm_util.get_int_from_config(config, section, "monitors_ttl",
+                                                   required=False, default=10)
+        self.api_cache_ttl = {"daemonCheck": daemon_status_ttl, "states": run_states_ttl,
+                              "monitors": monitors_ttl}
 
         # Notification settings
         section = "Notification"
@@ -52,6 +65,10 @@ class Settings:
                                                              required=False, default=False)
         self.no_notification_runstate = zm_util.get_from_config(config, section,
                                              "no_notification_runstate", required=False, default="")
+        self.coalesce_window = zm_util.get_float_from_config(config, section, "coalesce_window",
+                                                             required=False, default=0.)
+        self.coalesce_max_delay = zm_util.get_float_from_config(config, section,
+                                             "coalesce_max_delay", required=False, default=0.)
 
         # Convert email addresses and attachment settings to lists
         if addresses != "":
@@ -59,7 +76,7 @@ class Settings:
             attach_image = zm_util.get_from_config(config, section, "attach_image") \
                            .replace(" ","").split(",")
             if len(addresses) != len(attach_image):
-                zm_util.debug("Must specify attach_image for each address", "stderr")
+                debug("Must specify attach_image for each address", "stderr")
                 sys.exit(1)
         else:
             addresses = []
@@ -75,7 +92,7 @@ class Settings:
             elif attach_image[i].lower() in valid_no:
                 to_address["image"] = False
             else:
-                zm_util.debug("attach_image must be Yes/No", "stderr")
+                debug("attach_image must be Yes/No", "stderr")
                 sys.exit(1)
             self.to_addresses.append(to_address)
 
@@ -91,12 +108,111 @@ class Settings:
             self.pushover_data = {"api_token": pushover_api_token, "user_key": pushover_user_key,
                                   "attach_image": pushover_attach_image}
 
+        # Email transport. With smtp, email is sent directly over a persistent SMTP connection
+        # instead of with mutt.
+        self.email_transport = zm_util.get_from_config(config, section, "email_transport",
+                                                       required=False, default="mutt").lower()
+        if self.email_transport not in ["mutt", "smtp"]:
+            debug("email_transport must be mutt or smtp.", "stderr")
+            sys.exit(1)
+        self.smtp_settings = None
+        if self.email_transport == "smtp":
+            security = zm_util.get_from_config(config, section, "smtp_security", required=False,
+                                               default="starttls").lower()
+            if security not in ["starttls", "ssl", "none"]:
+                debug("smtp_security must be starttls, ssl, or none.", "stderr")
+                sys.exit(1)
+            self.smtp_settings = {
+                "host": zm_util.get_from_config(config, section, "smtp_host"),
+                "port": zm_util.get_int_from_config(config, section, "smtp_port",
+                                                    required=False, default=587),
+                "security": security,
+                "username": zm_util.get_from_config(config, section, "smtp_username",
+                                                    required=False, default=""),
+                "password": zm_util.get_from_config(config, section, "smtp_password",
+                                                    required=False, default=""),
+                "sender": zm_util.get_from_config(config, section, "smtp_from", required=False,
+                                                  default=""),
+                "timeout": zm_util.get_float_from_config(config, section, "smtp_timeout",
+                                                         required=False, default=10.),
+                "idle_timeout": zm_util.get_float_from_config(config, section,
+                                             "smtp_idle_timeout", required=False, default=60.)}
+
         # Daemon settings
         section = "Daemon"
         self.running_timeout = zm_util.get_int_from_config(config, section, "running_timeout",
                                                            required=False, default=5)
         self.stopped_timeout = zm_util.get_int_from_config(config, section, "stopped_timeout",
                                                            required=False, default=30)
+        self.max_poll_interval = zm_util.get_int_from_config(config, section,
+                                             "max_poll_interval", required=False, default=60)
+        self.poll_backoff = zm_util.get_float_from_config(config, section, "poll_backoff",
+                                                          required=False, default=2.0)
+        self.status_check_interval = zm_util.get_int_from_config(config, section,
+                                             "status_check_interval", required=False, default=60)
+        # Monitor statuses are read once per status check, so a longer cache time would make the
+        # check reuse a stale status and miss monitors becoming active or inactive
+        self.api_cache_ttl["monitors"] = min(self.api_cache_ttl["monitors"],
+                                             self.status_check_interval)
+        self.max_queue_depth = zm_util.get_int_from_config(config, section, "max_queue_depth",
+                                                           required=False, default=100)
+        self.frame_poll_interval = zm_util.get_float_from_config(config, section,
+                                             "frame_poll_interval", required=False, default=0.5)
+        detector_plugins = zm_util.get_from_config(config, section, "detector_plugins",
+                                                   required=False, default="")
+        self.detector_plugins = []
+        if detector_plugins != "":
+            self.detector_plugins = detector_plugins.replace(" ","").split(",")
+        self.trace_log = zm_util.get_from_config(config, section, "trace_log", required=False,
+                                                 default="")
+        self.slow_event_threshold = zm_util.get_float_from_config(config, section,
+                                             "slow_event_threshold", required=False, default=30.)
+        self.model_memory_budget = zm_util.get_int_from_config(config, section,
+                                             "model_memory_budget", required=False, default=0)
+        self.model_idle_timeout = zm_util.get_int_from_config(config, section,
+                                             "model_idle_timeout", required=False, default=0)
+        self.prewarm_models = zm_util.get_bool_from_config(config, section, "prewarm_models",
+                                                           required=False, default=True)
+        self.log_level = zm_util.get_from_config(config, section, "log_level", required=False,
+                                                 default="info").lower()
+        if self.log_level not in ["debug", "info", "warning", "error"]:
+            debug("log_level must be debug, info, warning, or error.", "stderr")
+            sys.exit(1)
+        self.log_json = zm_util.get_bool_from_config(config, section, "log_json", required=False,
+                                                     default=False)
+        self.log_rate_limit = zm_util.get_float_from_config(config, section, "log_rate_limit",
+                                                            required=False, default=60.)
+        self.log_queue_size = zm_util.get_int_from_config(config, section, "log_queue_size",
+                                                          required=False, default=10000)
+        self.profile_dir = zm_util.get_from_config(config, section, "profile_dir",
+                                                   required=False, default="/tmp")
+        self.event_source = zm_util.get_from_config(config, section, "event_source",
+                                                    required=False, default="api").lower()
+        if self.event_source not in ["api", "database"]:
+            debug("event_source must be api or database.", "stderr")
+            sys.exit(1)
+
+        # Direct database access for event_source database
+        section = "Database"
+        self.database_settings = {"driver": "mysql", "host": "localhost", "port": 3306,
+                                  "user": "zmuser", "password": "zmpass", "database": "zm",
+                                  "path": "", "events_dir": "/var/cache/zoneminder/events",
+                                  "pool_size": 2}
+        if config.has_section(section):
+            opts = self.database_settings
+            opts["driver"] = zm_util.get_from_config(config, section, "driver", required=False,
+                                                     default=opts["driver"]).lower()
+            if opts["driver"] not in ["mysql", "sqlite"]:
+                debug("Database:driver must be mysql or sqlite.", "stderr")
+                sys.exit(1)
+            for key in ["host", "user", "password", "database", "path", "events_dir"]:
+                opts[key] = zm_util.get_from_config(config, section, key, required=False,
+                                                    default=opts[key])
+            opts["port"] = zm_util.get_int_from_config(config, section, "port", required=False,
+                                                       default=opts["port"])
+            opts["pool_size"] = zm_util.get_int_from_config(config, section, "pool_size",
+                                                            required=False,
+                                                            default=opts["pool_size"])
 
         # Detector settings
         section = "Darknet"
@@ -106,6 +222,7 @@ class Settings:
         self.darknet_classes = os.path.join("/usr", "share", "zm-notifier", "coco.names.80")
         darknet_width = 416
         darknet_height = 416
+        self.darknet_letterbox = False
         if config.has_section(section):
             self.darknet_model = zm_util.get_from_config(config, section, "model_path",
                                                          required=False, default=self.darknet_model)
@@ -117,7 +234,11 @@ class Settings:
                                                         required=False, default=darknet_width)
             darknet_height = zm_util.get_int_from_config(config, section, "analysis_height",
                                                         required=False, default=darknet_height)
+            self.darknet_letterbox = zm_util.get_bool_from_config(config, section, "letterbox",
+                                                                  required=False, default=False)
         self.darknet_analysis_size = (darknet_width,darknet_height)
+        self.model_variants = {}
+        self.readModelVariants(config, section, self.darknet_model, ["fp16"])
 
         section = "MobileNetV3"
         datadir = "ssd_mobilenet_v3_large_coco_2020_01_14"
@@ -133,6 +254,7 @@ class Settings:
                                                       required=False, default=self.mobilenet_config)
             self.mobilenet_classes = zm_util.get_from_config(config, section, "classes_path",
                                                      required=False, default=self.mobilenet_classes)
+        self.readModelVariants(config, section, self.mobilenet_model, ["fp16"])
 
         section = "InceptionV2"
         datadir = "ssd_inception_v2_coco_2017_11_17"
@@ -155,6 +277,7 @@ class Settings:
             inception_height = zm_util.get_int_from_config(config, section, "analysis_height",
                                                            required=False, default=inception_height)
         self.inception_analysis_size = (inception_width,inception_height)
+        self.readModelVariants(config, section, self.inception_model, ["fp16"])
 
         section = "HOG"
         hog_width = 640
@@ -176,6 +299,78 @@ class Settings:
         self.hog_analysis_size = (hog_width,hog_height)
         self.hog_winstride = (hog_stridex,hog_stridey)
 
+        # Inference server settings for detection_model Remote
+        section = "InferenceServer"
+        self.inference_server_url = "http://127.0.0.1:8765"
+        self.inference_server_model = "Darknet"
+        self.inference_server_timeout = 30.
+        if config.has_section(section):
+            self.inference_server_url = zm_util.get_from_config(config, section, "url",
+                                            required=False, default=self.inference_server_url)
+            self.inference_server_model = zm_util.get_from_config(config, section, "model",
+                                            required=False, default=self.inference_server_model)
+            self.inference_server_timeout = zm_util.get_float_from_config(config, section,
+                                   "timeout", required=False, default=self.inference_server_timeout)
+
+        # Video decoding settings for detection in event videos
+        section = "Video"
+        self.video_decode_options = {"prefetch": 8, "backend": "any", "threads": 0,
+                                     "hw_accel": False, "max_width": 0}
+        if config.has_section(section):
+            opts = self.video_decode_options
+            opts["prefetch"] = zm_util.get_int_from_config(config, section, "prefetch_frames",
+                                                           required=False, default=opts["prefetch"])
+            opts["backend"] = zm_util.get_from_config(config, section, "decode_backend",
+                                                      required=False, default=opts["backend"])
+            opts["threads"] = zm_util.get_int_from_config(config, section, "decode_threads",
+                                                          required=False, default=opts["threads"])
+            opts["hw_accel"] = zm_util.get_bool_from_config(config, section, "hw_accel",
+                                                            required=False, default=False)
+            opts["max_width"] = zm_util.get_int_from_config(config, section, "decode_max_width",
+                                                        required=False, default=opts["max_width"])
+
+        section = "ONNX"
+        self.onnx_model = os.path.join("/usr", "share", "zm-notifier", "yolov8", "yolov8n.onnx")
+        self.onnx_classes = os.path.join("/usr", "share", "zm-notifier", "coco.names.80")
+        self.onnx_output_format = "yolov8"
+        self.onnx_use_onnxruntime = False
+        onnx_width = 640
+        onnx_height = 640
+        if config.has_section(section):
+            self.onnx_model = zm_util.get_from_config(config, section, "model_path",
+                                                      required=False, default=self.onnx_model)
+            self.onnx_classes = zm_util.get_from_config(config, section, "classes_path",
+                                                        required=False, default=self.onnx_classes)
+            self.onnx_output_format = zm_util.get_from_config(config, section, "output_format",
+                                                    required=False, default=self.onnx_output_format)
+            self.onnx_use_onnxruntime = zm_util.get_bool_from_config(config, section,
+                                      "use_onnxruntime", required=False, default=False)
+            onnx_width = zm_util.get_int_from_config(config, section, "analysis_width",
+                                                     required=False, default=onnx_width)
+            onnx_height = zm_util.get_int_from_config(config, section, "analysis_height",
+                                                      required=False, default=onnx_height)
+        self.onnx_analysis_size = (onnx_width,onnx_height)
+        self.readModelVariants(config, section, self.onnx_model)
+
+    def readModelVariants(self, config, section, fp32_model, precisions=["fp16", "int8"]):
+        '''Reads paths of reduced-precision variants of a model (fp16_model_path and
+           int8_model_path) from a model section. The regular model_path is the fp32 variant.
+           precisions lists the variants the model type supports. Others are ignored with a
+           warning.'''
+        variants = {"fp32": fp32_model}
+        if config.has_section(section):
+            for variant in ["fp16", "int8"]:
+                path = zm_util.get_from_config(config, section, variant+"_model_path",
+                                               required=False, default="")
+                if path == "":
+                    continue
+                if variant not in precisions:
+                    debug("{:s} models don't support {:s}. Ignoring {:s}_model_path." \
+                          .format(section, variant, variant), "stderr")
+                    continue
+                variants[variant] = path
+        self.model_variants[section] = variants
+
     def readMonitorSettings(self, api_monitors):
         '''Reads monitor settings given a list of monitors from the API'''
 
@@ -194,10 +389,32 @@ class Settings:
             detect_classes = []
             confidence_threshold = 0.4
             detect_in = ""
+            cascade_first_stage = "MobileNetV3"
+            cascade_uncertain_low = 0.3
+            cascade_uncertain_high = 0.7
+            cascade_escalate_score = 50
+            priority = 0
+            event_deadline = 0
+            stale_detection_model = ""
+            frame_idle_timeout = 5
+            frame_step = 1
+            detect_source = "events"
+            stream_url = ""
+            stream_sample_rate = 1.0
+            stream_cooldown = 60
+            tile_columns = 1
+            tile_rows = 1
+            tile_overlap = 0.2
+            model_variant = "fp32"
+            duplicate_gate = "off"
+            duplicate_distance = 5
+            duplicate_max_age = 300
+            latency_budget = 0
+            notification_group = ""
             self.monitors[mname]["check_events"] = True
             if not config.has_section(mname):
-                zm_util.debug("No config section for {:s}, not doing object detection." \
-                              .format(mname))
+                debug("No config section for {:s}, not doing object detection." \
+                      .format(mname))
             else:
                 self.monitors[mname]["check_events"] = zm_util.get_bool_from_config(config, mname,
                                                        "check_events", required=False, default=True)
@@ -212,8 +429,97 @@ class Settings:
                                                 "confidence_threshold", required=False, default=0.4)
                 detect_in = zm_util.get_from_config(config, mname, "detect_in", required=False,
                                                     default="image")
+                cascade_first_stage = zm_util.get_from_config(config, mname,
+                                "cascade_first_stage", required=False, default=cascade_first_stage)
+                cascade_uncertain_low = zm_util.get_float_from_config(config, mname,
+                            "cascade_uncertain_low", required=False, default=cascade_uncertain_low)
+                cascade_uncertain_high = zm_util.get_float_from_config(config, mname,
+                          "cascade_uncertain_high", required=False, default=cascade_uncertain_high)
+                cascade_escalate_score = zm_util.get_int_from_config(config, mname,
+                          "cascade_escalate_score", required=False, default=cascade_escalate_score)
+                # Otherwise the first stage alone could report detections below the threshold
+                if detection_model == "Cascade" and not \
+                   cascade_uncertain_low <= confidence_threshold <= cascade_uncertain_high:
+                    debug("{:s}:confidence_threshold must be between cascade_uncertain_low and " \
+                          "cascade_uncertain_high".format(mname), "stderr")
+                    sys.exit(1)
+                priority = zm_util.get_int_from_config(config, mname, "priority", required=False,
+                                                       default=priority)
+                event_deadline = zm_util.get_int_from_config(config, mname, "event_deadline",
+                                                             required=False, default=event_deadline)
+                stale_detection_model = zm_util.get_from_config(config, mname,
+                            "stale_detection_model", required=False, default=stale_detection_model)
+                frame_idle_timeout = zm_util.get_float_from_config(config, mname,
+                                  "frame_idle_timeout", required=False, default=frame_idle_timeout)
+                frame_step = zm_util.get_int_from_config(config, mname, "frame_step",
+                                                         required=False, default=frame_step)
+                detect_source = zm_util.get_from_config(config, mname, "detect_source",
+                                                        required=False, default=detect_source)
+                stream_url = zm_util.get_from_config(config, mname, "stream_url", required=False,
+                                                     default=stream_url)
+                stream_sample_rate = zm_util.get_float_from_config(config, mname,
+                                  "stream_sample_rate", required=False, default=stream_sample_rate)
+                if stream_sample_rate <= 0:
+                    debug("{:s}:stream_sample_rate must be positive".format(mname),
+                          "stderr")
+                    sys.exit(1)
+                stream_cooldown = zm_util.get_float_from_config(config, mname, "stream_cooldown",
+                                                            required=False, default=stream_cooldown)
+                tile_columns = zm_util.get_int_from_config(config, mname, "tile_columns",
+                                                           required=False, default=tile_columns)
+                tile_rows = zm_util.get_int_from_config(config, mname, "tile_rows",
+                                                        required=False, default=tile_rows)
+                tile_overlap = zm_util.get_float_from_config(config, mname, "tile_overlap",
+                                                             required=False, default=tile_overlap)
+                model_variant = zm_util.get_from_config(config, mname, "model_variant",
+                                                        required=False, default=model_variant)
+                if model_variant not in ["fp32", "fp16", "int8"]:
+                    debug("{:s}:model_variant must be fp32, fp16, or int8".format(mname),
+                          "stderr")
+                    sys.exit(1)
+                # OpenCV can only load int8-quantized models from ONNX files
+                if model_variant == "int8" and \
+                   detection_model in ["Darknet", "MobileNetV3", "InceptionV2", "Cascade"]:
+                    debug("{:s}:model_variant int8 is not supported for {:s}" \
+                          .format(mname, detection_model), "stderr")
+                    sys.exit(1)
+                duplicate_gate = zm_util.get_from_config(config, mname, "duplicate_gate",
+                                                    required=False, default=duplicate_gate).lower()
+                if duplicate_gate not in ["off", "reuse", "skip"]:
+                    debug("{:s}:duplicate_gate must be off, reuse, or skip".format(mname),
+                          "stderr")
+                    sys.exit(1)
+                duplicate_distance = zm_util.get_int_from_config(config, mname,
+                                  "duplicate_distance", required=False, default=duplicate_distance)
+                duplicate_max_age = zm_util.get_float_from_config(config, mname,
+                                    "duplicate_max_age", required=False, default=duplicate_max_age)
+                latency_budget = zm_util.get_float_from_config(config, mname,
+                                          "latency_budget", required=False, default=latency_budget)
+                notification_group = zm_util.get_from_config(config, mname, "notification_group",
+                                                    required=False, default=notification_group)
             self.monitors[mname]["detect_objects"] = detect_objects
             self.monitors[mname]["detection_model"] = detection_model
             self.monitors[mname]["detect_classes"] = detect_classes
             self.monitors[mname]["confidence_threshold"] = confidence_threshold
             self.monitors[mname]["detect_in"] = detect_in
+            self.monitors[mname]["cascade_first_stage"] = cascade_first_stage
+            self.monitors[mname]["cascade_uncertain_low"] = cascade_uncertain_low
+            self.monitors[mname]["cascade_uncertain_high"] = cascade_uncertain_high
+            self.monitors[mname]["cascade_escalate_score"] = cascade_escalate_score
+            self.monitors[mname]["priority"] = priority
+            self.monitors[mname]["event_deadline"] = event_deadline
+            self.monitors[mname]["stale_detection_model"] = stale_detection_model
+            self.monitors[mname]["frame_idle_timeout"] = frame_idle_timeout
+            self.monitors[mname]["frame_step"] = frame_step
+            self.monitors[mname]["detect_source"] = detect_source
+            self.monitors[mname]["stream_url"] = stream_url
+            self.monitors[mname]["stream_sample_rate"] = stream_sample_rate
+            self.monitors[mname]["stream_cooldown"] = stream_cooldown
+            self.monitors[mname]["tile_grid"] = (tile_columns,tile_rows)
+            self.monitors[mname]["tile_overlap"] = tile_overlap
+            self.monitors[mname]["model_variant"] = model_variant
+            self.monitors[mname]["duplicate_gate"] = duplicate_gate
+            self.monitors[mname]["duplicate_distance"] = duplicate_distance
+            self.monitors[mname]["duplicate_max_age"] = duplicate_max_age
+            self.monitors[mname]["latency_budget"] = latency_budget
+            self.monitors[mname]["notification_group"] = notification_group
@@ -0,0 +1,97 @@
+import threading
+import time
+import cv2
+import zm_util
+
+debug = zm_util.module_debug(__name__)
+
+class StreamCapture:
+    '''Reads frames from a video stream (e.g. ZoneMinder nph-zms MJPEG or a camera RTSP url) in a
+       background thread. Only the latest frame is kept, so slow consumers always get a recent
+       frame instead of a backlog. The stream is reopened automatically if it drops.'''
+
+    def __init__(self, name, url, reconnect_delay=5, max_frame_age=2):
+        '''name: name used in log messages
+           url: stream url, or a function returning the url (called on every (re)connect, so it
+                can include a fresh access token)
+           reconnect_delay: seconds to wait before reopening the stream after an error
+           max_frame_age: frames older than this many seconds are considered stale'''
+        self.name = name
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_frame_age = max_frame_age
+
+        self.lock = threading.Lock()
+        self.frame = None
+        self.frame_time = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        # Counters
+        self.frames_read = 0
+        self.reconnects = 0
+
+    def debug(self, message, pipename='stdout'):
+        debug("{:s} stream: {:s}".format(self.name, message), pipename)
+
+    def _getURL(self):
+        if callable(self.url):
+            return self.url()
+        return self.url
+
+    def _captureLoop(self):
+        '''Background thread that reads frames from the stream and reconnects on errors'''
+        connected_before = False
+        while not self.stop_event.is_set():
+            cap = cv2.VideoCapture(self._getURL())
+            if not cap.isOpened():
+                self.debug("Unable to open stream. Retrying in {:g} s."\
+                           .format(self.reconnect_delay), "stderr")
+                cap.release()
+                self.stop_event.wait(self.reconnect_delay)
+                continue
+            if connected_before:
+                self.reconnects += 1
+                self.debug("Reconnected.")
+            connected_before = True
+
+            while not self.stop_event.is_set():
+                success, frame = cap.read()
+                if not success:
+                    self.debug("Stream dropped. Reconnecting in {:g} s."\
+                               .format(self.reconnect_delay), "stderr")
+                    break
+                with self.lock:
+                    self.frame = frame
+                    self.frame_time = time.time()
+                self.frames_read += 1
+            cap.release()
+            self.stop_event.wait(self.reconnect_delay)
+
+    def start(self):
+        '''Starts the capture thread'''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._captureLoop,
+                                       name="stream_{:s}".format(self.name), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the capture thread'''
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def getLatestFrame(self):
+        '''Returns the latest frame and removes it from the buffer, so the same frame is never
+           returned twice. Returns None if there is no frame or it is stale.'''
+        with self.lock:
+            frame = self.frame
+            frame_time = self.frame_time
+            self.frame = None
+        if frame is None or time.time() - frame_time > self.max_frame_age:
+            return None
+        return frame
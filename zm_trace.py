@@ -0,0 +1,135 @@
+import json
+import time
+import zm_util
+
+debug = zm_util.module_debug(__name__)
+
+# Trace of the event being processed. Phases are marked on it with mark() from anywhere in the
+# processing path, so the trace doesn't need to be passed through every call.
+active = None
+
+def mark(phase, **detail):
+    '''Records a phase on the active trace, if there is one'''
+    if active is not None:
+        active.mark(phase, **detail)
+
+
+class EventTrace:
+    '''Timestamps of the processing phases of one event, from discovery to the notifications
+       being sent. Use the trace as a context manager to make it the active trace while
+       processing:
+           with trace:
+               process_event(...)
+       Phases that happen more than once (e.g. once per video frame) are all recorded.'''
+
+    def __init__(self, monitor_name, event_id, discovered_time=None):
+        self.monitor_name = monitor_name
+        self.event_id = event_id
+        self.start = discovered_time if discovered_time is not None else time.time()
+        self.marks = [("discovered", self.start, {})]
+        self.result = ""
+        self.previous = None
+
+    def __enter__(self):
+        global active
+        self.previous = active
+        active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active
+        active = self.previous
+        self.previous = None
+        return False
+
+    def mark(self, phase, **detail):
+        '''Records the time of a phase along with optional details'''
+        self.marks.append((phase, time.time(), detail))
+
+    def elapsed(self):
+        '''Returns the seconds from discovery to the last recorded phase'''
+        return self.marks[-1][1] - self.start
+
+    def summary(self):
+        '''Returns a dict of phase -> milliseconds from discovery to the last time the phase was
+           recorded, and phase -> count for phases recorded more than once'''
+        phases = {}
+        counts = {}
+        for phase, t, _ in self.marks:
+            phases[phase] = round((t - self.start)*1000, 1)
+            counts[phase] = counts.get(phase, 0) + 1
+        repeated = {phase: n for phase, n in counts.items() if n > 1}
+        return phases, repeated
+
+    def detail(self):
+        '''Returns every recorded phase in order with its details'''
+        items = []
+        for phase, t, detail in self.marks:
+            item = {"phase": phase, "ms": round((t - self.start)*1000, 1)}
+            item.update(detail)
+            items.append(item)
+        return items
+
+
+class TraceGroup:
+    '''Traces of several events that are processed together, e.g. in one merged notification.
+       Used as a context manager like EventTrace, it records the phases marked while it is
+       active on every trace in the group.'''
+
+    def __init__(self, traces):
+        self.traces = traces
+        self.previous = None
+
+    def __enter__(self):
+        global active
+        self.previous = active
+        active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active
+        active = self.previous
+        self.previous = None
+        return False
+
+    def mark(self, phase, **detail):
+        now = time.time()
+        for trace in self.traces:
+            trace.marks.append((phase, now, detail))
+
+
+class TraceLog:
+    '''Writes event traces as one JSON line per event. Events that took longer than slow_threshold
+       seconds from discovery to the last phase include every recorded phase with its details
+       and are also reported in the main log. An empty path disables the log.'''
+
+    def __init__(self, path="", slow_threshold=30.):
+        self.path = path
+        self.slow_threshold = slow_threshold
+
+    def write(self, trace):
+        '''Appends a trace to the log. Returns True if the event was slow.'''
+        total = trace.elapsed()
+        slow = self.slow_threshold > 0 and total > self.slow_threshold
+        if slow:
+            debug("Event {:d} on {:s} was slow: {:.1f} s from discovery to {:s}." \
+                  .format(trace.event_id, trace.monitor_name, total, trace.marks[-1][0]),
+                  "stderr")
+        if self.path == "":
+            return slow
+
+        phases, repeated = trace.summary()
+        record = {"time": round(trace.start, 3), "monitor": trace.monitor_name,
+                  "event": trace.event_id, "result": trace.result,
+                  "total_ms": round(total*1000, 1), "slow": slow, "phases": phases}
+        if len(repeated) > 0:
+            record["counts"] = repeated
+        if slow:
+            record["detail"] = trace.detail()
+        try:
+            # Opened for every event so that the log can be rotated
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except IOError:
+            debug("Unable to write to trace log {:s}.".format(self.path), "stderr")
+        return slow
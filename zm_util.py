@@ -1,14 +1,179 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
 import sys
-from datetime import datetime
+import threading
+import time
 from configparser import NoOptionError
 
-def debug(message, pipe="stdout"):
+# Log records are put on a queue by the caller and written to stdout/stderr by a QueueListener
+# thread, so slow log I/O never blocks detection or polling.
+_listener = None
+_queue_handler = None
+# Set by stop_logging at exit, after which debug writes to the streams directly
+_stopped = False
+_lock = threading.RLock()
 
-    curr_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if pipe == "stderr":
-        sys.stderr.write("{:s} {:s}\n".format(curr_time, message))
-    else:
-        sys.stdout.write("{:s} {:s}\n".format(curr_time, message))
+# Logger names for the modules, so that each module logs as e.g. zm_notifier.api
+_module_loggers = {"zm_api": "api", "zm_object_detection": "detector", "zm_monitor": "monitor",
+                   "zm_notification": "notification", "__main__": "main"}
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler that drops records instead of blocking or raising when the queue is full'''
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _RateLimitFilter(logging.Filter):
+    '''Suppresses repeats of the same warning or error from the same logger within interval
+       seconds. The next message let through reports how many were suppressed.'''
+
+    def __init__(self, interval):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.recent = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        now = time.time()
+        key = (record.name, record.levelno, record.getMessage())
+        last = self.recent.get(key)
+        if last is not None and now - last[0] < self.interval:
+            last[1] += 1
+            return False
+        if last is not None and last[1] > 0:
+            record.msg = "{:s} (repeated {:d} more times)".format(record.getMessage(), last[1])
+            record.args = None
+        self.recent[key] = [now, 0]
+
+        # Forget messages that haven't been seen for a while
+        if len(self.recent) > 1000:
+            self.recent = {k: v for k, v in self.recent.items() if now - v[0] < self.interval}
+        return True
+
+class _JSONFormatter(logging.Formatter):
+    '''Formats records as one JSON object per line'''
+
+    def format(self, record):
+        return json.dumps({"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                           "level": record.levelname.lower(), "logger": record.name,
+                           "message": record.getMessage()})
+
+class _MaxLevelFilter(logging.Filter):
+    def __init__(self, level):
+        logging.Filter.__init__(self)
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno < self.level
+
+def setup_logging(level="info", json_format=False, rate_limit=60, queue_size=10000):
+    '''Sets up asynchronous logging. Messages below warning level go to stdout and the rest to
+       stderr. level: debug, info, warning, or error. json_format: write JSON lines instead of
+       text. rate_limit: seconds during which repeats of the same warning or error are suppressed
+       (0 disables this). queue_size: maximum number of records waiting to be written; more are
+       dropped. Can be called again to change the settings, also while other threads are
+       logging.'''
+    global _listener, _queue_handler, _stopped
+
+    with _lock:
+        if json_format:
+            formatter = _JSONFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%d %H:%M:%S")
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.addFilter(_MaxLevelFilter(logging.WARNING))
+        stdout_handler.setFormatter(formatter)
+        stderr_handler = logging.StreamHandler(sys.stderr)
+        stderr_handler.setLevel(logging.WARNING)
+        stderr_handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(maxsize=queue_size)
+        queue_handler = _DroppingQueueHandler(log_queue)
+        if rate_limit > 0:
+            queue_handler.addFilter(_RateLimitFilter(rate_limit))
+        listener = logging.handlers.QueueListener(log_queue, stdout_handler, stderr_handler,
+                                                  respect_handler_level=True)
+        listener.start()
+
+        # On a reload other threads may be logging, so the new handler is installed before the old
+        # one is removed and its listener stopped. Holding _lock keeps debug from starting another
+        # listener meanwhile.
+        logger = logging.getLogger("zm_notifier")
+        logger.addHandler(queue_handler)
+        logger.setLevel(getattr(logging, level.upper(), logging.INFO))
+        logger.propagate = False
+        for handler in logger.handlers[:]:
+            if handler is not queue_handler:
+                logger.removeHandler(handler)
+        old_listener, old_handler = _listener, _queue_handler
+        _listener, _queue_handler = listener, queue_handler
+        _stopped = False
+        _stop_listener(old_listener, old_handler)
+
+def _stop_listener(listener, queue_handler):
+    if listener is None:
+        return
+    listener.stop()
+    if queue_handler.dropped > 0:
+        sys.stderr.write("{:d} log messages were dropped because the log queue was full.\n" \
+                         .format(queue_handler.dropped))
+
+def stop_logging():
+    '''Writes out any queued log records and stops the logging thread. Messages logged after
+       this are written directly to stdout or stderr.'''
+    global _listener, _stopped
+    with _lock:
+        listener = _listener
+        _listener = None
+        _stopped = True
+        _stop_listener(listener, _queue_handler)
+
+atexit.register(stop_logging)
+
+def get_logger(module_name):
+    '''Returns the logger for a module'''
+    name = _module_loggers.get(module_name, module_name.replace("zm_", "", 1))
+    return logging.getLogger("zm_notifier." + name)
+
+_main_logger = get_logger("__main__")
+
+def debug(message, pipe="stdout", level=None, logger=None):
+    '''Logs a message with a logger from get_logger, or the main logger if none is given.
+       Messages for stderr are logged as warnings and others as info, unless a level (a logging
+       module level) is given.'''
+    if level is None:
+        level = logging.WARNING if pipe == "stderr" else logging.INFO
+    if logger is None:
+        logger = _main_logger
+    if _listener is None:
+        with _lock:
+            if _stopped:
+                if logger.isEnabledFor(level):
+                    stream = sys.stderr if level >= logging.WARNING else sys.stdout
+                    stream.write(message + "\n")
+                return
+            if _listener is None:
+                setup_logging()
+    logger.log(level, message)
+
+def module_debug(module_name):
+    '''Returns a debug function that logs with the logger of a module. Modules set it up once
+       with debug = zm_util.module_debug(__name__).'''
+    logger = get_logger(module_name)
+    def _debug(message, pipe="stdout", level=None):
+        debug(message, pipe, level, logger)
+    return _debug
 
 def get_from_config(config, section, option, required=True, default=None):
 